@@ -23,6 +23,7 @@ import datetime
 import random
 
 from archipelcore.archipelPlugin import TNArchipelPlugin
+from archipelcore.entriesencoding import ARCHIPEL_CENTRALAGENT_FEATURE_SYNC_VMS, ARCHIPEL_ENTRIES_ENCODING_COMPACT, ARCHIPEL_ENTRIES_ENCODINGS, get_domain_fingerprint, get_encodings, get_features, is_compact_entries_node, pack_compact_entries, unpack_compact_entries
 from archipelcore.pubsub import TNPubSubNode
 from archipelcore import xmpp
 from threading import Timer
@@ -37,6 +38,12 @@ ARCHIPEL_ERROR_CODE_CENTRALAGENT         = 123
 
 ARCHIPEL_CENTRAL_AGENT_TIMEOUT           = 60
 
+# number of entries asked per chunk of read
+ARCHIPEL_CENTRALDB_READ_CHUNK_SIZE       = 500
+
+# number of times a read is started again when a chunk cannot be read
+ARCHIPEL_CENTRALDB_READ_RETRIES          = 1
+
 
 class TNTasks(object):
     """Timed jobs tasker"""
@@ -83,13 +90,18 @@ class TNCentralDb (TNArchipelPlugin):
         if self.entity.__class__.__name__ == "TNArchipelVirtualMachine":
             self.entity.register_hook("HOOK_VM_INITIALIZE", method=self.hook_missed_vms, oneshot=True)
             self.entity.register_hook("HOOK_VM_DEFINE",     method=self.hook_vm_event)
+            self.entity.register_hook("HOOK_VM_TERMINATE",  method=self.hook_vm_left)
+            self.entity.register_hook("HOOK_VM_UNDEFINE",   method=self.hook_vm_left)
 
         self.central_agent_jid_val = None
+        self.central_agent_encodings = []
+        self.central_agent_features = []
         self.last_keepalive_heard = None
         self.keepalive_interval = int(ARCHIPEL_CENTRAL_AGENT_TIMEOUT * 2)
         self.hypervisor_timeout_threshold = int(ARCHIPEL_CENTRAL_AGENT_TIMEOUT)
         self.delayed_tasks = TNTasks(self.entity.log)
         self.vms_to_hook = set()
+        self.vms_fingerprints = {}
 
         self.xmpp_authenticated    = False
 
@@ -113,14 +125,32 @@ class TNCentralDb (TNArchipelPlugin):
             return
 
         xmldesc = self.entity.xmldesc(mask_description=False)
-        vm_info = [{"uuid":self.entity.uuid,"parker":None,"creation_date":None,"domain":xmldesc,"hypervisor":self.entity.hypervisor.jid, 'name':xmldesc.getTag("name").getData()}]
+        fingerprint = get_domain_fingerprint(xmldesc)
+        hypervisor_centraldb = self.entity.hypervisor.get_plugin("centraldb")
+        if hypervisor_centraldb:
+            if hypervisor_centraldb.vms_fingerprints.get(self.entity.uuid) == fingerprint:
+                self.entity.log.debug("CENTRALDB: definition of %s has not changed, not registering it." % self.entity.uuid)
+                return
+            hypervisor_centraldb.vms_fingerprints[self.entity.uuid] = fingerprint
+        vm_info = [{"uuid":self.entity.uuid,"parker":None,"creation_date":None,"domain":xmldesc,"hypervisor":self.entity.hypervisor.jid, 'name':xmldesc.getTag("name").getData(), "fingerprint":fingerprint}]
         self.register_vms(vm_info)
 
+    def hook_vm_left(self, origin=None, user_info=None, arguments=None):
+        """
+        Called when a VM is undefined or leaves the hypervisor (free, soft free
+        for parking or migration). Forget its fingerprint, so its definition is
+        registered again with this hypervisor if it comes back.
+        """
+        hypervisor_centraldb = self.entity.hypervisor.get_plugin("centraldb")
+        if hypervisor_centraldb:
+            hypervisor_centraldb.vms_fingerprints.pop(self.entity.uuid, None)
+
     def hook_vm_unregistered(self, origin=None, user_info=None, arguments=None):
         """
         Called when a VM termination occurs.
         This will advertise undefinition to the central agent.
         """
+        self.vms_fingerprints.pop(arguments.uuid, None)
         self.unregister_vms([{"uuid":arguments.uuid}], None)
 
     # Pubsub management
@@ -199,13 +229,22 @@ class TNCentralDb (TNArchipelPlugin):
                     self.hypervisor_timeout_threshold = int(central_announcement_event.getAttr("hypervisor_timeout_threshold"))
 
                 self.central_agent_jid_val = keepalive_jid
+                self.central_agent_encodings = get_encodings(central_announcement_event)
+                self.central_agent_features = get_features(central_announcement_event)
                 self.last_keepalive_heard  = datetime.datetime.now()
 
                 self.delayed_tasks.add((self.hypervisor_timeout_threshold - self.keepalive_interval) * 2 / 3, self.push_statistics_to_centraldb, {'central_announcement_event':central_announcement_event})
 
                 if not old_central_agent_jid:
                     self.delayed_tasks.add(self.keepalive_interval, self.handle_first_keepalive, {'keepalive_jid':keepalive_jid})
-                elif central_announcement_event.getAttr("force_update") == "true" or keepalive_jid != old_central_agent_jid:
+                elif central_announcement_event.getAttr("force_update") == "true":
+                    self.delayed_tasks.add(self.keepalive_interval, self.push_vms_in_central_db)
+                elif keepalive_jid != old_central_agent_jid:
+                    # a standby central agent with a replica of the database took over. The replica may miss
+                    # the last changes, so we still push our vms, but through sync_vms only the definitions
+                    # it does not know are sent again.
+                    if central_announcement_event.getAttr("replicated") == "true":
+                        self.entity.log.info("CENTRALDB: central agent %s took over with a replicated database, syncing our vms" % keepalive_jid)
                     self.delayed_tasks.add(self.keepalive_interval, self.push_vms_in_central_db)
 
     def push_statistics_to_centraldb(self, central_announcement_event):
@@ -246,14 +285,11 @@ class TNCentralDb (TNArchipelPlugin):
                 if callback:
                     callback(**kwargs)
 
-            for vm in vms_from_local_db:
-                entryTag = xmpp.Node(tag="entry")
-                uuid     = xmpp.JID(vm["string_jid"]).getNode()
-                entryTag.addChild("item",attrs={"key":"uuid","value": uuid})
+            for entryTag in self.pack_entries([{"uuid": xmpp.JID(vm["string_jid"]).getNode()} for vm in vms_from_local_db]):
                 dbCommand.addChild(node=entryTag)
 
             iq = xmpp.Iq(typ="set", queryNS=ARCHIPEL_NS_CENTRALAGENT, to=keepalive_jid)
-            iq.getTag("query").addChild(name="archipel", attrs={"action":"get_existing_vms_instances"})
+            iq.getTag("query").addChild(name="archipel", attrs={"action":"get_existing_vms_instances", "encodings":",".join(ARCHIPEL_ENTRIES_ENCODINGS)})
             iq.getTag("query").getTag("archipel").addChild(node=dbCommand)
             self.entity.xmppclient.SendAndCallForResponse(iq, _get_existing_vms_instances_callback)
 
@@ -268,38 +304,68 @@ class TNCentralDb (TNArchipelPlugin):
         there is a new central agent, or we just started.
         Consequently, we re-populate central database
         since we are using "on conflict replace" mode of sqlite, inserting an existing uuid will overwrite it.
+        If the central agent supports it, only the fingerprints of the definitions
+        are sent first, then the definitions it does not know yet. Otherwise, all
+        the definitions are sent.
         """
-        vms = []
+        vms = {}
         for vm,vmprops in self.entity.virtualmachines.iteritems():
             if vmprops.definition:
-                vms.append({"uuid":vmprops.uuid,"parker":None,"creation_date":None,"domain":vmprops.definition,"hypervisor":self.entity.jid, "name":vmprops.definition.getTag("name").getData()})
+                fingerprint = get_domain_fingerprint(vmprops.definition)
+                self.vms_fingerprints[vmprops.uuid] = fingerprint
+                vms[vmprops.uuid] = {"uuid":vmprops.uuid,"parker":None,"creation_date":None,"domain":vmprops.definition,"hypervisor":self.entity.jid, "name":vmprops.definition.getTag("name").getData(), "fingerprint":fingerprint}
             else:
                 self.entity.log.debug("[CENTRALDB] The entity %s looks not ready, postponing it's registration." % vmprops.uuid)
                 self.vms_to_hook.add(vmprops.uuid)
 
-        if len(vms) >= 1:
-            self.register_vms(vms)
+        def _sync_vms_callback(changed_vms):
+            changed = [vms[vm["uuid"]] for vm in changed_vms if vm.get("uuid") in vms]
+            self.entity.log.info("CENTRALDB: %d/%d vms definitions to send to central agent" % (len(changed), len(vms)))
+            if len(changed) >= 1:
+                self.register_vms(changed)
+
+        if len(vms) >= 1 and not ARCHIPEL_CENTRALAGENT_FEATURE_SYNC_VMS in self.central_agent_features:
+            self.entity.log.info("CENTRALDB: central agent does not support sync_vms, sending all the %d vms definitions" % len(vms))
+            self.register_vms(vms.values())
+        elif len(vms) >= 1:
+            self.sync_vms([{"uuid":vm["uuid"], "fingerprint":vm["fingerprint"], "hypervisor":vm["hypervisor"], "name":vm["name"]} for vm in vms.values()], _sync_vms_callback)
 
         self.register_hypervisors([{"jid":self.entity.jid, "status":"Online", "last_seen": datetime.datetime.now(), "stat1":0, "stat2":0, "stat3":0}])
 
     # Database Management
     # read commands
 
-    def read_hypervisors(self, columns, where_statement, callback):
+    def read_hypervisors(self, columns, where_statement, callback, **query):
         """
         List vm in database.
         @type table: list
         @param table: the list of hypervisors to insert
+        @type query: dict
+        @param query: the structured query (filters, order, limit, offset) used instead of where_statement,
+                      and the chunking of the reply (chunk_size, incremental), see read_from_db
         """
-        self.read_from_db("read_hypervisors", columns, where_statement, callback)
+        self.read_from_db("read_hypervisors", columns, where_statement, callback, **query)
 
-    def read_vms(self, columns, where_statement, callback):
+    def read_vms(self, columns, where_statement, callback, **query):
         """
         Registers a list of vms into central database.
         @type table: list
         @param table: the list of vms to insert
+        @type query: dict
+        @param query: the structured query (filters, order, limit, offset) used instead of where_statement,
+                      and the chunking of the reply (chunk_size, incremental), see read_from_db
         """
-        self.read_from_db("read_vms", columns, where_statement, callback)
+        self.read_from_db("read_vms", columns, where_statement, callback, **query)
+
+    def count_vms(self, callback, filters=None):
+        """
+        Count the vms of central database matching the filters.
+        @type callback: func
+        @param callback: will be called with a list containing one entry with the "count" key
+        @type filters: list
+        @param filters: list of (column, operator, value), see read_from_db
+        """
+        self.read_from_db("count_vms", None, None, callback, filters=filters)
 
     # write commands
 
@@ -319,6 +385,17 @@ class TNCentralDb (TNArchipelPlugin):
         """
         self.commit_to_db("register_vms",table, None)
 
+    def sync_vms(self,table,callback):
+        """
+        Send the fingerprints of a list of vms to central database. The vms
+        whose definition is already known are assigned to the hypervisor.
+        @type table: list
+        @param table: the list of vms, with uuid, fingerprint, hypervisor and name
+        @type callback: func
+        @param callback: will return the list of vms whose definition must be registered
+        """
+        self.commit_to_db("sync_vms",table, callback)
+
     def unregister_hypervisors(self,table):
         """
         Unregisters a list of hypervisors from central database.
@@ -383,22 +460,18 @@ class TNCentralDb (TNArchipelPlugin):
 
         if central_agent_jid:
             dbCommand = xmpp.Node(tag="event", attrs={"jid":self.entity.jid})
-            for entry in table:
-                entryTag = xmpp.Node(tag="entry")
-                for key,value in entry.iteritems():
-                    entryTag.addChild("item",attrs={"key":key,"value":value})
-
+            for entryTag in self.pack_entries(table):
                 dbCommand.addChild(node=entryTag)
 
             iq = xmpp.Iq(typ="set", queryNS=ARCHIPEL_NS_CENTRALAGENT, to=central_agent_jid)
-            iq.getTag("query").addChild(name="archipel", attrs={"action":action})
+            iq.getTag("query").addChild(name="archipel", attrs={"action":action, "encodings":",".join(ARCHIPEL_ENTRIES_ENCODINGS)})
             iq.getTag("query").getTag("archipel").addChild(node=dbCommand)
             self.entity.log.debug("CENTRALDB [%s]: \n%s" % (action.upper(), iq))
             self.entity.xmppclient.SendAndCallForResponse(iq, commit_to_db_callback)
         else:
             self.entity.log.warning("CENTRALDB: cannot commit to db because we have not detected any central agent")
 
-    def read_from_db(self,action,columns, where_statement, callback):
+    def read_from_db(self,action,columns, where_statement, callback, filters=None, order=None, limit=None, offset=None, chunk_size=ARCHIPEL_CENTRALDB_READ_CHUNK_SIZE, incremental=False):
         """
         Send a select statement to central db.
         @type command: string
@@ -407,16 +480,58 @@ class TNCentralDb (TNArchipelPlugin):
         @param columns: the list of database columns to return
         @type where_statement: string
         @param where_statement: for database reads, provides "where" constraint
-        """
+        @type filters: list
+        @param filters: list of (column, operator, value) that must all match, used instead of where_statement.
+                        The value of the "in" operator is a list, the "not_online" operator has no value,
+                        the value of the "after" operator is the (value, uuid) of the last entry of the previous page
+        @type order: list
+        @param order: list of (column, "asc" or "desc")
+        @type limit: int
+        @param limit: the maximum number of entries to return
+        @type offset: int
+        @param offset: the number of entries to skip
+        @type chunk_size: int
+        @param chunk_size: the maximum number of entries the central agent sends per reply, None for all
+        @type incremental: bool
+        @param incremental: if True, callback is called for each chunk with (entries, more),
+                            more being True until the last chunk. Otherwise the chunks are
+                            reassembled and callback is called once with all the entries.
+                            If a chunk cannot be read, the read is started again if it is not
+                            incremental, otherwise callback is not called anymore
+        """
+        read_entries = []
+        read_state = {"retries": ARCHIPEL_CENTRALDB_READ_RETRIES, "continued": False}
 
         def _read_from_db_callback(conn, resp):
+            if resp.getType() == "error":
+                if read_state["continued"] and not incremental and read_state["retries"] > 0:
+                    read_state["retries"] -= 1
+                    read_state["continued"] = False
+                    del read_entries[:]
+                    self.entity.log.warning("CENTRALDB: unable to read the next entries of [%s], reading them again from the start: %s" % (action.upper(), str(resp)))
+                    _send_read_request(resp.getFrom())
+                else:
+                    self.entity.log.error("CENTRALDB: unable to read [%s] from central db: %s" % (action.upper(), str(resp)))
+                return
             unpacked_entries = self.unpack_entries(resp)
+            continuation = resp.getTag("continuation")
             self.entity.log.debug("CENTRALDB: read %s entries from db response" % len(unpacked_entries))
-            callback(unpacked_entries)
-
-        central_agent_jid = self.central_agent_jid()
-
-        if central_agent_jid:
+            if incremental:
+                callback(unpacked_entries, bool(continuation))
+            else:
+                read_entries.extend(unpacked_entries)
+            if continuation:
+                self.entity.log.debug("CENTRALDB: %s entries left to read" % continuation.getAttr("remaining"))
+                read_state["continued"] = True
+                continueCommand = xmpp.Node(tag="event", attrs={"jid":self.entity.jid, "continuation":continuation.getAttr("token")})
+                iq = xmpp.Iq(typ="set", queryNS=ARCHIPEL_NS_CENTRALAGENT, to=resp.getFrom())
+                iq.getTag("query").addChild(name="archipel", attrs={"action":"read_continue", "encodings":",".join(ARCHIPEL_ENTRIES_ENCODINGS)})
+                iq.getTag("query").getTag("archipel").addChild(node=continueCommand)
+                self.entity.xmppclient.SendAndCallForResponse(iq, _read_from_db_callback)
+            elif not incremental:
+                callback(read_entries)
+
+        def _send_read_request(central_agent_jid):
             dbCommand = xmpp.Node(tag="event", attrs={"jid":self.entity.jid})
             if where_statement:
                 dbCommand.setAttr("where_statement", where_statement)
@@ -424,14 +539,56 @@ class TNCentralDb (TNArchipelPlugin):
             if columns:
                 dbCommand.setAttr("columns", columns)
 
-            self.entity.log.debug("CENTRALDB: Asking central db for [%s] %s %s" % (action.upper(), columns, where_statement))
+            for column, operator, value in filters or []:
+                filter_node = dbCommand.addChild("filter", attrs={"column": column, "operator": operator})
+                if operator in ("in", "after"):
+                    for item in value:
+                        filter_node.addChild("value", attrs={"value": item})
+                elif value is not None:
+                    filter_node.setAttr("value", value)
+
+            for column, direction in order or []:
+                dbCommand.addChild("order", attrs={"column": column, "direction": direction})
+
+            if limit is not None:
+                limit_node = dbCommand.addChild("limit", attrs={"count": limit})
+                if offset is not None:
+                    limit_node.setAttr("offset", offset)
+
+            self.entity.log.debug("CENTRALDB: Asking central db for [%s] %s %s" % (action.upper(), columns, where_statement or filters))
             iq = xmpp.Iq(typ="set", queryNS=ARCHIPEL_NS_CENTRALAGENT, to=central_agent_jid)
-            iq.getTag("query").addChild(name="archipel", attrs={"action":action})
+            iq.getTag("query").addChild(name="archipel", attrs={"action":action, "encodings":",".join(ARCHIPEL_ENTRIES_ENCODINGS)})
+            if chunk_size:
+                iq.getTag("query").getTag("archipel").setAttr("chunk_size", chunk_size)
             iq.getTag("query").getTag("archipel").addChild(node=dbCommand)
             self.entity.xmppclient.SendAndCallForResponse(iq, _read_from_db_callback)
+
+        central_agent_jid = self.central_agent_jid()
+
+        if central_agent_jid:
+            _send_read_request(central_agent_jid)
         else:
             self.entity.log.warning("CENTRALDB: cannot read from db because we have not detected any central agent")
 
+    def pack_entries(self, table):
+        """
+        Pack the list of entries to send to the central agent. The compact
+        encoding is used if the central agent announced it.
+        @type table: list
+        @param table: list of dict entries
+        @rtype: list
+        @return: list of xmpp nodes, one per entry, or one compact node
+        """
+        if ARCHIPEL_ENTRIES_ENCODING_COMPACT in self.central_agent_encodings:
+            return [pack_compact_entries(table)]
+        packed_entries = []
+        for entry in table:
+            entryTag = xmpp.Node(tag="entry")
+            for key,value in entry.iteritems():
+                entryTag.addChild("item",attrs={"key":key,"value":value})
+            packed_entries.append(entryTag)
+        return packed_entries
+
     def unpack_entries(self, iq):
         """
         Unpack the list of entries from iq for database processing.
@@ -441,6 +598,9 @@ class TNCentralDb (TNArchipelPlugin):
         entries = []
 
         for entry in iq.getChildren():
+            if is_compact_entries_node(entry):
+                entries.extend(unpack_compact_entries(entry))
+                continue
             entry_dict = {}
             for entry_val in entry.getChildren():
                 if entry_val.getAttr("key"):
@@ -43,8 +43,8 @@ class TNOOMKiller (TNArchipelPlugin):
         @param entry_point_group: the group name of plugin entry_point
         """
         TNArchipelPlugin.__init__(self, configuration=configuration, entity=entity, entry_point_group=entry_point_group)
-        self.entity.register_hook("HOOK_VM_INITIALIZE", method=self.vm_initialized)
-        self.entity.register_hook("HOOK_VM_CREATE", method=self.vm_create)
+        self.entity.register_hook("HOOK_VM_INITIALIZE", method=self.vm_initialized, asynchronous=True)
+        self.entity.register_hook("HOOK_VM_CREATE", method=self.vm_create, asynchronous=True)
         self.oomkiller_flag = "/%s/oomkiller_flag" % (self.entity.folder)
         self.entity.log.info("OOM: module oom killer initialized")
         # permissions
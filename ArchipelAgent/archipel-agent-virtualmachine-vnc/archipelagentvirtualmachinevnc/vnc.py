@@ -58,13 +58,13 @@ class TNArchipelVNC (TNArchipelPlugin):
         # permissions
         self.entity.permission_center.create_permission("vnc_display", "Authorizes users to access the vnc display port", False)
         # hooks
-        self.entity.register_hook("HOOK_VM_CREATE", method=self.create_novnc_proxy)
-        self.entity.register_hook("HOOK_VM_CRASH", method=self.stop_novnc_proxy)
-        self.entity.register_hook("HOOK_VM_STOP", method=self.stop_novnc_proxy)
-        self.entity.register_hook("HOOK_VM_DESTROY", method=self.stop_novnc_proxy)
-        self.entity.register_hook("HOOK_VM_TERMINATE", method=self.stop_novnc_proxy)
-        self.entity.register_hook("HOOK_VM_MIGRATED", method=self.stop_novnc_proxy)
-        self.entity.register_hook("HOOK_VM_INITIALIZE", method=self.awake_from_initialization)
+        self.entity.register_hook("HOOK_VM_CREATE", method=self.create_novnc_proxy, asynchronous=True)
+        self.entity.register_hook("HOOK_VM_CRASH", method=self.stop_novnc_proxy, asynchronous=True)
+        self.entity.register_hook("HOOK_VM_STOP", method=self.stop_novnc_proxy, asynchronous=True)
+        self.entity.register_hook("HOOK_VM_DESTROY", method=self.stop_novnc_proxy, asynchronous=True)
+        self.entity.register_hook("HOOK_VM_TERMINATE", method=self.stop_novnc_proxy, asynchronous=True)
+        self.entity.register_hook("HOOK_VM_MIGRATED", method=self.stop_novnc_proxy, asynchronous=True)
+        self.entity.register_hook("HOOK_VM_INITIALIZE", method=self.awake_from_initialization, asynchronous=True)
 
         self.websocket_verbose = False
         if self.configuration.has_option("VNC", "vnc_enable_websocket_debug"):
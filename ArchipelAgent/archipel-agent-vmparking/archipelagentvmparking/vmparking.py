@@ -39,6 +39,9 @@ ARCHIPEL_ERROR_CODE_VMPARK_DELETE          = -11004
 ARCHIPEL_ERROR_CODE_VMPARK_EDIT_DEFINITION = -11004
 ARCHIPEL_ERROR_CODE_VMPARK_CREATE_PARKED   = -11005
 
+ARCHIPEL_VMPARK_LIST_COLUMNS      = "uuid,parker,creation_date,name"
+ARCHIPEL_VMPARK_VMS_PER_PAGE      = 30
+
 ARCHIPEL_NS_HYPERVISOR_VMPARKING = "archipel:hypervisor:vmparking"
 ARCHIPEL_NS_VM_VMPARKING         = "archipel:vm:vmparking"
 
@@ -62,6 +65,8 @@ class TNVMParking (TNArchipelPlugin):
 
         if isinstance(self.entity, TNArchipelHypervisor):
             self.entity.permission_center.create_permission("vmparking_list", "Authorizes user to list virtual machines in parking", False)
+            self.entity.permission_center.create_permission("vmparking_count", "Authorizes user to count virtual machines in parking", False)
+            self.entity.permission_center.create_permission("vmparking_get", "Authorizes user to get the definition of parked virtual machines", False)
             self.entity.permission_center.create_permission("vmparking_unpark", "Authorizes user to unpark a virtual machines", False)
             self.entity.permission_center.create_permission("vmparking_delete", "Authorizes user to delete parked virtual machines", False)
             self.entity.permission_center.create_permission("vmparking_edit_definition", "Authorizes user to edit the xml definition of a parked virtual machines", False)
@@ -128,8 +133,8 @@ class TNVMParking (TNArchipelPlugin):
         uuid_strings = []
         for vm in vms:
             uuid_strings.append(vm["uuid"])
-        where_statement = "uuid='" + "' or uuid='".join(uuid_strings) + "' and (hypervisor='None' or hypervisor not in (select jid from hypervisors where status='Online'))"
-        self.entity.get_plugin("centraldb").read_vms("*", where_statement, callback)
+        filters = [("uuid", "in", uuid_strings), ("hypervisor", "not_online", None)]
+        self.entity.get_plugin("centraldb").read_vms("*", None, callback, filters=filters)
 
     def get_vms_from_name(self, name, callback):
         """
@@ -137,18 +142,40 @@ class TNVMParking (TNArchipelPlugin):
         @type name: string
         @param name: The pattern name of vms like vm_
         """
-        where_statement = "name like '%s%' and domain != 'None' and (hypervisor='None' or hypervisor not in (select jid from hypervisors where status='Online')) order by name" % name
-        self.entity.get_plugin("centraldb").read_vms("*", where_statement, callback)
+        filters = [("name", "like", "%s%%" % name), ("domain", "!=", "None"), ("hypervisor", "not_online", None)]
+        self.entity.get_plugin("centraldb").read_vms("*", None, callback, filters=filters, order=[("name", "asc")])
+
+    def get_parked_filters(self, filter=None):
+        """
+        Return the structured query filters matching the parked virtual machines.
+        @type filter: string
+        @param filter: if set, only the vms with a name containing it
+        @rtype: list
+        @return: list of filters
+        """
+        filters = [("domain", "!=", "None"), ("hypervisor", "not_online", None)]
+        if filter:
+            filters.insert(0, ("name", "like", "%%%s%%" % filter))
+        return filters
 
     def get_vms(self, iq, conn):
         """
-        List virtual machines in the park withing an interval
+        List virtual machines in the park withing an interval.
+        The archipel tag can contain:
+            - filter: only list the vms with a name containing it
+            - after_name and after_uuid: the name and uuid of the last vm of the previous page.
+              If set, the page starts right after it (keyset pagination) and page is ignored
+            - page: the number of the page, for clients not using after_name
+            - light: if "yes", the domain is not returned (use the get action to get it)
         """
-        vms_per_page = 30
-        page = iq.getQuery().getTagAttr('archipel', 'page')
+        archipel_tag = iq.getQuery().getTag('archipel')
+        page = archipel_tag.getAttr('page')
         if not page:
             page = 0
-        filter = iq.getQuery().getTagAttr('archipel', 'filter')
+        filter = archipel_tag.getAttr('filter')
+        after_name = archipel_tag.getAttr('after_name')
+        after_uuid = archipel_tag.getAttr('after_uuid') or ""
+        light = archipel_tag.getAttr('light') == "yes"
 
         def _on_centralagent_reply(vms):
             try:
@@ -158,9 +185,10 @@ class TNVMParking (TNArchipelPlugin):
                 for vm in vms:
                     try:
                         vm_node = xmpp.Node("virtualmachine", attrs={"uuid": vm["uuid"], "parker": vm["parker"], "date": vm["creation_date"], 'name':vm['name']})
-                        xmldef = xmpp.simplexml.NodeBuilder(vm["domain"]).getDom()
-                        xmldef.delChild("description")
-                        vm_node.addChild(node=xmldef)
+                        if not light:
+                            xmldef = xmpp.simplexml.NodeBuilder(vm["domain"]).getDom()
+                            xmldef.delChild("description")
+                            vm_node.addChild(node=xmldef)
                         nodes.append(vm_node)
                     except:
                         self.entity.log.warning("VMPARKING: Error parsing entry %s" % vm)
@@ -170,10 +198,60 @@ class TNVMParking (TNArchipelPlugin):
                 reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_VMPARK_LIST)
             self.entity.xmppclient.send(reply)
             raise xmpp.protocol.NodeProcessed
-        where_statement = "domain != 'None' and (hypervisor='None' or hypervisor not in (select jid from hypervisors where status='Online')) order by name limit %s offset %s" % (vms_per_page, vms_per_page * int(page))
-        if filter:
-            where_statement = "name like '%%%s%%' and %s" % (filter, where_statement)
-        self.entity.get_plugin("centraldb").read_vms("*", where_statement, _on_centralagent_reply)
+
+        columns = ARCHIPEL_VMPARK_LIST_COLUMNS if light else "*"
+        filters = self.get_parked_filters(filter)
+        order = [("name", "asc"), ("uuid", "asc")]
+        if after_name is not None:
+            filters.append(("name", "after", [after_name, after_uuid]))
+            self.entity.get_plugin("centraldb").read_vms(columns, None, _on_centralagent_reply, filters=filters, order=order, limit=ARCHIPEL_VMPARK_VMS_PER_PAGE)
+        else:
+            self.entity.get_plugin("centraldb").read_vms(columns, None, _on_centralagent_reply, filters=filters, order=order, limit=ARCHIPEL_VMPARK_VMS_PER_PAGE, offset=ARCHIPEL_VMPARK_VMS_PER_PAGE * int(page))
+
+    def count_vms(self, iq, conn):
+        """
+        Count the virtual machines in the park.
+        The archipel tag can contain a filter attribute, as for get_vms.
+        """
+        filter = iq.getQuery().getTagAttr('archipel', 'filter')
+
+        def _on_centralagent_reply(entries):
+            try:
+                reply = iq.buildReply("result")
+                count = 0
+                if entries:
+                    count = entries[0]["count"]
+                reply.setQueryPayload([xmpp.Node("count", attrs={"value": count})])
+            except Exception as ex:
+                reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_VMPARK_LIST)
+            self.entity.xmppclient.send(reply)
+            raise xmpp.protocol.NodeProcessed
+
+        self.entity.get_plugin("centraldb").count_vms(_on_centralagent_reply, filters=self.get_parked_filters(filter))
+
+    def get_vms_definitions(self, iq, conn):
+        """
+        Return the definition of the given parked virtual machines.
+        """
+        vms = [{"uuid": item.getAttr("uuid")} for item in iq.getTag("query").getTag("archipel").getTags("item")]
+
+        def _on_centralagent_reply(vms):
+            try:
+                reply = iq.buildReply("result")
+                nodes = []
+                for vm in vms:
+                    vm_node = xmpp.Node("virtualmachine", attrs={"uuid": vm["uuid"], "parker": vm["parker"], "date": vm["creation_date"], 'name':vm['name']})
+                    xmldef = xmpp.simplexml.NodeBuilder(vm["domain"]).getDom()
+                    xmldef.delChild("description")
+                    vm_node.addChild(node=xmldef)
+                    nodes.append(vm_node)
+                reply.setQueryPayload(nodes)
+            except Exception as ex:
+                reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_VMPARK_LIST)
+            self.entity.xmppclient.send(reply)
+            raise xmpp.protocol.NodeProcessed
+
+        self.get_vms_from_uuid(vms, _on_centralagent_reply)
 
     # Plugin information
 
@@ -358,6 +436,8 @@ class TNVMParking (TNArchipelPlugin):
         This method is invoked when a ARCHIPEL_NS_HYPERVISOR_VMPARKING IQ is received.
         It understands IQ of type:
             - list
+            - count
+            - get
             - park
             - create_parked
             - unpark
@@ -373,6 +453,10 @@ class TNVMParking (TNArchipelPlugin):
         self.entity.check_perm(conn, iq, action, -1, prefix="vmparking_")
         if action == "list":
             reply = self.iq_list(iq, conn)
+        if action == "count":
+            reply = self.iq_count(iq, conn)
+        if action == "get":
+            reply = self.iq_get(iq, conn)
         if action == "park":
             reply = self.iq_park(iq)
         if action == "unpark":
@@ -401,6 +485,34 @@ class TNVMParking (TNArchipelPlugin):
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_VMPARK_LIST)
         return reply
 
+    def iq_count(self, iq, conn):
+        """
+        Return the number of parked virtual machines
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready to send IQ containing the result of the action
+        """
+        try:
+            reply = self.count_vms(iq, conn)
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_VMPARK_LIST)
+        return reply
+
+    def iq_get(self, iq, conn):
+        """
+        Return the definition of parked virtual machines
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready to send IQ containing the result of the action
+        """
+        try:
+            reply = self.get_vms_definitions(iq, conn)
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_VMPARK_LIST)
+        return reply
+
     #FIXME THIS IS BROKEN
     def message_list(self, msg):
         """
@@ -285,12 +285,14 @@ class TNXMPPServerController (TNArchipelPlugin):
         @type args: dict
         @param args: optional kwards of the callback
         """
-        for vm in self.entity.read_vms('uuid', None):
-            entry = "%s@%s" % (vm.get('uuid'), self.xmpp_server)
-            self.entities_from_central_db['virtualmachines'].add(entry)
-
-        for hyp in self.entity.read_hypervisors("jid"):
-            self.entities_from_central_db['hypervisors'].add(hyp.get('jid').split('/')[0])
+        for vms in self.entity.read_chunks("vms", "uuid"):
+            for vm in vms:
+                entry = "%s@%s" % (vm.get('uuid'), self.xmpp_server)
+                self.entities_from_central_db['virtualmachines'].add(entry)
+
+        for hyps in self.entity.read_chunks("hypervisors", "jid"):
+            for hyp in hyps:
+                self.entities_from_central_db['hypervisors'].add(hyp.get('jid').split('/')[0])
 
         start_time = time.time()
 
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+# archipelDomainStatsSampler.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNDomainStatsSampler}, the hypervisor wide sampler of the
+domains CPU time.
+"""
+
+import array
+import libvirt
+import threading
+import time
+from threading import Thread
+
+
+ARCHIPEL_SAMPLER_DEFAULT_INTERVAL   = 2.0
+
+
+def get_all_domain_stats(libvirt_connection, stats=0, flags=0):
+    """
+    Return the stats of all the domains in one libvirt call. If libvirt is too
+    old to support virConnectGetAllDomainStats, fall back on info() for each
+    domain and return the same keys.
+    @type libvirt_connection: virConnect
+    @param libvirt_connection: the libvirt connection
+    @type stats: int
+    @param stats: the VIR_DOMAIN_STATS_* groups to get
+    @type flags: int
+    @param flags: the VIR_CONNECT_GET_ALL_DOMAINS_STATS_* flags
+    @rtype: list
+    @return: list of (uuid, dict of stats)
+    """
+    if hasattr(libvirt_connection, "getAllDomainStats"):
+        return [(dom.UUIDString(), record) for dom, record in libvirt_connection.getAllDomainStats(stats, flags)]
+    records = []
+    for dom in libvirt_connection.listAllDomains(0):
+        try:
+            info = dom.info()
+        except libvirt.libvirtError:
+            continue
+        records.append((dom.UUIDString(), {"state.state": info[0],
+                                          "balloon.maximum": info[1],
+                                          "balloon.current": info[2],
+                                          "vcpu.current": info[3],
+                                          "cpu.time": info[4]}))
+    return records
+
+
+class TNDomainStatsSampler (Thread):
+    """
+    Samples the CPU time of all the domains of the hypervisor with one
+    bulk libvirt call per interval, and computes their CPU usage.
+    Samples are stored in flat arrays indexed by a slot per domain.
+    """
+
+    def __init__(self, hypervisor, interval=ARCHIPEL_SAMPLER_DEFAULT_INTERVAL):
+        """
+        Initialize the TNDomainStatsSampler.
+        @type hypervisor: L{TNArchipelHypervisor}
+        @param hypervisor: the hypervisor owning the libvirt connection
+        @type interval: float
+        @param interval: the sampling interval in seconds
+        """
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.hypervisor     = hypervisor
+        self.interval       = interval
+        self.running        = False
+        self.slots          = {}
+        self.free_slots     = []
+        self.last_times     = array.array('d')
+        self.last_cputimes  = array.array('d')
+        self.cpu_usages     = array.array('d')
+        self.lock           = threading.Lock()
+
+    def _get_slot(self, uuid):
+        """
+        Return the slot of the domain, allocating it if needed.
+        @type uuid: string
+        @param uuid: the UUID of the domain
+        @rtype: int
+        @return: the slot index
+        """
+        if uuid in self.slots:
+            return self.slots[uuid]
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.last_times[slot] = 0.0
+            self.last_cputimes[slot] = 0.0
+            self.cpu_usages[slot] = 0.0
+        else:
+            slot = len(self.last_times)
+            self.last_times.append(0.0)
+            self.last_cputimes.append(0.0)
+            self.cpu_usages.append(0.0)
+        self.slots[uuid] = slot
+        return slot
+
+    def sample(self):
+        """
+        Take one sample of all the domains.
+        """
+        now = time.time()
+        records = get_all_domain_stats(self.hypervisor.libvirt_connection, getattr(libvirt, "VIR_DOMAIN_STATS_CPU_TOTAL", 0))
+        cores = self.hypervisor.nodeinfo['nrCoreperSocket']
+        seen = set()
+        with self.lock:
+            for uuid, record in records:
+                if not "cpu.time" in record:
+                    continue
+                seen.add(uuid)
+                slot = self._get_slot(uuid)
+                cputime = float(record["cpu.time"])
+                if self.last_times[slot]:
+                    usage = 100 * (cputime - self.last_cputimes[slot]) / ((now - self.last_times[slot]) * cores * 1000000000)
+                    self.cpu_usages[slot] = max(usage, 0.0)
+                self.last_times[slot] = now
+                self.last_cputimes[slot] = cputime
+            for uuid in [uuid for uuid in self.slots if not uuid in seen]:
+                self.free_slots.append(self.slots.pop(uuid))
+
+    def get_cpu_usage(self, uuid):
+        """
+        Return the CPU usage of the domain between the two last samples.
+        @type uuid: string
+        @param uuid: the UUID of the domain
+        @rtype: float
+        @return: the CPU usage in percent, 0 if unknown
+        """
+        with self.lock:
+            if not uuid in self.slots:
+                return 0
+            return self.cpu_usages[self.slots[uuid]]
+
+    def run(self):
+        """
+        Main loop of the sampler.
+        """
+        self.running = True
+        while self.running:
+            try:
+                self.sample()
+            except Exception as ex:
+                self.hypervisor.log.warning("SAMPLER: unable to sample domains cpu time: %s" % str(ex))
+            time.sleep(self.interval)
+
+    def stop(self):
+        """
+        Stop the sampler.
+        """
+        self.running = False
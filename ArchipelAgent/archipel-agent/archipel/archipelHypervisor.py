@@ -37,12 +37,16 @@ from threading import Thread
 from archipelcore.archipelAvatarControllableEntity import TNAvatarControllableEntity
 from archipelcore.archipelEntity import TNArchipelEntity
 from archipelcore.archipelHookableEntity import TNHookableEntity
+from archipelcore.archipelReactor import TNArchipelReactor
+from archipelcore.archipelStreamMultiplexer import TNXMPPStreamMultiplexer
 from archipelcore.archipelTaggableEntity import TNTaggableEntity
 from archipelcore.utils import build_error_iq, build_error_message
 from archipelcore import xmpp
 
+from archipelDomainStatsSampler import TNDomainStatsSampler, get_all_domain_stats
 from archipelLibvirtEntity import ARCHIPEL_NS_LIBVIRT_GENERIC_ERROR
 from archipelVirtualMachine import TNArchipelVirtualMachine
+from archipelVirtualMachinesStarter import TNVirtualMachinesStarter, ARCHIPEL_STARTER_DEFAULT_WORKERS, ARCHIPEL_STARTER_DEFAULT_RATE
 import archipelLibvirtEntity
 
 
@@ -61,6 +65,7 @@ ARCHIPEL_ERROR_CODE_HYPERVISOR_UNMANAGE         = -9011
 ARCHIPEL_ERROR_CODE_HYPERVISOR_MIGRATION_INFO   = -9012
 ARCHIPEL_ERROR_CODE_HYPERVISOR_SET_ORG_INFO     = -9013
 ARCHIPEL_ERROR_CODE_HYPERVISOR_NODE_INFO        = -9014
+ARCHIPEL_ERROR_CODE_HYPERVISOR_DOMAINS_STATS    = -9015
 
 ARCHIPEL_VM_NAME_CHECK_INTERNAL                 = 1
 ARCHIPEL_VM_NAME_CHECK_ALL                      = 2
@@ -139,6 +144,8 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         self.virtualmachines = {}
         self.database_file = database_file
         self.xmppserveraddr = self.jid.getDomain()
+        self.vm_xmpp_domain = self.xmppserveraddr
+        self.vm_stream_multiplexer = None
         self.entity_type = "hypervisor"
         self.default_avatar = self.configuration.get("HYPERVISOR", "hypervisor_default_avatar")
         self.libvirt_event_callback_id = None
@@ -146,6 +153,8 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         self.bad_chars_in_name = '(){}[]<>!@#$'
         self.check_for_central_agent = False
         self.already_wake_up = False
+        self.vm_startup_workers = ARCHIPEL_STARTER_DEFAULT_WORKERS
+        self.vm_startup_rate = ARCHIPEL_STARTER_DEFAULT_RATE
 
         try:
             central_db_configured = self.configuration.getboolean("MODULES", "centraldb")
@@ -185,8 +194,30 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         names_file.close()
         self.number_of_names = len(self.generated_names) - 1
 
+        if self.configuration.has_option("HYPERVISOR", "vm_startup_workers"):
+            self.vm_startup_workers = self.configuration.getint("HYPERVISOR", "vm_startup_workers")
+        if self.configuration.has_option("HYPERVISOR", "vm_startup_rate"):
+            self.vm_startup_rate = self.configuration.getfloat("HYPERVISOR", "vm_startup_rate")
+
         self.log.info("Server address defined as %s" % self.xmppserveraddr)
 
+        # shared reactor for the XMPP streams of all entities
+        if self.configuration.has_option("GLOBAL", "use_shared_xmpp_reactor") and self.configuration.getboolean("GLOBAL", "use_shared_xmpp_reactor"):
+            self.reactor = TNArchipelReactor(self.log)
+
+        # shared XMPP stream for virtual machines
+        if self.configuration.has_option("VIRTUALMACHINE", "xmpp_component"):
+            self.vm_xmpp_domain = self.configuration.get("VIRTUALMACHINE", "xmpp_component")
+            component_address = self.xmppserveraddr
+            if self.configuration.has_option("VIRTUALMACHINE", "xmpp_component_address"):
+                component_address = self.configuration.get("VIRTUALMACHINE", "xmpp_component_address")
+            debug_mode = self.configuration.has_option("LOGGING", "xmpppy_debug") and self.configuration.getboolean("LOGGING", "xmpppy_debug")
+            self.vm_stream_multiplexer = TNXMPPStreamMultiplexer(self.vm_xmpp_domain,
+                                                                 self.configuration.get("VIRTUALMACHINE", "xmpp_component_secret"),
+                                                                 component_address, self.log, debug=debug_mode)
+            self.vm_stream_multiplexer.start()
+            self.log.info("Virtual machines will share the XMPP stream of component %s" % self.vm_xmpp_domain)
+
         # hooks
         self.create_hook("HOOK_HYPERVISOR_ALLOC")
         self.create_hook("HOOK_HYPERVISOR_SOFT_ALLOC")
@@ -215,6 +246,10 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         self.capabilities = self.get_capabilities()
         self.nodeinfo = self.get_nodeinfo()
 
+        # cpu usage of all domains
+        self.cpu_sampler = TNDomainStatsSampler(self)
+        self.cpu_sampler.start()
+
         # action on auth
         self.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=self.manage_vcard_hook)
         if not self.get_plugin("centraldb"):
@@ -367,6 +402,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         self.permission_center.create_permission("migrationinfo", "Authorizes users to get the migration informations", False)
         self.permission_center.create_permission("capabilities", "Authorizes users to access the hypervisor capabilities", False)
         self.permission_center.create_permission("nodeinfo", "Authorizes users to access the hypervisor Node Information", False)
+        self.permission_center.create_permission("domainsstats", "Authorizes users to get the informations and statistics of all the virtual machines", False)
         self.permission_center.create_permission("manage", "Authorizes users make Archipel able to manage external virtual machines", False)
         self.permission_center.create_permission("unmanage", "Authorizes users to make Archipel able to unmanage virtual machines", False)
         self.permission_center.create_permission("setorginfo", "Authorizes users to change VM Organization information of virtual machines", False)
@@ -391,11 +427,15 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
     def manage_persistence(self, vms=[], existing_vms_entities=[]):
         """
         After getting the status of local vms from central db (were they exist
-        else where or not ?), we proceed to instanciate vms
+        else where or not ?), we proceed to instanciate vms. The entities are
+        built in parallel then started at a limited rate by a L{TNVirtualMachinesStarter}
         """
         if len(vms) > 0 or len(existing_vms_entities) > 0:
             self.update_presence(presence_msg="Initializing...")
 
+        starter = TNVirtualMachinesStarter(self, workers=self.vm_startup_workers, rate=self.vm_startup_rate)
+        vms_to_build = []
+
         self.database = sqlite3.connect(self.database_file, check_same_thread=False)
         c = self.database.cursor()
         existing_vms_entities_uuids = []
@@ -411,10 +451,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             if uuid not in existing_vms_entities_uuids:
                 self.log.info("Creating vm entity for %s" % string_jid)
                 jid.setResource(self.jid.getNode().lower())
-                vm_thread = self.create_threaded_vm(jid, vm["password"], vm["name"], self.vcard_infos)
-                self.virtualmachines[vm_thread.jid.getNode()] = vm_thread.get_instance()
-                vm_thread.start()
-                self.perform_hooks("HOOK_HYPERVISOR_VM_WOKE_UP", vm_thread.get_instance())
+                vms_to_build.append((jid, vm["password"], vm["name"]))
             else:
                 self.log.warning("Vm entity %s already exist on another hypervisor, removing from local db and local libvirt." % string_jid)
                 c.execute("delete from virtualmachines where jid='%s'" % string_jid)
@@ -430,8 +467,14 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
                         except libvirt.libvirtError:
                             self.log.warning("Libvirt gave error while trying to destroy the existing vm %s" % (vm))
 
+        for vm_thread in starter.build(vms_to_build):
+            self.virtualmachines[vm_thread.jid.getNode()] = vm_thread.get_instance()
+
         self.perform_hooks("HOOK_HYPERVISOR_WOKE_UP", self)
-        self.update_presence()
+        if vms_to_build:
+            starter.start()
+        else:
+            self.update_presence()
 
     def create_threaded_vm(self, jid, password, name, organizationInfo=None):
         """
@@ -612,6 +655,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             - uri
             - capabilities
             - nodeinfo
+            - domainsstats
             - manage
             - unmanage
             - setorginfo
@@ -646,6 +690,8 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             reply = self.iq_capabilities(iq)
         elif action == "nodeinfo":
             reply = self.iq_nodeinfo(iq)
+        elif action == "domainsstats":
+            reply = self.iq_domains_stats(iq)
         elif action == "manage":
             reply = self.iq_manage(iq)
         elif action == "unmanage":
@@ -688,7 +734,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             vm_uuid = str(moduuid.uuid1())
 
         vm_password = ''.join([random.choice(string.letters + string.digits) for i in range(self.configuration.getint("VIRTUALMACHINE", "xmpp_password_size"))])
-        vm_jid = xmpp.JID(node=vm_uuid.lower(), domain=self.xmppserveraddr.lower(), resource=self.jid.getNode().lower())
+        vm_jid = xmpp.JID(node=vm_uuid.lower(), domain=self.vm_xmpp_domain.lower(), resource=self.jid.getNode().lower())
 
         is_xen = self.local_libvirt_uri.upper().startswith(archipelLibvirtEntity.ARCHIPEL_HYPERVISOR_TYPE_XEN)
         blank_spaces_disallowed_in_config = self.configuration.has_option("VIRTUALMACHINE", "allow_blank_space_in_vm_name") \
@@ -891,6 +937,65 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             "nrCoreperSocket": nodeinfo[6],
             "nrThreadperCore": nodeinfo[7]}
 
+    def domains_stats(self, block=False, network=False):
+        """
+        Return the informations of all the managed domains, using a
+        single libvirt request.
+        @type block: bool
+        @param block: if True, also return the block devices counters
+        @type network: bool
+        @param network: if True, also return the network interfaces counters
+        @rtype: list
+        @return: list of dict containing the info of each domain, and the
+        list of its block and interface counters
+        """
+        groups = ["STATE", "BALLOON", "VCPU"]
+        if block:
+            groups.append("BLOCK")
+        if network:
+            groups.append("INTERFACE")
+        # constants are missing from bindings too old to have getAllDomainStats
+        stats = 0
+        for group in groups:
+            stats |= getattr(libvirt, "VIR_DOMAIN_STATS_%s" % group, 0)
+
+        domains = []
+        for uuid, record in get_all_domain_stats(self.libvirt_connection, stats):
+            if not uuid in self.virtualmachines:
+                continue
+            vm = self.virtualmachines[uuid]
+            delta_memory = 0
+            if vm.definition and vm.definition.getAttr("type") == "xen" and vm.definition.getTag("os").getTag("type").getData() == "hvm":
+                delta_memory = 4096
+            info = {"uuid": uuid,
+                    "jid": vm.jid,
+                    "state": record.get("state.state", 0),
+                    "maxMem": record.get("balloon.maximum", 0) - delta_memory,
+                    "memory": record.get("balloon.current", 0) - delta_memory,
+                    "nrVirtCpu": record.get("vcpu.current", 0),
+                    "cpuPrct": self.cpu_sampler.get_cpu_usage(uuid)}
+            devices = []
+            if block:
+                for i in range(record.get("block.count", 0)):
+                    devices.append(("block", {"name": record.get("block.%d.name" % i, ""),
+                                              "rd_req": record.get("block.%d.rd.reqs" % i, 0),
+                                              "rd_bytes": record.get("block.%d.rd.bytes" % i, 0),
+                                              "wr_req": record.get("block.%d.wr.reqs" % i, 0),
+                                              "wr_bytes": record.get("block.%d.wr.bytes" % i, 0)}))
+            if network:
+                for i in range(record.get("net.count", 0)):
+                    devices.append(("network", {"name": record.get("net.%d.name" % i, ""),
+                                                "rx_bytes": record.get("net.%d.rx.bytes" % i, 0),
+                                                "rx_packets": record.get("net.%d.rx.pkts" % i, 0),
+                                                "rx_errs": record.get("net.%d.rx.errs" % i, 0),
+                                                "rx_drop": record.get("net.%d.rx.drop" % i, 0),
+                                                "tx_bytes": record.get("net.%d.tx.bytes" % i, 0),
+                                                "tx_packets": record.get("net.%d.tx.pkts" % i, 0),
+                                                "tx_errs": record.get("net.%d.tx.errs" % i, 0),
+                                                "tx_drop": record.get("net.%d.tx.drop" % i, 0)}))
+            domains.append((info, devices))
+        return domains
+
     def migration_info(self):
         """
         Return the migration information
@@ -1239,6 +1344,34 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         except Exception as ex:
             return build_error_message(self, ex, msg)
 
+    def iq_domains_stats(self, iq):
+        """
+        Send the informations and statistics of all the managed virtual machines.
+        The query's archipel tag can contain the attributes block="yes" and
+        network="yes" to get the block devices and network interfaces counters.
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the sender request IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready-to-send IQ containing the results
+        """
+        try:
+            reply = iq.buildReply("result")
+            archipel_tag = iq.getTag("query").getTag("archipel")
+            block = archipel_tag.getAttr("block") in ("yes", "true", "1")
+            network = archipel_tag.getAttr("network") in ("yes", "true", "1")
+            nodes = []
+            for info, devices in self.domains_stats(block=block, network=network):
+                n = xmpp.Node("domain", attrs=info)
+                for tag, counters in devices:
+                    n.addChild(node=xmpp.Node(tag, attrs=counters))
+                nodes.append(n)
+            reply.setQueryPayload(nodes)
+        except libvirt.libvirtError as ex:
+            reply = build_error_iq(self, ex, iq, ex.get_error_code(), ns=ARCHIPEL_NS_LIBVIRT_GENERIC_ERROR)
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HYPERVISOR_DOMAINS_STATS)
+        return reply
+
     def iq_manage(self, iq):
         """
         Manage an existing libvirt virtual machine
@@ -1347,6 +1480,15 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HYPERVISOR_SET_ORG_INFO)
         return reply
 
+    def loop(self):
+        """
+        Overrides the main loop. When the shared reactor is used, the calling
+        thread runs it for the hypervisor and all the virtual machines.
+        """
+        TNArchipelEntity.loop(self)
+        if self.reactor:
+            self.reactor.run()
+
     def on_xmpp_loop_tick(self):
         self.check_libvirt_connection()
         if self.check_for_central_agent:
@@ -1383,4 +1525,12 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             except Exception as ex:
                 self.log.error("CENTRALDB: error when executing exit proc: %s" % ex)
 
+        if self.vm_stream_multiplexer:
+            self.vm_stream_multiplexer.stop()
+
+        if self.reactor:
+            self.reactor.stop()
+
+        self.cpu_sampler.stop()
+
         self.disconnect()
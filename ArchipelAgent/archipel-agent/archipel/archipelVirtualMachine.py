@@ -48,6 +48,7 @@ from StringIO import StringIO
 from archipelcore.archipelAvatarControllableEntity import TNAvatarControllableEntity
 from archipelcore.archipelEntity import TNArchipelEntity
 from archipelcore.archipelHookableEntity import TNHookableEntity
+from archipelcore.archipelPermissionCenter import TNArchipelScopedPermissionCenter, get_shared_permission_store
 from archipelcore.archipelRosterQueryableEntity import TNRosterQueryableEntity
 from archipelcore.archipelTaggableEntity import TNTaggableEntity
 from archipelcore.utils import build_error_iq, build_error_message
@@ -107,6 +108,9 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         TNArchipelEntity.__init__(self, jid, password, configuration, name)
 
         self.hypervisor = hypervisor
+        if hypervisor.vm_stream_multiplexer and hypervisor.vm_stream_multiplexer.handles(self.jid):
+            self.stream_multiplexer = hypervisor.vm_stream_multiplexer
+        self.reactor = hypervisor.reactor
         self.libvirt_status = libvirt.VIR_DOMAIN_SHUTDOWN
         self.domain = None
         self.definition = None
@@ -123,9 +127,6 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         self.is_freeing = False
         self.inhibit_undefine_domain_event_counter = 0
         self.inhibit_define_domain_event_counter   = 0
-        self.cputime_samples = []
-        self.cputime_sampling_Interval = 2.0
-        self.cputime_sampling_timer(self.cputime_sampling_Interval)
 
         if self.configuration.has_option("VIRTUALMACHINE", "vm_perm_path"):
             self.vm_perm_base_path = self.configuration.get("VIRTUALMACHINE", "vm_perm_path")
@@ -138,9 +139,13 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
             os.makedirs(self.folder)
         if not os.path.isdir(self.permfolder):
             os.makedirs(self.permfolder)
+        self.multiplexed_roster_path = "%s/roster.json" % self.permfolder
 
         # start the permission center
         self.permission_db_file = "%s/%s" % (self.permfolder, self.configuration.get("VIRTUALMACHINE", "vm_permissions_database_path"))
+        if self.configuration.has_option("VIRTUALMACHINE", "vm_shared_permissions_database_path"):
+            store = get_shared_permission_store(self.configuration.get("VIRTUALMACHINE", "vm_shared_permissions_database_path"))
+            self.permission_center = TNArchipelScopedPermissionCenter(store, str(self.jid.getStripped()), root_admins=self.permission_admin_names)
         self.permission_center.start(database_file=self.permission_db_file)
         self.init_permissions()
 
@@ -760,38 +765,14 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
             return (data, size)
         return (None, (0, 0))
 
-    def cputime_sampling_timer(self, interval):
-        """
-        Create a threaded timer to take timestamp,cputime samples from actual domain
-        """
-        if self.domain and not self.is_freeing and not self.is_migrating:
-            try:
-                self.cputime_samples.insert(0, (time.time(), self.domain.info()[4]))
-                if len(self.cputime_samples) > 2:
-                    self.cputime_samples.pop()
-            except Exception as ex:
-                # @TODO: I'm sure there is a better way to do this.
-                # First, this thing should be only running when the VM is running
-                # instead of trying for nothing is the VM is not defined and running.
-                self.log.warning("It seems the VM is gone, certainly due to migration. Stopping cpu usage collector. (reason %s)" % ex)
-                return
-
-        if not self.is_migrating:
-            Timer(interval, self.cputime_sampling_timer, [interval]).start()
-
     def compute_cpu_usage(self):
         """
-        Return the vm CPU usage in percent between two samples
+        Return the vm CPU usage in percent between the two last samples
+        of the hypervisor cpu sampler
         """
-        try:
-            prtCPU = 100 * (self.cputime_samples[0][1] - self.cputime_samples[1][1]) / ((self.cputime_samples[0][0] - self.cputime_samples[1][0]) * self.hypervisor.get_nodeinfo()['nrCoreperSocket'] * 1000000000)
-        except:
-            prtCPU = 0
-
-        if prtCPU > 0:
-            return prtCPU
-        else:
+        if not self.domain or self.is_freeing or self.is_migrating:
             return 0
+        return self.hypervisor.cpu_sampler.get_cpu_usage(self.uuid)
 
     def info(self):
         """
@@ -1194,9 +1175,15 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         @param clean_files: if True, remove the permission file and folder
         """
         self.perform_hooks("HOOK_VM_TERMINATE")
+        if isinstance(self.permission_center, TNArchipelScopedPermissionCenter):
+            if not clean_files:
+                # let the next hypervisor import our permissions
+                self.permission_center.export_database(self.permission_db_file)
+            self.permission_center.drop_scope()
         self.permission_center.close_database()
         if clean_files:
-            os.unlink(self.permission_db_file)
+            if os.path.exists(self.permission_db_file):
+                os.unlink(self.permission_db_file)
             self.remove_folder()
 
     # XMPP Controls
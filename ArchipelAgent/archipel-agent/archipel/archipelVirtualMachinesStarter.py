@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# archipelVirtualMachinesStarter.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNVirtualMachinesStarter}, the pipeline used by the hypervisor
+to wake up its virtual machines when it starts.
+"""
+
+import Queue
+import threading
+import time
+from threading import Thread
+
+
+ARCHIPEL_STARTER_DEFAULT_WORKERS        = 4
+ARCHIPEL_STARTER_DEFAULT_RATE           = 20.0
+ARCHIPEL_STARTER_ONLINE_TIMEOUT         = 300.0
+ARCHIPEL_STARTER_PRESENCE_INTERVAL      = 2.0
+
+
+class TNVirtualMachinesStarter (Thread):
+    """
+    Wakes up the virtual machines of the hypervisor in two stages:
+        - the entities are built in parallel by a bounded number of workers
+        - their threads are started, and so connect to the XMPP server, at a
+          limited rate
+    The progress is reported in the hypervisor presence, and the time needed
+    to get all the virtual machines online is logged.
+    """
+
+    def __init__(self, hypervisor, workers=ARCHIPEL_STARTER_DEFAULT_WORKERS, rate=ARCHIPEL_STARTER_DEFAULT_RATE):
+        """
+        Initialize the TNVirtualMachinesStarter.
+        @type hypervisor: L{TNArchipelHypervisor}
+        @param hypervisor: the hypervisor owning the virtual machines
+        @type workers: int
+        @param workers: the number of entities built at the same time
+        @type rate: float
+        @param rate: the number of XMPP connections started per second, 0 for no limit
+        """
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.hypervisor     = hypervisor
+        self.workers        = max(1, workers)
+        self.rate           = rate
+        self.vm_threads     = []
+        self.start_time     = time.time()
+        self.online_count   = 0
+        self.online_lock    = threading.Lock()
+        self.all_online     = threading.Event()
+
+    ### Stage 1: build
+
+    def _build_worker(self, jobs):
+        """
+        Build the virtual machines entities until there is no more job.
+        @type jobs: Queue.Queue
+        @param jobs: the queue of (jid, password, name) to build
+        """
+        while True:
+            try:
+                jid, password, name = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                vm_thread = self.hypervisor.create_threaded_vm(jid, password, name, self.hypervisor.vcard_infos)
+                vm_thread.get_instance().register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=self.on_vm_online, oneshot=True)
+                with self.online_lock:
+                    self.vm_threads.append(vm_thread)
+            except Exception as ex:
+                self.hypervisor.log.error("STARTER: unable to create the virtual machine entity %s: %s" % (jid, str(ex)))
+
+    def build(self, vms):
+        """
+        Build the given virtual machines entities, and wait for all of them.
+        @type vms: list
+        @param vms: list of (jid, password, name)
+        @rtype: list
+        @return: list of the L{TNThreadedVirtualMachine} built, not yet started
+        """
+        if not vms:
+            return self.vm_threads
+        jobs = Queue.Queue()
+        for vm in vms:
+            jobs.put(vm)
+        workers = [Thread(target=self._build_worker, args=(jobs,)) for i in range(min(self.workers, len(vms)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.hypervisor.log.info("STARTER: %d virtual machines entities built in %.2fs" % (len(self.vm_threads), time.time() - self.start_time))
+        return self.vm_threads
+
+    ### Stage 2: admission
+
+    def on_vm_online(self, origin=None, user_info=None, parameters=None):
+        """
+        Hook called when a virtual machine is authenticated.
+        @type origin: L{TNArchipelVirtualMachine}
+        @param origin: the virtual machine
+        @type user_info: object
+        @param user_info: random user info
+        @type parameters: object
+        @param parameters: runtime arguments
+        """
+        with self.online_lock:
+            self.online_count += 1
+            if self.online_count >= len(self.vm_threads):
+                self.all_online.set()
+
+    def report_progress(self, started):
+        """
+        Update the hypervisor presence with the progress.
+        @type started: int
+        @param started: the number of virtual machines started
+        """
+        total = len(self.vm_threads)
+        self.hypervisor.update_presence(presence_msg="Starting %d/%d, online %d/%d" % (started, total, self.online_count, total))
+
+    def run(self):
+        """
+        Start the virtual machines threads at the configured rate.
+        """
+        total = len(self.vm_threads)
+        last_report = 0
+        for started, vm_thread in enumerate(self.vm_threads, 1):
+            vm_thread.start()
+            self.hypervisor.perform_hooks("HOOK_HYPERVISOR_VM_WOKE_UP", vm_thread.get_instance())
+            if time.time() - last_report >= ARCHIPEL_STARTER_PRESENCE_INTERVAL:
+                self.report_progress(started)
+                last_report = time.time()
+            if self.rate > 0:
+                time.sleep(1.0 / self.rate)
+        self.hypervisor.log.info("STARTER: %d virtual machines started in %.2fs" % (total, time.time() - self.start_time))
+
+        deadline = time.time() + ARCHIPEL_STARTER_ONLINE_TIMEOUT
+        while not self.all_online.is_set() and time.time() < deadline:
+            self.report_progress(total)
+            self.all_online.wait(ARCHIPEL_STARTER_PRESENCE_INTERVAL)
+
+        if self.all_online.is_set():
+            self.hypervisor.log.info("STARTER: all %d virtual machines online in %.2fs" % (total, time.time() - self.start_time))
+        else:
+            self.hypervisor.log.warning("STARTER: only %d/%d virtual machines online after %.2fs" % (self.online_count, total, time.time() - self.start_time))
+        self.hypervisor.update_presence()
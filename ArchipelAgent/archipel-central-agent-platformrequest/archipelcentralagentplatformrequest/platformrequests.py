@@ -20,12 +20,15 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import threading
+import time
 from pkg_resources import iter_entry_points
 
 from archipelcore.archipelPlugin import TNArchipelPlugin
 from archipelcore.utils import build_error_iq
 from archipelcore import xmpp
 
+from reservations import TNPlacementReservations, ARCHIPEL_PLACEMENT_RESERVATION_TIMEOUT
 from scorecomputing import TNBasicPlatformScoreComputing
 
 
@@ -46,6 +49,12 @@ class TNPlatformRequests (TNArchipelPlugin):
         """
         TNArchipelPlugin.__init__(self, configuration=configuration, entity=entity, entry_point_group=entry_point_group)
         self.computing_unit = None
+        reservation_timeout = ARCHIPEL_PLACEMENT_RESERVATION_TIMEOUT
+        if self.configuration.has_option("PLATFORMREQUEST", "placement_reservation_timeout"):
+            reservation_timeout = self.configuration.getfloat("PLATFORMREQUEST", "placement_reservation_timeout")
+        self.reservations = TNPlacementReservations(reservation_timeout)
+        # placements are computed and reserved one batch at a time
+        self.placement_lock = threading.Lock()
         # get computing unit plugin if present
         self.load_computing_unit()
 
@@ -97,6 +106,7 @@ class TNPlatformRequests (TNArchipelPlugin):
         if not self.computing_unit:
             self.computing_unit = TNBasicPlatformScoreComputing()
             self.entity.log.warning("PLATFORMREQ: using dummy computing unit. It returns random values !")
+        self.computing_unit.initialize(self.entity, self.configuration)
 
 
     ### XMPP Management
@@ -106,6 +116,8 @@ class TNPlatformRequests (TNArchipelPlugin):
         This method is invoked when a ARCHIPEL_NS_PLATFORM IQ is received.
         It understands IQ of type:
             - request
+            - place
+            - release
         @type conn: xmpp.Dispatcher
         @param conn: ths instance of the current connection that send the stanza
         @type iq: xmpp.Protocol.Iq
@@ -115,6 +127,10 @@ class TNPlatformRequests (TNArchipelPlugin):
         action = self.entity.check_acp(conn, iq)
         if action == "request":
             reply = self.iq_request(iq)
+        elif action == "place":
+            reply = self.iq_place(iq)
+        elif action == "release":
+            reply = self.iq_release(iq)
         if reply:
             conn.send(reply)
             raise xmpp.protocol.NodeProcessed
@@ -137,3 +153,51 @@ class TNPlatformRequests (TNArchipelPlugin):
         except Exception as ex:
             reply = build_error_iq(self, ex, iq)
         return reply
+
+    def iq_place(self, iq):
+        """
+        Process a batch placement request. The demands of the vms are given
+        as <vm id memory vcpus/> nodes, the memory being in the unit of the
+        free memory statistics of the hypervisors. The resources of the placed
+        vms are reserved until the reservation is released or expires.
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready to send IQ containing the result of the action
+        """
+        try:
+            reply = iq.buildReply("result")
+            demands = []
+            for vm in iq.getTag("query").getTag("archipel").getTags("vm"):
+                demands.append({"id": vm.getAttr("id"),
+                                "memory": float(vm.getAttr("memory") or 0),
+                                "vcpus": int(vm.getAttr("vcpus") or 1)})
+            with self.placement_lock:
+                now = time.time()
+                placements = self.computing_unit.place(self.entity.database, demands, self.reservations.reserved(now))
+                reserved = [(placement["hypervisor"], demand) for placement, demand in zip(placements, demands) if placement["hypervisor"]]
+                token = self.reservations.reserve(reserved, now)
+            self.entity.log.info("PLATFORMREQ: placed %d of %d vms, reservation %s" % (len(reserved), len(demands), token))
+            reply.addChild("reservation", attrs={"token": token, "timeout": self.reservations.timeout})
+            for placement in placements:
+                reply.addChild("vm", attrs={"id": placement["id"], "hypervisor": placement["hypervisor"] or ""})
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq)
+        return reply
+
+    def iq_release(self, iq):
+        """
+        Release the reservation of a batch placement.
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready to send IQ containing the result of the action
+        """
+        try:
+            reply = iq.buildReply("result")
+            token = iq.getTag("query").getTag("archipel").getAttr("token")
+            if not self.reservations.release(token):
+                self.entity.log.debug("PLATFORMREQ: reservation %s is unknown or expired" % token)
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq)
+        return reply
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# reservations.py
+#
+# Copyright (C) 2013 Nicolas Ochem <nicolas.ochem@free.fr>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNPlacementReservations}, the tentative reservations of the
+batch placements, which are substracted from the capacity of the hypervisors
+until the vms are deployed and appear in their statistics.
+"""
+
+import threading
+from uuid import uuid4
+
+
+ARCHIPEL_PLACEMENT_RESERVATION_TIMEOUT  = 120
+
+
+class TNPlacementReservations (object):
+    """
+    Keeps the resources reserved on each hypervisor by the batch placements.
+    A reservation is released by its owner once the vms are deployed, or
+    expires after a timeout.
+    """
+
+    def __init__(self, timeout=ARCHIPEL_PLACEMENT_RESERVATION_TIMEOUT):
+        """
+        Initialize the TNPlacementReservations.
+        @type timeout: float
+        @param timeout: the number of seconds after which a reservation expires
+        """
+        self.timeout        = timeout
+        self.reservations   = {}
+        self.lock           = threading.Lock()
+
+    def _expire(self, now):
+        """
+        Drop the expired reservations. Must be called with the lock.
+        @type now: float
+        @param now: the current timestamp
+        """
+        for token, (deadline, placements) in self.reservations.items():
+            if deadline < now:
+                del self.reservations[token]
+
+    def reserve(self, placements, now):
+        """
+        Reserve the resources of placed vms.
+        @type placements: list
+        @param placements: list of (hypervisor JID, demand), the demand being a dict with "memory" and "vcpus"
+        @type now: float
+        @param now: the current timestamp
+        @rtype: string
+        @return: the token of the reservation
+        """
+        token = str(uuid4())
+        with self.lock:
+            self._expire(now)
+            self.reservations[token] = (now + self.timeout, placements)
+        return token
+
+    def release(self, token):
+        """
+        Release a reservation.
+        @type token: string
+        @param token: the token of the reservation
+        @rtype: bool
+        @return: True if the reservation existed
+        """
+        with self.lock:
+            return self.reservations.pop(token, None) is not None
+
+    def reserved(self, now):
+        """
+        Return the resources reserved on each hypervisor.
+        @type now: float
+        @param now: the current timestamp
+        @rtype: dict
+        @return: dict of {"memory", "vcpus", "vms"} by hypervisor JID
+        """
+        reserved = {}
+        with self.lock:
+            self._expire(now)
+            for deadline, placements in self.reservations.values():
+                for jid, demand in placements:
+                    resources = reserved.setdefault(jid, {"memory": 0.0, "vcpus": 0, "vms": 0})
+                    resources["memory"] += demand["memory"]
+                    resources["vcpus"] += demand["vcpus"]
+                    resources["vms"] += 1
+        return reserved
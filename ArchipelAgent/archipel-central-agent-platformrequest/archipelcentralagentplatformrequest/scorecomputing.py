@@ -36,7 +36,20 @@ class TNBasicPlatformScoreComputing (object):
         # required_stats to be written to central db regularly for score computing
         # should be in the form i.e. [ { "major": "(memory|cpu|load)", "minor": "free" } ]
         required_stats = []
-        pass
+        # the latest statistics of the hypervisors, kept in memory by the central agent
+        # (L{TNHypervisorStatsBuffer}), set when the computing unit is loaded
+        self.stats_buffer = None
+
+    def initialize(self, entity, configuration):
+        """
+        Called once the computing unit is loaded by the central agent.
+        Put the initialization needing the central agent here.
+        @type entity: L{TNArchipelCentralAgent}
+        @param entity: the central agent
+        @type configuration: Configuration object
+        @param configuration: the configuration
+        """
+        self.stats_buffer = getattr(entity, "stats_buffer", None)
 
     ## Plugin
 
@@ -64,6 +77,8 @@ class TNBasicPlatformScoreComputing (object):
         you got to perform the action. If you want to decline
         the performing of the action, return 0.0 or None. the max score
         you can return is 1.0 (so basically see it as a percentage).
+        @type database: L{TNDBController}
+        @param database: the central database, queried with read()
         @type limit: float
         @param limit: max numbers of hypervisors to suggest
         @rtype: list
@@ -72,7 +87,22 @@ class TNBasicPlatformScoreComputing (object):
         ## awesome computing goes here
         import random
         hyp_list = []
-        rows = database.execute("select jid from hypervisors where status='Online' limit %s" % limit)
+        rows = database.read("select jid from hypervisors where status='Online' limit %s" % limit)
         for row in rows:
             hyp_list.append({"jid":row[0], "score": random.random()}) # yeah! that's a big computing
         return hyp_list
+
+    def place(self, database, demands, reserved):
+        """
+        Assign a batch of vms to the hypervisors. Override this to support
+        the batch placements.
+        @type database: L{TNDBController}
+        @param database: the central database, queried with read()
+        @type demands: list
+        @param demands: list of {"id", "memory", "vcpus"}, the resources needed by each vm
+        @type reserved: dict
+        @param reserved: the {"memory", "vcpus", "vms"} already reserved on each hypervisor by the previous placements
+        @rtype: list
+        @return: list of {"id", "hypervisor"} in the order of the demands, the hypervisor being None if the vm cannot be placed
+        """
+        raise Exception("The computing unit does not support batch placements")
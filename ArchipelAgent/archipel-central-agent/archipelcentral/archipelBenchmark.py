@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+#
+# archipelBenchmark.py
+#
+# Copyright (C) 2013 Nicolas Ochem <nicolas.ochem@free.fr>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNCentralAgentBenchmark}, the load simulation of the central
+agent used by archipel-central-agent-benchmark.
+
+The central agent is not connected to any XMPP server: its connection and
+its keepalive pubsub are replaced by L{TNBenchmarkConnection} and
+L{TNBenchmarkPubSub}, and the synthetic IQs of the hypervisors are given
+directly to process_iq_for_centralagent. The database is a real sqlite
+file, so the numbers include the database controller.
+"""
+
+import datetime
+import os
+import random
+import time
+from uuid import uuid4
+
+from archipelcore.entriesencoding import ARCHIPEL_ENTRIES_ENCODINGS, pack_compact_entries
+from archipelcore import xmpp
+
+from archipelCentralAgent import ARCHIPEL_NS_CENTRALAGENT
+
+try:
+    from archipelcentralagentplatformrequest.platformrequests import ARCHIPEL_NS_PLATFORM
+except ImportError:
+    ARCHIPEL_NS_PLATFORM = None
+
+
+ARCHIPEL_BENCHMARK_DOMAIN = """<domain type="kvm"><name>%(name)s</name><uuid>%(uuid)s</uuid><memory>%(memory)d</memory><vcpu>%(vcpus)d</vcpu>\
+<description>%(name)s@benchmark.archipel::::benchmark</description><os><type arch="x86_64" machine="pc">hvm</type></os></domain>"""
+
+
+class TNBenchmarkConnection (object):
+    """
+    The XMPP connection of the benchmarked central agent. It keeps the last
+    stanza sent and counts the stanzas, nothing leaves the process.
+    """
+
+    def __init__(self):
+        """
+        Initialize the TNBenchmarkConnection.
+        """
+        self.sent       = 0
+        self.last_sent  = None
+
+    def send(self, stanza):
+        """
+        Record a sent stanza.
+        @type stanza: xmpp.Node
+        @param stanza: the stanza
+        """
+        self.sent += 1
+        self.last_sent = stanza
+
+    def SendAndCallForResponse(self, stanza, func=None, args=None):
+        """
+        Record a sent stanza. No response will ever come.
+        """
+        self.send(stanza)
+
+    def RegisterHandler(self, *args, **kwargs):
+        pass
+
+    def UnregisterHandler(self, *args, **kwargs):
+        pass
+
+    def isConnected(self):
+        return False
+
+
+class TNBenchmarkPubSub (object):
+    """
+    The keepalive pubsub of the benchmarked central agent.
+    """
+
+    def __init__(self):
+        """
+        Initialize the TNBenchmarkPubSub.
+        """
+        self.items = 0
+
+    def add_item(self, item, callback=None):
+        """
+        Record a published item.
+        @type item: xmpp.Node
+        @param item: the item
+        """
+        self.items += 1
+
+
+class TNCentralAgentBenchmark (object):
+    """
+    Drives a central agent with the synthetic traffic of a cluster, phase
+    by phase, and measures the latency of each operation. The writes are
+    asynchronous, so each phase waits for the database to be idle before
+    it ends, and its throughput includes the writes.
+    """
+
+    def __init__(self, agent, hypervisors=2000, vms=50000, rounds=3, batch_size=100, compact=True, queries=200):
+        """
+        Initialize the TNCentralAgentBenchmark.
+        @type agent: L{TNArchipelCentralAgent}
+        @param agent: the central agent, not connected
+        @type hypervisors: int
+        @param hypervisors: the number of simulated hypervisors
+        @type vms: int
+        @param vms: the number of simulated vms
+        @type rounds: int
+        @param rounds: the number of statistics updates sent by each hypervisor
+        @type batch_size: int
+        @param batch_size: the number of entries per registration request
+        @type compact: bool
+        @param compact: if True, the entries are sent in compact encoding
+        @type queries: int
+        @param queries: the number of requests of the read and scoring phases
+        """
+        self.agent          = agent
+        self.hypervisors    = ["hypervisor-%d@benchmark.archipel/archipel" % i for i in range(hypervisors)]
+        self.vms            = vms
+        self.rounds         = rounds
+        self.batch_size     = batch_size
+        self.compact        = compact
+        self.queries        = queries
+        self.connection     = TNBenchmarkConnection()
+        self.pubsub         = TNBenchmarkPubSub()
+        self.results        = []
+
+    ### Setup
+
+    def setup(self):
+        """
+        Plug the fake connection and pubsub, and make the agent the active central agent.
+        """
+        self.agent.xmppclient               = self.connection
+        self.agent.central_keepalive_pubsub = self.pubsub
+        self.agent.xmpp_authenticated       = True
+        self.agent.central_agent_mode       = "force"
+        self.agent.ping_hypervisors         = True
+        self.agent.become_central_agent()
+        self.wait_database()
+
+    def wait_database(self):
+        """
+        Wait for the pending writes. The request goes through the writer
+        queue, after all the writes queued before it.
+        """
+        list(self.agent.database.request("select 1"))
+
+    ### Synthetic traffic
+
+    def build_iq(self, action, entries=None, attrs=None, event_attrs=None, queryNS=ARCHIPEL_NS_CENTRALAGENT, sender=None):
+        """
+        Build a request of a hypervisor.
+        @type action: string
+        @param action: the action
+        @type entries: list
+        @param entries: the entries of the event, if any
+        @type attrs: dict
+        @param attrs: the additional attributes of the archipel node
+        @type event_attrs: dict
+        @param event_attrs: the attributes of the event node, None for no event
+        @type queryNS: string
+        @param queryNS: the namespace of the query
+        @type sender: string
+        @param sender: the JID of the sender, the first hypervisor by default
+        @rtype: xmpp.Iq
+        @return: the request
+        """
+        sender = sender or self.hypervisors[0]
+        iq = xmpp.Iq(typ="set", queryNS=queryNS, to=self.agent.jid, frm=sender)
+        archipel_attrs = {"action": action}
+        if self.compact:
+            archipel_attrs["encodings"] = ",".join(ARCHIPEL_ENTRIES_ENCODINGS)
+        archipel_attrs.update(attrs or {})
+        archipel = iq.getTag("query").addChild(name="archipel", attrs=archipel_attrs)
+        if entries is not None or event_attrs is not None:
+            event = xmpp.Node(tag="event", attrs=dict({"jid": sender}, **(event_attrs or {})))
+            if entries and self.compact:
+                event.addChild(node=pack_compact_entries(entries))
+            for entry in (entries if not self.compact else []) or []:
+                entry_node = xmpp.Node(tag="entry")
+                for key, value in entry.iteritems():
+                    entry_node.addChild("item", attrs={"key": key, "value": value})
+                event.addChild(node=entry_node)
+            archipel.addChild(node=event)
+        return iq
+
+    def dispatch(self, iq, handler=None):
+        """
+        Give a request to the central agent.
+        @type iq: xmpp.Iq
+        @param iq: the request
+        @type handler: function
+        @param handler: the IQ handler, process_iq_for_centralagent by default
+        @rtype: xmpp.Iq
+        @return: the reply
+        """
+        self.connection.last_sent = None
+        try:
+            (handler or self.agent.process_iq_for_centralagent)(self.connection, iq)
+        except xmpp.protocol.NodeProcessed:
+            pass
+        reply = self.connection.last_sent
+        if reply is None or reply.getType() == "error":
+            raise Exception("the request %s failed" % iq.getTag("query").getTag("archipel").getAttr("action"))
+        return reply
+
+    def keepalive_message(self):
+        """
+        Build the pubsub message of a keepalive of the central agent.
+        @rtype: xmpp.Node
+        @return: the message
+        """
+        keepalive = xmpp.Node("event", attrs={"type": "keepalive", "jid": self.agent.jid, "keepalive_interval": self.agent.keepalive_interval})
+        message = xmpp.Node("message")
+        message.addChild("event").addChild("items").addChild("item").addChild(node=keepalive)
+        return message
+
+    ### Measurement
+
+    def measure(self, name, operations):
+        """
+        Run and time operations.
+        @type name: string
+        @param name: the name of the phase
+        @type operations: iterable
+        @param operations: the operations, functions without argument
+        @rtype: dict
+        @return: the result of the phase
+        """
+        latencies = []
+        errors = 0
+        started = time.time()
+        for operation in operations:
+            operation_started = time.time()
+            try:
+                operation()
+            except Exception as ex:
+                errors += 1
+                if errors == 1:
+                    self.agent.log.error("BENCHMARK: %s: %s" % (name, str(ex)))
+            latencies.append(time.time() - operation_started)
+        self.wait_database()
+        elapsed = time.time() - started
+        latencies.sort()
+        result = {"name": name,
+                  "operations": len(latencies),
+                  "errors": errors,
+                  "elapsed": elapsed,
+                  "throughput": len(latencies) / elapsed if elapsed else 0.0}
+        for label, percentile in (("p50", 0.50), ("p90", 0.90), ("p99", 0.99), ("max", 1.0)):
+            result[label] = latencies[min(len(latencies) - 1, int(percentile * len(latencies)))] if latencies else 0.0
+        self.results.append(result)
+        return result
+
+    ### Phases
+
+    def run(self):
+        """
+        Run all the phases.
+        @rtype: list
+        @return: the results of the phases
+        """
+        self.setup()
+        hypervisors = self.hypervisors
+        batches = lambda items: [items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size)]
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+        hypervisor_entries = [{"jid": jid, "status": "Online", "last_seen": now, "stat1": 0, "stat2": 0, "stat3": 0} for jid in hypervisors]
+        self.measure("register_hypervisors", [self._operation("register_hypervisors", batch) for batch in batches(hypervisor_entries)])
+
+        vm_entries = []
+        for i in range(self.vms):
+            uuid = str(uuid4())
+            domain = ARCHIPEL_BENCHMARK_DOMAIN % {"name": "vm-%d" % i, "uuid": uuid, "memory": random.choice((524288, 1048576, 4194304)), "vcpus": random.choice((1, 2, 4))}
+            vm_entries.append({"uuid": uuid, "parker": None, "creation_date": None, "domain": domain, "hypervisor": hypervisors[i % len(hypervisors)], "name": "vm-%d" % i})
+        self.measure("register_vms", [self._operation("register_vms", batch, sender=batch[0]["hypervisor"]) for batch in batches(vm_entries)])
+
+        for round_index in range(self.rounds):
+            updates = [self._operation("update_hypervisors", [{"jid": jid, "stat1": random.randint(0, 256000000), "stat2": random.randint(0, 100), "stat3": random.random() * 16}], sender=jid) for jid in hypervisors]
+            self.measure("update_hypervisors #%d" % (round_index + 1), updates)
+            self.measure("flush_stats #%d" % (round_index + 1), [self.agent.flush_stats])
+
+        self.measure("keepalive", [lambda: self.agent.handle_central_keepalive_event(self.keepalive_message()) for i in range(self.queries)])
+        self.measure("check_hyps", [self.agent.check_hyps for i in range(self.rounds)])
+
+        read_vms = []
+        for i in range(self.queries):
+            jid = random.choice(hypervisors)
+            iq = self.build_iq("read_vms", event_attrs={"columns": "uuid,name,hypervisor"}, sender=jid)
+            iq.getTag("query").getTag("archipel").getTag("event").addChild("filter", attrs={"column": "hypervisor", "operator": "=", "value": jid})
+            read_vms.append(lambda iq=iq: self.dispatch(iq))
+        self.measure("read_vms", read_vms)
+        self.measure("read_hypervisors", [self.read_all_hypervisors for i in range(self.rounds)])
+
+        platform = self.agent.get_plugin("platformrequest")
+        if platform and ARCHIPEL_NS_PLATFORM:
+            request = self.build_iq("request", attrs={"limit": "10"}, queryNS=ARCHIPEL_NS_PLATFORM)
+            self.measure("platform_request", [lambda: self.dispatch(request, platform.process_iq) for i in range(self.queries)])
+            demands = [{"id": "vm-%d" % i, "memory": 1048576, "vcpus": 2} for i in range(self.batch_size)]
+            place = self.build_iq("place", queryNS=ARCHIPEL_NS_PLATFORM)
+            for demand in demands:
+                place.getTag("query").getTag("archipel").addChild("vm", attrs=demand)
+            self.measure("platform_place", [lambda: self.dispatch(place, platform.process_iq) for i in range(self.rounds)])
+
+        # every hypervisor times out at once
+        self.agent.liveness_tracker.load([(jid, 0, "Online") for jid in hypervisors])
+        self.measure("check_hyps_timeout", [self.agent.check_hyps])
+        return self.results
+
+    def _operation(self, action, entries, sender=None):
+        """
+        Build the request of an action and return the operation sending it.
+        """
+        iq = self.build_iq(action, entries, sender=sender)
+        return lambda: self.dispatch(iq)
+
+    def read_all_hypervisors(self):
+        """
+        Read the online hypervisors by chunks, following the continuations.
+        """
+        iq = self.build_iq("read_hypervisors", attrs={"chunk_size": "500"}, event_attrs={"columns": "jid,status"})
+        iq.getTag("query").getTag("archipel").getTag("event").addChild("filter", attrs={"column": "status", "operator": "=", "value": "Online"})
+        reply = self.dispatch(iq)
+        while reply.getTag("continuation"):
+            iq = self.build_iq("read_continue", attrs={"chunk_size": "500"}, event_attrs={"continuation": reply.getTag("continuation").getAttr("token")})
+            reply = self.dispatch(iq)
+
+    ### Report
+
+    def database_size(self, path):
+        """
+        Return the size of the database files.
+        @type path: string
+        @param path: the path of the database
+        @rtype: int
+        @return: the size in bytes of the database and its journal
+        """
+        return sum(os.path.getsize(path + suffix) for suffix in ("", "-wal", "-journal") if os.path.exists(path + suffix))
+
+    def report(self, path):
+        """
+        Format the results.
+        @type path: string
+        @param path: the path of the database
+        @rtype: string
+        @return: the report
+        """
+        lines = ["%-22s %8s %7s %10s %10s %10s %10s %10s %10s" % ("phase", "ops", "errors", "seconds", "ops/s", "p50 ms", "p90 ms", "p99 ms", "max ms")]
+        for result in self.results:
+            lines.append("%-22s %8d %7d %10.3f %10.1f %10.3f %10.3f %10.3f %10.3f" % (result["name"], result["operations"], result["errors"], result["elapsed"], result["throughput"],
+                                                                                   result["p50"] * 1000, result["p90"] * 1000, result["p99"] * 1000, result["max"] * 1000))
+        lines.append("")
+        for table in ("hypervisors", "vms", "hypervisors_stats"):
+            lines.append("%-22s %8d rows" % (table, list(self.agent.database.request("select count(*) from %s" % table))[0][0]))
+        lines.append("%-22s %8.1f MB" % ("database size", self.database_size(path) / 1048576.0))
+        return "\n".join(lines)
@@ -26,17 +26,27 @@ Contains L{TNArchipelCentralAgent}, the entities used for central agent.
 import datetime
 import random
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from threading import Thread
-from Queue import Queue
+from Queue import Queue, Empty
+from uuid import uuid4
 
 from archipelcore.archipelAvatarControllableEntity import TNAvatarControllableEntity
 from archipelcore.archipelEntity import TNArchipelEntity
 from archipelcore.archipelHookableEntity import TNHookableEntity
 from archipelcore.archipelTaggableEntity import TNTaggableEntity
+from archipelcore.entriesencoding import ARCHIPEL_CENTRALAGENT_FEATURES, ARCHIPEL_ENTRIES_ENCODING_COMPACT, ARCHIPEL_ENTRIES_ENCODINGS, decode_payload, encode_payload, get_domain_fingerprint, get_encodings, is_compact_entries_node, pack_compact_entries, unpack_compact_entries
 from archipelcore.pubsub import TNPubSubNode
 from archipelcore.utils import build_error_iq
 from archipelcore import xmpp
 
+from archipelLivenessTracker import TNHypervisorLivenessTracker
+from archipelStatsBuffer import ARCHIPEL_STATS_DEFAULT_FLUSH_INTERVAL, TNHypervisorStatsBuffer
+from archipelStatsHistory import ARCHIPEL_STATS_RESOLUTIONS, ARCHIPEL_STATS_ROLLUP_INTERVAL, TNHypervisorStatsHistory
+from archipelReplication import ARCHIPEL_REPLICATION_DEFAULT_INTERVAL, ARCHIPEL_REPLICATION_SNAPSHOT_CHUNK, ARCHIPEL_REPLICATION_TABLES, ARCHIPEL_REPLICATION_TIMEOUT, TNReplicationLog, compile_changes
+
 # this pubsub is subscribed by all hypervisors and carries the keepalive messages
 # for the central agent
 ARCHIPEL_KEEPALIVE_PUBSUB                = "/archipel/centralagentkeepalive"
@@ -44,57 +54,640 @@ ARCHIPEL_NS_CENTRALAGENT                 = "archipel:centralagent"
 
 ARCHIPEL_ERROR_CODE_CENTRALAGENT         = 123
 
+# group commit of the database controller
+ARCHIPEL_DB_COMMIT_INTERVAL              = 0.05
+ARCHIPEL_DB_COMMIT_MAX_STATEMENTS        = 1000
+
+# read only connections of the database controller
+ARCHIPEL_DB_READERS                      = 4
+
+# revision of the central database schema, stored as its user_version
+ARCHIPEL_CENTRALDB_SCHEMA_VERSION        = 5
+ARCHIPEL_CENTRALDB_VMS_COLUMNS           = "uuid, parker, creation_date, domain, hypervisor, name"
+
+# structured queries
+ARCHIPEL_CENTRALDB_TABLES = {
+    "vms": {"columns": ("uuid", "parker", "creation_date", "domain", "hypervisor", "name", "jid", "fingerprint"),
+            "default": ("uuid", "parker", "creation_date", "domain", "hypervisor", "name"),
+            "key": "uuid"},
+    "hypervisors": {"columns": ("jid", "last_seen", "status", "stat1", "stat2", "stat3"),
+                    "default": ("jid", "last_seen", "status"),
+                    "key": "jid"}
+}
+ARCHIPEL_CENTRALDB_QUERY_OPERATORS = {
+    "=": "%(column)s=?",
+    "!=": "%(column)s!=?",
+    "<": "%(column)s<?",
+    "<=": "%(column)s<=?",
+    ">": "%(column)s>?",
+    ">=": "%(column)s>=?",
+    "like": "%(column)s like ?",
+    "in": "%(column)s in (%(placeholders)s)",
+    "after": "(%(column)s>=? and (%(column)s>? or %(key)s>?))",
+    "not_online": "(%(column)s='None' or %(column)s not in (select jid from hypervisors where status='Online'))"
+}
+ARCHIPEL_CENTRALDB_QUERY_CACHE_SIZE      = 256
+
+# maximum number of parameters of the statements built from a list of entries
+ARCHIPEL_CENTRALDB_MAX_VARIABLES         = 500
+
+# chunked reads
+ARCHIPEL_CENTRALDB_READ_CHUNK_SIZE       = 500
+ARCHIPEL_CENTRALDB_MAX_CHUNK_SIZE        = 2000
+ARCHIPEL_CENTRALDB_CURSOR_TIMEOUT        = 60
+ARCHIPEL_CENTRALDB_MAX_CURSORS           = 256
+ARCHIPEL_CENTRALDB_MAX_CURSORS_PER_OWNER = 8
+
 # XMPP shows
 ARCHIPEL_XMPP_SHOW_ONLINE                       = "Online"
 
 
+class TNQueryCompiler(object):
+    """
+    This class compiles the structured queries sent to the central agent
+    into parameterized select statements. The statements are cached by
+    shape, so the same query with other values reuses the same statement
+    text, and so the statement prepared by sqlite.
+    A query is made of:
+        - columns: list of columns to return, the default ones if empty
+        - filters: list of (column, operator, value), all of them must match.
+          The value of the "in" operator is a list, "not_online" has no value.
+          The value of the "after" operator is the (value, key) of the last row
+          of the previous page, for keyset pagination ordered by (column, key)
+        - order: list of (column, "asc" or "desc")
+        - limit and offset: integers, or None
+    A keyset query has no order and no offset: it returns the rowid of the
+    rows as last column, and only the rows after a given rowid, in rowid
+    order. The rowid is the parameter following the ones of the filters.
+    """
+    def __init__(self, cache_size=ARCHIPEL_CENTRALDB_QUERY_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.statements = OrderedDict()
+        self.lock = threading.Lock()
+
+    def compile(self, table, columns=None, filters=None, order=None, limit=None, offset=None, count=False, after_rowid=None):
+        """
+        Compile a structured query.
+        @type table: string
+        @param table: the table to query
+        @type count: bool
+        @param count: if True, the statement returns the number of matching rows
+        @type after_rowid: int
+        @param after_rowid: if not None, compile a keyset query returning the rows after this rowid
+        @rtype: tuple
+        @return: (statement, parameters, list of returned columns)
+        """
+        if not table in ARCHIPEL_CENTRALDB_TABLES:
+            raise Exception("Unknown table %s" % table)
+        if count:
+            columns, order, limit, offset, after_rowid = ("count(*)",), None, None, None, None
+        if after_rowid is not None and (order or offset is not None):
+            raise Exception("A keyset query cannot be ordered or have an offset")
+        columns = tuple(columns or ARCHIPEL_CENTRALDB_TABLES[table]["default"])
+        filters = filters or []
+        order = tuple(order or [])
+        params = []
+        shape = []
+        for column, operator, value in filters:
+            if operator == "in":
+                shape.append((column, operator, len(value)))
+                params.extend(value)
+            elif operator == "after":
+                shape.append((column, operator, None))
+                params.extend([value[0], value[0], value[1]])
+            elif operator == "not_online":
+                shape.append((column, operator, None))
+            else:
+                shape.append((column, operator, None))
+                params.append(value)
+        if after_rowid is not None:
+            params.append(int(after_rowid))
+        if limit is not None:
+            params.append(int(limit))
+            if offset is not None:
+                params.append(int(offset))
+        key = (table, columns, tuple(shape), order, limit is not None, limit is not None and offset is not None, after_rowid is not None)
+
+        with self.lock:
+            statement = self.statements.pop(key, None)
+            if not statement:
+                statement = self._build(table, columns, shape, order, limit is not None, offset is not None, after_rowid is not None)
+            self.statements[key] = statement
+            if len(self.statements) > self.cache_size:
+                self.statements.popitem(last=False)
+        if count:
+            columns = ("count",)
+        if after_rowid is not None:
+            columns = columns + ("rowid",)
+        return statement, params, columns
+
+    def _build(self, table, columns, shape, order, has_limit, has_offset, keyset=False):
+        """
+        Build the statement of a query shape, checking every column and operator.
+        """
+        allowed = ARCHIPEL_CENTRALDB_TABLES[table]["columns"] + ("count(*)",)
+        for column in columns + tuple(item[0] for item in shape) + tuple(item[0] for item in order):
+            if not column in allowed:
+                raise Exception("Unknown column %s in table %s" % (column, table))
+        statement = "select %s from %s" % (", ".join(columns + (("rowid",) if keyset else ())), table)
+        clauses = []
+        for column, operator, count in shape:
+            if not operator in ARCHIPEL_CENTRALDB_QUERY_OPERATORS:
+                raise Exception("Unknown operator %s" % operator)
+            clauses.append(ARCHIPEL_CENTRALDB_QUERY_OPERATORS[operator] % {"column": column,
+                                                                           "key": ARCHIPEL_CENTRALDB_TABLES[table]["key"],
+                                                                           "placeholders": ",".join("?" * (count or 0))})
+        if keyset:
+            clauses.append("rowid>?")
+            order = (("rowid", "asc"),)
+        if clauses:
+            statement += " where %s" % " and ".join(clauses)
+        if order:
+            orders = []
+            for column, direction in order:
+                if not direction in ("asc", "desc"):
+                    raise Exception("Unknown order direction %s" % direction)
+                orders.append("%s %s" % (column, direction))
+            statement += " order by %s" % ", ".join(orders)
+        if has_limit:
+            statement += " limit ?"
+            if has_offset:
+                statement += " offset ?"
+        return statement
+
+
+class TNReadCursors(object):
+    """
+    This class keeps the state of the chunked reads until they are fully
+    sent. The first chunk of a result is sent in the reply of the read, with
+    a continuation token if there are more rows. Each read_continue request
+    with this token gets the next chunk.
+    A cursor does not keep the result: its fetch function reads the next
+    chunk when it is asked, for instance with a keyset query on the rowid,
+    so only one chunk is in memory. fetch(after, count) returns at most count
+    (key, entry), following the key of the last entry already sent, None for
+    the first chunk.
+    Cursors which are not continued during the timeout are dropped. An owner
+    keeps at most max_cursors_per_owner cursors, its oldest one is dropped
+    when it opens more.
+    """
+    def __init__(self, timeout=ARCHIPEL_CENTRALDB_CURSOR_TIMEOUT, max_cursors=ARCHIPEL_CENTRALDB_MAX_CURSORS, max_cursors_per_owner=ARCHIPEL_CENTRALDB_MAX_CURSORS_PER_OWNER):
+        self.timeout = timeout
+        self.max_cursors = max_cursors
+        self.max_cursors_per_owner = max_cursors_per_owner
+        self.cursors = {}
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        """
+        Drop the cursors not continued during the timeout. Must be called with the lock.
+        """
+        for token in [token for token, cursor in self.cursors.iteritems() if cursor["deadline"] < now]:
+            del self.cursors[token]
+
+    def _add(self, cursor, now):
+        """
+        Add a cursor, dropping the oldest one of its owner if it has too many.
+        Must be called with the lock.
+        @rtype: string
+        @return: the continuation token
+        """
+        self._expire(now)
+        owned = sorted([(c["opened"], token) for token, c in self.cursors.iteritems() if c["owner"] == cursor["owner"]])
+        while len(owned) >= self.max_cursors_per_owner:
+            del self.cursors[owned.pop(0)[1]]
+        if len(self.cursors) >= self.max_cursors:
+            raise Exception("Too many reads in progress, try again later")
+        token = uuid4().hex
+        self.cursors[token] = cursor
+        return token
+
+    def open(self, entries, chunk_size, owner=None):
+        """
+        Return the first chunk of a result already read.
+        @type entries: list
+        @param entries: all the entries of the result
+        @type chunk_size: int
+        @param chunk_size: the maximum number of entries per chunk, None for no limit
+        @type owner: string
+        @param owner: the bare JID of the requester
+        @rtype: tuple
+        @return: (first chunk, continuation token or None, number of remaining entries)
+        """
+        def _fetch(after, count):
+            start = after or 0
+            return [(start + i + 1, entry) for i, entry in enumerate(entries[start:start + count])]
+        return self.open_query(_fetch, lambda: len(entries), chunk_size, owner)
+
+    def open_query(self, fetch, count, chunk_size, owner=None):
+        """
+        Return the first chunk of a result read by chunks.
+        @type fetch: function
+        @param fetch: fetch(after, count) returns the next (key, entry) of the result
+        @type count: function
+        @param count: count() returns the number of entries of the result
+        @type chunk_size: int
+        @param chunk_size: the maximum number of entries per chunk, None for no limit
+        @type owner: string
+        @param owner: the bare JID of the requester
+        @rtype: tuple
+        @return: (first chunk, continuation token or None, number of remaining entries)
+        """
+        rows = fetch(None, chunk_size + 1 if chunk_size else None)
+        if chunk_size is None or len(rows) <= chunk_size:
+            return [entry for key, entry in rows], None, 0
+        rows = rows[:chunk_size]
+        remaining = max(count() - chunk_size, 1)
+        now = time.time()
+        cursor = {"fetch": fetch, "after": rows[-1][0], "chunk_size": chunk_size, "remaining": remaining,
+                  "owner": owner, "opened": now, "deadline": now + self.timeout}
+        with self.lock:
+            token = self._add(cursor, now)
+        return [entry for key, entry in rows], token, remaining
+
+    def next(self, token, owner=None):
+        """
+        Return the next chunk of a result.
+        @type token: string
+        @param token: the continuation token
+        @type owner: string
+        @param owner: the bare JID of the requester, which must be the one which opened the cursor
+        @rtype: tuple
+        @return: (chunk, continuation token or None, number of remaining entries)
+        """
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            cursor = self.cursors.pop(token, None)
+        if not cursor or cursor["owner"] != owner:
+            raise Exception("Unknown or expired continuation token %s" % token)
+        rows = cursor["fetch"](cursor["after"], cursor["chunk_size"] + 1)
+        if len(rows) <= cursor["chunk_size"]:
+            return [entry for key, entry in rows], None, 0
+        rows = rows[:cursor["chunk_size"]]
+        cursor["after"] = rows[-1][0]
+        cursor["remaining"] = max(cursor["remaining"] - len(rows), 1)
+        cursor["deadline"] = now + self.timeout
+        with self.lock:
+            self.cursors[token] = cursor
+        return [entry for key, entry in rows], token, cursor["remaining"]
+
+
+class TNDBReadPool(object):
+    """
+    This class represents a pool of threads, each one owning a read only
+    connection to the database. They serve the select statements in parallel
+    with the writes of L{TNDBController} when the database is in WAL mode.
+    Statements written by the controller are visible once it commits them.
+    """
+    def __init__(self, db, log, size=ARCHIPEL_DB_READERS):
+        self.db = db
+        self.log = log
+        self.requests = Queue()
+        self.readers = []
+        for i in range(size):
+            reader = Thread(target=self.run, name="%s-%d" % (self.__class__.__name__, i))
+            reader.setDaemon(True)
+            reader.start()
+            self.readers.append(reader)
+
+    def run(self):
+        conn = sqlite3.connect(self.db, timeout=10, cached_statements=ARCHIPEL_CENTRALDB_QUERY_CACHE_SIZE)
+        try:
+            conn.execute("pragma query_only=1")
+        except Exception:
+            pass
+        while True:
+            request, arg, results = self.requests.get()
+            if request == '--close connection--':
+                break
+            try:
+                results.put((conn.execute(request, arg).fetchall(), None))
+            except Exception as ex:
+                self.log.error("Error while executing sql statement %s with %s (%s)" % (request, arg, ex))
+                results.put((None, ex))
+        conn.close()
+
+    def execute(self, request, arg=None):
+        """
+        Execute a select statement on one of the read only connections.
+        @type request: string
+        @param request: the sql statement
+        @type arg: tuple or dict
+        @param arg: the parameters of the statement
+        @rtype: list
+        @return: all the rows returned by the statement
+        """
+        results = Queue()
+        self.requests.put((request, arg or tuple(), results))
+        rows, ex = results.get()
+        if ex:
+            raise ex
+        return rows
+
+    def close(self):
+        for reader in self.readers:
+            self.requests.put(('--close connection--', None, None))
+
+
 class TNDBController(Thread):
     """
     This class reprensent the database controller. The main purpose is to handle
     better concurency read/write by setting up a Queue. This is a workaround to
     avoid sqlite3 to segfault from time to time.
+    Write statements are grouped in transactions: a transaction is committed when
+    it is open for more than commit_interval seconds, or when it contains
+    ARCHIPEL_DB_COMMIT_MAX_STATEMENTS statements.
+    The journal mode of the database is left unchanged unless journal_mode is set.
+    In WAL mode, reads can be sent to a L{TNDBReadPool} with read().
+    When the replication is started, temporary triggers record the rows of
+    the replicated tables changed by each write statement, and the changes
+    are added to the L{TNReplicationLog} in the order of the statements.
     """
-    def __init__(self, db, log):
+    def __init__(self, db, log, journal_mode=None, commit_interval=ARCHIPEL_DB_COMMIT_INTERVAL, readers=ARCHIPEL_DB_READERS):
         super(TNDBController, self).__init__()
         self.db = db
+        self.log = log
+        self.journal_mode = journal_mode
+        self.commit_interval = commit_interval
         self.requets = Queue()
+        self.replication_log = None
         self.name = self.__class__.__name__
         self.start()
-        self.log = log
+        self.read_pool = None
+        if readers > 0 and self.journal_mode and self.journal_mode.lower() == "wal":
+            self.read_pool = TNDBReadPool(db, log, readers)
 
     def run(self):
         conn = sqlite3.connect(self.db)
+        if self.journal_mode:
+            try:
+                conn.execute("pragma journal_mode=%s" % self.journal_mode)
+                if self.journal_mode.lower() == "wal":
+                    conn.execute("pragma synchronous=normal")
+            except Exception as ex:
+                self.log.error("Unable to set the journal mode of the database to %s (%s)" % (self.journal_mode, ex))
         cursor = conn.cursor()
+        pending = 0
+        transaction_start = None
         while True:
-            request, arg, results = self.requets.get()
+            try:
+                if pending:
+                    timeout = max(0, self.commit_interval - (time.time() - transaction_start))
+                    request, arg, results, many = self.requets.get(timeout=timeout)
+                else:
+                    request, arg, results, many = self.requets.get()
+            except Empty:
+                pending = self.commit(conn, pending)
+                continue
             if request == '--close connection--':
                 break
+            if request in ('--replication--', '--snapshot--', '--apply--'):
+                pending = self.commit(conn, pending)
+                if request == '--replication--':
+                    self.set_replication(conn, arg)
+                elif request == '--snapshot--':
+                    results.put(self.read_snapshot(conn, arg))
+                else:
+                    results.put(self.apply_statements(conn, arg))
+                if results:
+                    results.put('--no more results--')
+                continue
+            total_changes = conn.total_changes
+            error = None
             try:
-                cursor.execute(request, arg)
-                conn.commit()
+                if many:
+                    cursor.executemany(request, arg)
+                else:
+                    cursor.execute(request, arg)
+                if not pending:
+                    transaction_start = time.time()
+                pending += 1
             except Exception as ex:
-                self.log.error("Error while executing sql statement %s with %s (%s)" % (request, arg, ex))
+                error = ex
+            if self.replication_log and conn.total_changes != total_changes:
+                self.log_changes(conn)
+            if error:
+                self.log.error("Error while executing sql statement %s with %s (%s)" % (request, arg, error))
+                if results:
+                    results.put('--no more results--')
                 continue
             if results:
                 for record in cursor:
                     results.put(record)
                 results.put('--no more results--')
+            if pending >= ARCHIPEL_DB_COMMIT_MAX_STATEMENTS or time.time() - transaction_start >= self.commit_interval:
+                pending = self.commit(conn, pending)
+        self.commit(conn, pending)
         conn.close()
 
+    def commit(self, conn, pending):
+        """
+        Commit the current transaction.
+        @type conn: sqlite3.Connection
+        @param conn: the connection
+        @type pending: int
+        @param pending: the number of statements in the transaction
+        @rtype: int
+        @return: the number of statements left in the transaction, always 0
+        """
+        if pending:
+            try:
+                conn.commit()
+            except Exception as ex:
+                self.log.error("Error while committing %d sql statements (%s)" % (pending, ex))
+                conn.rollback()
+                if self.replication_log:
+                    # the logged changes are lost, the replicas must start again from a snapshot
+                    self.replication_log.reset()
+        return 0
+
+    def set_replication(self, conn, replication_log):
+        """
+        Create or drop the temporary triggers recording the changed rows of
+        the replicated tables. Called in the controller thread.
+        @type conn: sqlite3.Connection
+        @param conn: the connection
+        @type replication_log: L{TNReplicationLog}
+        @param replication_log: the log of the changes, None to stop the replication
+        """
+        self.replication_log = replication_log
+        try:
+            for table in ARCHIPEL_REPLICATION_TABLES:
+                for event in ("insert", "update", "delete"):
+                    conn.execute("drop trigger if exists temp.replication_%s_%s" % (table, event))
+            conn.execute("drop table if exists temp.replication_changes")
+            if not replication_log:
+                return
+            # the rows replaced by "on conflict replace" only fire the delete triggers with recursive triggers
+            conn.execute("pragma recursive_triggers=1")
+            conn.execute("create temp table replication_changes (tbl string, op string, row int)")
+            for table in ARCHIPEL_REPLICATION_TABLES:
+                conn.execute("create temp trigger replication_%s_insert after insert on main.%s begin insert into replication_changes values ('%s', 'upsert', new.rowid); end" % (table, table, table))
+                conn.execute("create temp trigger replication_%s_update after update on main.%s begin insert into replication_changes values ('%s', 'upsert', new.rowid); end" % (table, table, table))
+                conn.execute("create temp trigger replication_%s_delete after delete on main.%s begin insert into replication_changes values ('%s', 'delete', old.rowid); end" % (table, table, table))
+            conn.commit()
+        except Exception as ex:
+            self.log.error("Unable to set up the replication of the database (%s)" % ex)
+            self.replication_log = None
+
+    def log_changes(self, conn):
+        """
+        Add the rows changed by the last statement to the replication log,
+        with their current values. Called in the controller thread.
+        @type conn: sqlite3.Connection
+        @param conn: the connection
+        """
+        changed = OrderedDict()
+        for table, op, row in conn.execute("select tbl, op, row from temp.replication_changes order by rowid").fetchall():
+            changed.pop((table, row), None)
+            changed[(table, row)] = op
+        if not changed:
+            return
+        conn.execute("delete from temp.replication_changes")
+        values = {}
+        for table in ARCHIPEL_REPLICATION_TABLES:
+            rowids = [row for (changed_table, row), op in changed.iteritems() if changed_table == table and op == "upsert"]
+            if not rowids:
+                continue
+            columns = [item[1] for item in conn.execute("pragma table_info('%s')" % table).fetchall()]
+            for i in range(0, len(rowids), ARCHIPEL_CENTRALDB_MAX_VARIABLES):
+                chunk = rowids[i:i + ARCHIPEL_CENTRALDB_MAX_VARIABLES]
+                for row in conn.execute("select rowid, %s from %s where rowid in (%s)" % (", ".join(columns), table, ",".join("?" * len(chunk))), chunk):
+                    values[(table, row[0])] = dict(zip(columns, row[1:]))
+        changes = []
+        for (table, row), op in changed.iteritems():
+            if (table, row) in values:
+                changes.append([table, "upsert", row, values[(table, row)]])
+            else:
+                changes.append([table, "delete", row, None])
+        self.replication_log.append(changes)
+
+    def read_snapshot(self, conn, tables):
+        """
+        Read whole tables, with their rowid, and the sequence number of the
+        replication log at this point. Called in the controller thread.
+        @type conn: sqlite3.Connection
+        @param conn: the connection
+        @type tables: list
+        @param tables: the names of the tables to read
+        @rtype: tuple
+        @return: (sequence number of the replication log, list of (table, columns, rows))
+        """
+        seq = self.replication_log.seq if self.replication_log else 0
+        snapshot = []
+        for table in tables:
+            columns = ["rowid"] + [item[1] for item in conn.execute("pragma table_info('%s')" % table).fetchall()]
+            snapshot.append((table, columns, conn.execute("select %s from %s" % (", ".join(columns), table)).fetchall()))
+        return seq, snapshot
+
+    def apply_statements(self, conn, statements):
+        """
+        Execute statements in one transaction, rolled back if one of them
+        fails. Called in the controller thread.
+        @type conn: sqlite3.Connection
+        @param conn: the connection
+        @type statements: list
+        @param statements: list of (statement, parameters)
+        @rtype: Exception
+        @return: the error, None if the statements are committed
+        """
+        try:
+            for statement, params in statements:
+                conn.execute(statement, params)
+            conn.commit()
+        except Exception as ex:
+            conn.rollback()
+            self.log.error("Error while applying %d sql statements (%s)" % (len(statements), ex))
+            return ex
+        return None
+
     def execute(self, request, arg=None, results=None):
-        self.requets.put((request, arg or tuple(), results))
+        self.requets.put((request, arg or tuple(), results, False))
+
+    def executemany(self, request, args):
+        self.requets.put((request, list(args), None, True))
+
+    def start_replication(self, replication_log):
+        """
+        Start adding the changes of the write statements to a replication log.
+        The statements queued before are not added.
+        @type replication_log: L{TNReplicationLog}
+        @param replication_log: the log
+        """
+        self.requets.put(('--replication--', replication_log, None, False))
+
+    def stop_replication(self):
+        """
+        Stop adding the changes of the write statements to the replication log.
+        """
+        self.requets.put(('--replication--', None, None, False))
+
+    def apply(self, statements):
+        """
+        Execute statements in one transaction and wait for the result.
+        @type statements: list
+        @param statements: list of (statement, parameters)
+        @raise Exception: if a statement fails, none of them is applied
+        """
+        results = Queue()
+        self.requets.put(('--apply--', statements, results, False))
+        error = list(self.results(results))[0]
+        if error:
+            raise error
 
     def request(self, request, arg=None):
         results = Queue()
         self.execute(request, arg, results)
+        return self.results(results)
+
+    def results(self, results):
+        """
+        Return the records put in a results queue by the controller.
+        @type results: Queue
+        @param results: the queue given with the statement
+        @rtype: generator
+        @return: generator of the records
+        """
         while True:
             record = results.get()
             if record == '--no more results--':
                 break
             yield record
 
+    def snapshot(self, tables):
+        """
+        Read whole tables at the point of the last statement added to the
+        replication log. The statements sent after are not visible. The
+        first column of each table is the rowid.
+        @type tables: list
+        @param tables: the names of the tables to read
+        @rtype: tuple
+        @return: (sequence number of the replication log, list of (table, columns, rows))
+        """
+        results = Queue()
+        self.requets.put(('--snapshot--', tables, results, False))
+        return list(self.results(results))[0]
+
+    def read(self, request, arg=None):
+        """
+        Execute a select statement and return all its rows at once. If there
+        is a read pool, the statement does not wait for the pending writes.
+        @type request: string
+        @param request: the sql statement
+        @type arg: tuple or dict
+        @param arg: the parameters of the statement
+        @rtype: list
+        @return: all the rows returned by the statement
+        """
+        if self.read_pool:
+            return self.read_pool.execute(request, arg)
+        return list(self.request(request, arg))
+
     def close(self):
         self.execute('--close connection--')
+        if self.read_pool:
+            self.read_pool.close()
 
 
 class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarControllableEntity, TNTaggableEntity):
@@ -150,15 +743,57 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         self.create_hook("HOOK_CENTRALAGENT_VM_UNREGISTERED")
         self.create_hook("HOOK_CENTRALAGENT_HYP_REGISTERED")
         self.create_hook("HOOK_CENTRALAGENT_HYP_UNREGISTERED")
+        self.create_hook("HOOK_CENTRALAGENT_HYP_STATS_UPDATED")
 
         self.central_agent_jid_val = None
         self.xmpp_authenticated    = False
         self.is_central_agent      = False
         self.salt                  = random.random()
-        self.database              = TNDBController(self.configuration.get("CENTRALAGENT", "database"), self.log)
+        journal_mode = None
+        if self.configuration.has_option("CENTRALAGENT", "database_journal_mode"):
+            journal_mode = self.configuration.get("CENTRALAGENT", "database_journal_mode")
+        commit_interval = ARCHIPEL_DB_COMMIT_INTERVAL
+        if self.configuration.has_option("CENTRALAGENT", "database_commit_interval"):
+            commit_interval = self.configuration.getfloat("CENTRALAGENT", "database_commit_interval")
+        readers = ARCHIPEL_DB_READERS
+        if self.configuration.has_option("CENTRALAGENT", "database_readers"):
+            readers = self.configuration.getint("CENTRALAGENT", "database_readers")
+        self.database              = TNDBController(self.configuration.get("CENTRALAGENT", "database"), self.log, journal_mode, commit_interval, readers)
+        self.query_compiler        = TNQueryCompiler()
+        self.read_cursors          = TNReadCursors()
+        self.liveness_tracker      = TNHypervisorLivenessTracker(self.hypervisor_timeout_threshold)
+        self.stats_buffer          = TNHypervisorStatsBuffer()
+        self.stats_flush_interval  = ARCHIPEL_STATS_DEFAULT_FLUSH_INTERVAL
+        if self.configuration.has_option("CENTRALAGENT", "hypervisor_stats_flush_interval"):
+            self.stats_flush_interval = self.configuration.getfloat("CENTRALAGENT", "hypervisor_stats_flush_interval")
+        self.last_stats_flush      = time.time()
+
+        # history of the statistics of the hypervisors
+        self.stats_history         = None
+        if not self.configuration.has_option("CENTRALAGENT", "hypervisor_stats_history") or self.configuration.getboolean("CENTRALAGENT", "hypervisor_stats_history"):
+            retentions = {}
+            for name, resolution in ARCHIPEL_STATS_RESOLUTIONS.iteritems():
+                if self.configuration.has_option("CENTRALAGENT", "hypervisor_stats_retention_%s" % name):
+                    retentions[resolution] = self.configuration.getint("CENTRALAGENT", "hypervisor_stats_retention_%s" % name)
+            self.stats_history = TNHypervisorStatsHistory(self.database, retentions, self.stats_flush_interval)
+
+        # replication of the database to the standby central agents
+        self.replication_enabled   = False
+        if self.configuration.has_option("CENTRALAGENT", "database_replication"):
+            self.replication_enabled = self.configuration.getboolean("CENTRALAGENT", "database_replication")
+        self.replication_interval  = ARCHIPEL_REPLICATION_DEFAULT_INTERVAL
+        if self.configuration.has_option("CENTRALAGENT", "database_replication_interval"):
+            self.replication_interval = self.configuration.getfloat("CENTRALAGENT", "database_replication_interval")
+        self.replication_peers     = [str(self.jid.getStripped())]
+        if self.configuration.has_option("CENTRALAGENT", "database_replication_peers"):
+            self.replication_peers += [peer.strip() for peer in self.configuration.get("CENTRALAGENT", "database_replication_peers").split(",") if peer.strip()]
+        self.replication_columns   = None
+        self.replication_log       = None
+        self.replica               = {"epoch": None, "seq": 0, "snapshot": None, "pending": 0, "last_pull": 0, "more": False}
+        self.active_keepalive_interval = self.keepalive_interval
 
         # defining the structure of the keepalive pubsub event
-        self.keepalive_event      = xmpp.Node("event",attrs={"type":"keepalive","jid":self.jid})
+        self.keepalive_event      = xmpp.Node("event",attrs={"type":"keepalive","jid":self.jid, "encodings":",".join(ARCHIPEL_ENTRIES_ENCODINGS), "features":",".join(ARCHIPEL_CENTRALAGENT_FEATURES)})
         self.last_keepalive_heard = datetime.datetime.now()
         self.last_hyp_check       = datetime.datetime.now()
         self.required_stats_xml   = None
@@ -208,6 +843,9 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         It understands IQ of type:
             - read_hypervisors
             - read_vms
+            - read_continue
+            - count_vms
+            - sync_vms
             - get_existing_vms_instances
             - register_hypervisors
             - register_vms
@@ -215,6 +853,8 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             - update_hypervisors
             - unregister_hypervisors
             - unregister_vms
+            - replicate
+            - read_stats
         @type conn: xmpp.Dispatcher
         @param conn: ths instance of the current connection that send the stanza
         @type iq: xmpp.Protocol.Iq
@@ -226,6 +866,12 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             reply = self.iq_read_hypervisors(iq)
         elif action == "read_vms":
             reply = self.iq_read_vms(iq)
+        elif action == "read_continue":
+            reply = self.iq_read_continue(iq)
+        elif action == "count_vms":
+            reply = self.iq_count_vms(iq)
+        elif action == "sync_vms":
+            reply = self.iq_sync_vms(iq)
         elif action == "get_existing_vms_instances":
             reply = self.iq_get_existing_vms_instances(iq)
         elif action == "register_hypervisors":
@@ -242,6 +888,10 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             reply = self.iq_unregister_hypervisors(iq)
         elif action == "unregister_vms":
             reply = self.iq_unregister_vms(iq)
+        elif action == "replicate":
+            reply = self.iq_replicate(iq)
+        elif action == "read_stats":
+            reply = self.iq_read_stats(iq)
         if reply:
             conn.send(reply)
             raise xmpp.protocol.NodeProcessed
@@ -289,15 +939,35 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
 
     def become_central_agent(self):
         """
-        triggered when becoming active central agent
+        triggered when becoming active central agent. If we have an up to date
+        replica of the database of the previous central agent, we take over
+        with it and the hypervisors only sync the fingerprints of their vms,
+        to send again the definitions changed since the last replicated change.
         """
+        replicated = self.replication_enabled and self.replica["epoch"] is not None and not self.replica["snapshot"]
         self.is_central_agent = True
-        self.manage_database()
+        if replicated:
+            self.log.info("CENTRALAGENT: taking over with the replica of epoch %s at change %d" % (self.replica["epoch"], self.replica["seq"]))
+            self.create_database()
+        else:
+            self.manage_database()
+        self.replica.update({"epoch": None, "seq": 0, "snapshot": None, "pending": 0, "more": False})
+        if self.replication_enabled:
+            self.replication_log = TNReplicationLog()
+            self.database.start_replication(self.replication_log)
+        self.load_liveness()
+        if self.stats_history:
+            self.stats_history.load()
         initial_keepalive = xmpp.Node("event",attrs={"type":"keepalive","jid":self.jid})
-        initial_keepalive.setAttr("force_update","true")
+        if replicated:
+            initial_keepalive.setAttr("replicated","true")
+        else:
+            initial_keepalive.setAttr("force_update","true")
         initial_keepalive.setAttr("salt",self.salt)
         initial_keepalive.setAttr("keepalive_interval", self.keepalive_interval)
         initial_keepalive.setAttr("hypervisor_timeout_threshold", self.hypervisor_timeout_threshold)
+        initial_keepalive.setAttr("encodings", ",".join(ARCHIPEL_ENTRIES_ENCODINGS))
+        initial_keepalive.setAttr("features", ",".join(ARCHIPEL_CENTRALAGENT_FEATURES))
 
         if self.required_stats_xml:
             initial_keepalive.addChild(node=self.required_stats_xml)
@@ -348,12 +1018,17 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
                         self.log.debug("CENTRALAGENT: stepping down")
                         self.change_presence("away","Standby")
                         self.is_central_agent = False
+                        self.database.stop_replication()
+                        self.replication_log = None
+                        self.stats_buffer.clear()
                     else:
                         self.log.debug("CENTRALAGENT: election won")
                         return
 
                 self.central_agent_jid_val = keepalive_jid
                 self.last_keepalive_heard  = datetime.datetime.now()
+                if central_announcement_event.getAttr("keepalive_interval"):
+                    self.active_keepalive_interval = int(central_announcement_event.getAttr("keepalive_interval"))
 
     def iq_read_hypervisors(self,iq):
         """
@@ -363,12 +1038,8 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         """
         try:
             read_event      = iq.getTag("query").getTag("archipel").getTag("event")
-            columns         = read_event.getAttr("columns")
-            where_statement = read_event.getAttr("where_statement")
             reply           = iq.buildReply("result")
-            entries         = self.read_hypervisors(columns, where_statement)
-            for entry in self.pack_entries(entries):
-                reply.addChild(node=entry)
+            self.add_chunk_to_reply(iq, reply, *self.open_read(iq, "hypervisors", read_event))
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
         return reply
@@ -381,11 +1052,40 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         """
         try:
             read_event      = iq.getTag("query").getTag("archipel").getTag("event")
-            columns         = read_event.getAttr("columns")
-            where_statement = read_event.getAttr("where_statement")
             reply           = iq.buildReply("result")
-            entries         = self.read_vms(columns, where_statement)
-            for entry in self.pack_entries(entries):
+            self.add_chunk_to_reply(iq, reply, *self.open_read(iq, "vms", read_event))
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
+        return reply
+
+    def iq_read_continue(self,iq):
+        """
+        Called when the central agent receives a request for the next chunk
+        of a read. The event contains the continuation token.
+        @type iq: xmpp.Iq
+        @param iq: received Iq
+        """
+        try:
+            read_event      = iq.getTag("query").getTag("archipel").getTag("event")
+            reply           = iq.buildReply("result")
+            self.add_chunk_to_reply(iq, reply, *self.read_cursors.next(read_event.getAttr("continuation"), str(iq.getFrom().getStripped())))
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
+        return reply
+
+    def iq_count_vms(self,iq):
+        """
+        Called when the central agent receives a vms count event. The event
+        contains the filters of a structured query.
+        @type iq: xmpp.Iq
+        @param iq: received Iq
+        """
+        try:
+            read_event      = iq.getTag("query").getTag("archipel").getTag("event")
+            query           = self.unpack_query(read_event)
+            reply           = iq.buildReply("result")
+            entries         = self.read_table("vms", filters=query["filters"], count=True)
+            for entry in self.pack_entries(entries, iq):
                 reply.addChild(node=entry)
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
@@ -404,12 +1104,41 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             origin_hyp = iq.getFrom()
             reply      = iq.buildReply("result")
             entries    = self.get_existing_vms_instances(entries, origin_hyp)
-            for entry in self.pack_entries(entries):
+            for entry in self.pack_entries(entries, iq):
                 reply.addChild(node=entry)
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
         return reply
 
+    def iq_read_stats(self,iq):
+        """
+        Called when the central agent receives a statistics history read event.
+        The event may contain the start and the end of the period as timestamps,
+        the resolution (raw, minute or hour, the finest one kept otherwise), and
+        the jid of a hypervisor. The reply contains the aggregates of the
+        statistics of the cluster for each period.
+        @type iq: xmpp.Iq
+        @param iq: received Iq
+        """
+        try:
+            if not self.stats_history:
+                raise Exception("The history of the statistics is disabled")
+            read_event  = iq.getTag("query").getTag("archipel").getTag("event")
+            reply       = iq.buildReply("result")
+            start       = read_event.getAttr("start")
+            end         = read_event.getAttr("end")
+            resolution  = read_event.getAttr("resolution")
+            if resolution and not resolution in ARCHIPEL_STATS_RESOLUTIONS:
+                raise Exception("Unknown resolution %s" % resolution)
+            entries = self.stats_history.query(float(start) if start else None,
+                                               float(end) if end else None,
+                                               ARCHIPEL_STATS_RESOLUTIONS[resolution] if resolution else None,
+                                               read_event.getAttr("jid"))
+            self.add_chunk_to_reply(iq, reply, *self.read_cursors.open(entries, self.get_chunk_size(iq), str(iq.getFrom().getStripped())))
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
+        return reply
+
     def iq_register_hypervisors(self,iq):
         """
         Called when the central agent receives a hypervisor registration event.
@@ -420,6 +1149,9 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             reply   = iq.buildReply("result")
             entries = self.unpack_entries(iq)
             self.register_hypervisors(entries)
+            now = time.time()
+            for entry in entries:
+                self.liveness_tracker.seen(entry["jid"], now, entry.get("status"))
             self.perform_hooks("HOOK_CENTRALAGENT_HYP_REGISTERED", entries)
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
@@ -440,6 +1172,22 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
         return reply
 
+    def iq_sync_vms(self,iq):
+        """
+        Called when the central agent receives the fingerprints of the vms of
+        a hypervisor. Replies the vms whose definition must be registered.
+        @type iq: xmpp.Iq
+        @param iq: received Iq
+        """
+        try:
+            reply   = iq.buildReply("result")
+            entries = self.unpack_entries(iq)
+            for entry in self.pack_entries(self.sync_vms(entries), iq):
+                reply.addChild(node=entry)
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
+        return reply
+
     def iq_update_vms(self,iq):
         """
         Called when the central agent receives a vms update event.
@@ -464,7 +1212,7 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             reply   = iq.buildReply("result")
             entries = self.unpack_entries(iq)
             entries = self.update_vms_domain(entries)
-            for entry in self.pack_entries(entries):
+            for entry in self.pack_entries(entries, iq):
                 reply.addChild(node=entry)
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
@@ -479,9 +1227,26 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         try:
             reply   = iq.buildReply("result")
             entries = self.unpack_entries(iq)
+            last_seen = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+            status_entries = []
             for entry in entries:
-                entry['last_seen'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-            self.update_hypervisors(entries)
+                entry['last_seen'] = last_seen
+                # statistics are coalesced and flushed by flush_stats, status changes are written now
+                if "status" in entry:
+                    status_entries.append(entry)
+                else:
+                    self.stats_buffer.add(entry)
+            if status_entries:
+                self.update_hypervisors(status_entries)
+            now = time.time()
+            back_online = []
+            for entry in entries:
+                if self.liveness_tracker.seen(entry["jid"], now, entry.get("status")):
+                    self.log.info("CENTRALAGENT: Hypervisor %s is back up Online" % entry["jid"])
+                    back_online.append({"jid": entry["jid"], "status": "Online"})
+            if back_online:
+                self.update_hypervisors(back_online)
+            self.perform_hooks("HOOK_CENTRALAGENT_HYP_STATS_UPDATED", entries)
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
         return reply
@@ -496,6 +1261,9 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             reply   = iq.buildReply("result")
             entries = self.unpack_entries(iq)
             self.unregister_hypervisors(entries)
+            for entry in entries:
+                self.liveness_tracker.forget(entry["jid"])
+                self.stats_buffer.forget(entry["jid"])
             self.perform_hooks("HOOK_CENTRALAGENT_HYP_UNREGISTERED", entries)
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
@@ -512,12 +1280,254 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             in_entries  = self.unpack_entries(iq)
             out_entries = self.unregister_vms(in_entries)
             self.perform_hooks("HOOK_CENTRALAGENT_VM_UNREGISTERED", out_entries)
-            for entry in self.pack_entries(out_entries):
+            for entry in self.pack_entries(out_entries, iq):
                 reply.addChild(node=entry)
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
         return reply
 
+    def iq_replicate(self,iq):
+        """
+        Called when the central agent receives a replication request from a
+        standby central agent. The event contains the epoch and the sequence
+        number of its replica, or the continuation token of a snapshot.
+        The reply contains the following changes, or a chunk of snapshot:
+            <changes epoch="..." seq="last change" more="true|false">JSON payload</changes>
+            <snapshot epoch="..." seq="..." continuation="token">JSON payload</snapshot>
+        @type iq: xmpp.Iq
+        @param iq: received Iq
+        """
+        try:
+            if not self.is_central_agent or not self.replication_log:
+                raise Exception("This central agent does not replicate its database")
+            if not self.is_replication_peer(iq.getFrom()):
+                raise Exception("%s is not allowed to replicate the database" % iq.getFrom().getStripped())
+            replicate_event = iq.getTag("query").getTag("archipel").getTag("event")
+            reply           = iq.buildReply("result")
+            if replicate_event.getAttr("continuation"):
+                rows, token, remaining = self.read_cursors.next(replicate_event.getAttr("continuation"), str(iq.getFrom().getStripped()))
+                snapshot = xmpp.Node("snapshot")
+                if token:
+                    snapshot.setAttr("continuation", token)
+                reply.addChild(node=encode_payload(snapshot, {"rows": rows}))
+                return reply
+            epoch   = replicate_event.getAttr("epoch")
+            seq     = int(replicate_event.getAttr("seq") or 0)
+            changes = self.replication_log.since(epoch, seq)
+            if changes is None:
+                seq, tables = self.database.snapshot(ARCHIPEL_REPLICATION_TABLES)
+                self.log.info("CENTRALAGENT: sending a snapshot at change %d to %s" % (seq, iq.getFrom()))
+                rows = [[table, row] for table, columns, table_rows in tables for row in table_rows]
+                rows, token, remaining = self.read_cursors.open(rows, ARCHIPEL_REPLICATION_SNAPSHOT_CHUNK, str(iq.getFrom().getStripped()))
+                snapshot = xmpp.Node("snapshot", attrs={"epoch": self.replication_log.epoch, "seq": seq})
+                if token:
+                    snapshot.setAttr("continuation", token)
+                columns = dict((table, table_columns) for table, table_columns, table_rows in tables)
+                reply.addChild(node=encode_payload(snapshot, {"columns": columns, "rows": rows}))
+            else:
+                changes, more = changes
+                last_seq = changes[-1][0] if changes else seq
+                changes_node = xmpp.Node("changes", attrs={"epoch": epoch, "seq": last_seq, "more": str(more).lower()})
+                reply.addChild(node=encode_payload(changes_node, changes))
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
+        return reply
+
+    def is_replication_peer(self, jid):
+        """
+        Check if a central agent may replicate the database of this one, or
+        send its own: it must share the bare JID of this central agent, or be
+        listed in database_replication_peers.
+        @type jid: xmpp.JID
+        @param jid: the JID of the other central agent
+        @rtype: boolean
+        @return: True if the central agent is a replication peer
+        """
+        return str(xmpp.JID(jid).getStripped()) in self.replication_peers
+
+    def get_replication_columns(self):
+        """
+        Return the columns of the replicated tables of the local database,
+        the only ones the replicated changes may write.
+        @rtype: dict
+        @return: the columns of each replicated table
+        """
+        if not self.replication_columns:
+            self.replication_columns = {}
+            for table in ARCHIPEL_REPLICATION_TABLES:
+                self.replication_columns[table] = set(item[1] for item in self.database.request("pragma table_info('%s')" % table))
+        return self.replication_columns
+
+    def replicate(self):
+        """
+        Pull the next changes of the database of the active central agent,
+        or the next chunk of its snapshot. Called by the standby central agents.
+        """
+        now = time.time()
+        if self.replica["pending"] and now - self.replica["pending"] < ARCHIPEL_REPLICATION_TIMEOUT:
+            return
+        if not self.replica["more"] and now - self.replica["last_pull"] < self.replication_interval:
+            return
+        replicate_event = xmpp.Node("event", attrs={"jid": self.jid})
+        if self.replica["snapshot"]:
+            replicate_event.setAttr("continuation", self.replica["snapshot"]["continuation"])
+        elif self.replica["epoch"]:
+            replicate_event.setAttr("epoch", self.replica["epoch"])
+            replicate_event.setAttr("seq", self.replica["seq"])
+        iq = xmpp.Iq(typ="set", queryNS=ARCHIPEL_NS_CENTRALAGENT, to=self.central_agent_jid_val)
+        iq.getTag("query").addChild(name="archipel", attrs={"action": "replicate"})
+        iq.getTag("query").getTag("archipel").addChild(node=replicate_event)
+        self.replica["pending"] = now
+        self.replica["last_pull"] = now
+        self.xmppclient.SendAndCallForResponse(iq, self.on_replicate_reply)
+
+    def on_replicate_reply(self, conn, resp):
+        """
+        Apply the changes or the chunk of snapshot received from the active central agent.
+        @type conn: xmpp.Dispatcher
+        @param conn: the connection
+        @type resp: xmpp.Iq
+        @param resp: the reply to the replicate request
+        """
+        self.replica["pending"] = 0
+        self.replica["more"] = False
+        if self.is_central_agent:
+            return
+        if not self.is_replication_peer(resp.getFrom()):
+            self.log.warning("CENTRALAGENT: ignoring the replicated changes of %s, not a replication peer" % resp.getFrom())
+            return
+        if resp.getType() != "result":
+            self.log.warning("CENTRALAGENT: unable to replicate the database: %s" % resp.getTag("error"))
+            self.replica.update({"epoch": None, "seq": 0, "snapshot": None})
+            return
+        try:
+            if resp.getTag("snapshot"):
+                self.apply_snapshot(resp.getTag("snapshot"))
+            elif resp.getTag("changes"):
+                changes_node = resp.getTag("changes")
+                changes = []
+                for seq, statement_changes in decode_payload(changes_node) or []:
+                    changes += statement_changes
+                if changes:
+                    self.database.apply(compile_changes(changes, self.get_replication_columns()))
+                self.replica["seq"] = int(changes_node.getAttr("seq"))
+                self.replica["more"] = changes_node.getAttr("more") == "true"
+        except Exception as ex:
+            self.log.error("CENTRALAGENT: unable to apply the replicated changes, asking a new snapshot: %s" % str(ex))
+            self.replica.update({"epoch": None, "seq": 0, "snapshot": None})
+
+    def apply_snapshot(self, snapshot_node):
+        """
+        Apply a chunk of snapshot. The first chunk replaces the content of the tables.
+        @type snapshot_node: xmpp.Node
+        @param snapshot_node: the snapshot node of the reply
+        """
+        snapshot = decode_payload(snapshot_node)
+        changes = []
+        if not self.replica["snapshot"]:
+            self.create_database()
+            changes = [[table, "clear", 0, None] for table in ARCHIPEL_REPLICATION_TABLES]
+            self.replica["snapshot"] = {"epoch": snapshot_node.getAttr("epoch"), "seq": int(snapshot_node.getAttr("seq")), "columns": snapshot["columns"]}
+            self.replica["epoch"] = None
+        columns = self.replica["snapshot"]["columns"]
+        for table, row in snapshot["rows"]:
+            if not table in columns:
+                raise Exception("Unknown table %s in snapshot" % table)
+            # the first column is the rowid
+            changes.append([table, "upsert", row[0], dict(zip(columns[table][1:], row[1:]))])
+        self.database.apply(compile_changes(changes, self.get_replication_columns()))
+        if snapshot_node.getAttr("continuation"):
+            self.replica["snapshot"]["continuation"] = snapshot_node.getAttr("continuation")
+            self.replica["more"] = True
+        else:
+            self.replica.update({"epoch": self.replica["snapshot"]["epoch"], "seq": self.replica["snapshot"]["seq"], "snapshot": None})
+            self.log.info("CENTRALAGENT: database replicated from %s at change %d" % (self.central_agent_jid_val, self.replica["seq"]))
+
+    def read_table(self, table, columns=None, filters=None, order=None, limit=None, offset=None, count=False):
+        """
+        Read a table of the central db with a structured query.
+        See L{TNQueryCompiler} for the description of the arguments.
+        @type table: string
+        @param table: the table to read
+        @rtype: list
+        @return: list of dict, one per row
+        """
+        statement, params, columns = self.query_compiler.compile(table, columns, filters, order, limit, offset, count)
+        return [dict(zip(columns, row)) for row in self.database.read(statement, params)]
+
+    def open_read(self, iq, table, read_event):
+        """
+        Read the first chunk of the result of a read request, and open a
+        cursor reading the next ones from the database when they are asked:
+        with a keyset query on the rowid, or with an offset if the query is
+        ordered or limited. The whole result is returned at once if the
+        request is not chunked.
+        @type iq: xmpp.Iq
+        @param iq: the read request
+        @type table: string
+        @param table: the table to read, vms or hypervisors
+        @type read_event: xmpp.Node
+        @param read_event: the event node of the read request
+        @rtype: tuple
+        @return: (first chunk, continuation token or None, number of remaining entries)
+        """
+        chunk_size  = self.get_chunk_size(iq)
+        owner       = str(iq.getFrom().getStripped())
+
+        if not self.is_structured_query(read_event):
+            columns         = read_event.getAttr("columns") or "*"
+            where_statement = read_event.getAttr("where_statement")
+            if chunk_size is None:
+                if table == "vms":
+                    return self.read_vms(columns, where_statement), None, 0
+                return self.read_hypervisors(columns, where_statement), None, 0
+            if columns == "*":
+                columns = ARCHIPEL_CENTRALDB_VMS_COLUMNS if table == "vms" else "jid, last_seen, status"
+                names = [column.strip() for column in columns.split(",")]
+            else:
+                names = columns.split(",")
+            read_statement = "select %s, rowid from %s where rowid>?" % (columns, table)
+            count_statement = "select count(*) from %s" % table
+            if where_statement:
+                read_statement += " and (%s)" % where_statement
+                count_statement += " where %s" % where_statement
+            read_statement += " order by rowid limit ?"
+
+            def _fetch(after, count):
+                return [(row[-1], dict(zip(names, row[:-1]))) for row in self.database.read(read_statement, (after or 0, count))]
+            return self.read_cursors.open_query(_fetch, lambda: self.database.read(count_statement)[0][0], chunk_size, owner)
+
+        query = self.unpack_query(read_event)
+        if chunk_size is None:
+            return self.read_table(table, **query), None, 0
+        count_query = lambda: self.read_table(table, filters=query["filters"], count=True)[0]["count"]
+
+        if not query["order"] and query.get("limit") is None and query.get("offset") is None:
+            def _fetch(after, count):
+                statement, params, names = self.query_compiler.compile(table, query.get("columns"), query["filters"], limit=count, after_rowid=after or 0)
+                return [(row[-1], dict(zip(names[:-1], row[:-1]))) for row in self.database.read(statement, params)]
+            return self.read_cursors.open_query(_fetch, count_query, chunk_size, owner)
+
+        order = list(query["order"])
+        if not ARCHIPEL_CENTRALDB_TABLES[table]["key"] in [column for column, direction in order]:
+            order.append((ARCHIPEL_CENTRALDB_TABLES[table]["key"], "asc"))
+        limit = int(query["limit"]) if query.get("limit") is not None else None
+        offset = int(query["offset"]) if query.get("offset") is not None else 0
+
+        def _fetch(after, count):
+            position = after or 0
+            if limit is not None:
+                count = min(count, limit - position)
+            if count <= 0:
+                return []
+            entries = self.read_table(table, query.get("columns"), query["filters"], order, count, offset + position)
+            return [(position + i + 1, entry) for i, entry in enumerate(entries)]
+
+        def _count():
+            total = max(count_query() - offset, 0)
+            return min(total, limit) if limit is not None else total
+        return self.read_cursors.open_query(_fetch, _count, chunk_size, owner)
+
     def read_hypervisors(self, columns="*", where_statement=None):
         """
         Reads list of hypervisors in central db.
@@ -525,7 +1535,7 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         read_statement = "select %s from hypervisors" % columns
         if where_statement:
             read_statement += " where %s" % where_statement
-        rows = self.database.request(read_statement)
+        rows = self.database.read(read_statement)
         ret = []
         for row in rows:
             if columns == "*":
@@ -543,10 +1553,13 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         """
         Read list of vms in central db.
         """
-        read_statement = "select %s from vms" % columns
+        if columns == "*":
+            read_statement = "select %s from vms" % ARCHIPEL_CENTRALDB_VMS_COLUMNS
+        else:
+            read_statement = "select %s from vms" % columns
         if where_statement:
             read_statement += " where %s" % where_statement
-        rows = self.database.request(read_statement)
+        rows = self.database.read(read_statement)
         ret = []
         for row in rows:
             if columns == "*":
@@ -560,6 +1573,39 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
                 ret.append(res)
         return ret
 
+    def read_chunks(self, table, columns, where_statement=None, chunk_size=ARCHIPEL_CENTRALDB_READ_CHUNK_SIZE):
+        """
+        Read a table of central db by chunks, following the rowid order, so
+        the whole table is never loaded at once. Rows inserted or replaced
+        during the read may be returned at their new position.
+        @type table: string
+        @param table: the table to read
+        @type columns: string
+        @param columns: the comma separated columns to return
+        @type where_statement: string
+        @param where_statement: the optional "where" constraint
+        @type chunk_size: int
+        @param chunk_size: the maximum number of rows per chunk
+        @rtype: generator
+        @return: generator of lists of dict, one per row
+        """
+        if not table in ARCHIPEL_CENTRALDB_TABLES:
+            raise Exception("Unknown table %s" % table)
+        columns = [column.strip() for column in columns.split(",")]
+        read_statement = "select %s, rowid from %s where rowid>?" % (", ".join(columns), table)
+        if where_statement:
+            read_statement += " and (%s)" % where_statement
+        read_statement += " order by rowid limit ?"
+        last_rowid = 0
+        while True:
+            rows = self.database.read(read_statement, (last_rowid, chunk_size))
+            if not rows:
+                return
+            yield [dict(zip(columns, row[:-1])) for row in rows]
+            if len(rows) < chunk_size:
+                return
+            last_rowid = rows[-1][-1]
+
     def get_existing_vms_instances(self, entries, origin_hyp):
         """
         Based on a list of vms, and an hypervisor, return list of vms which
@@ -573,11 +1619,11 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
 
         read_statement = "select vms.uuid from vms join hypervisors on hypervisors.jid=vms.hypervisor"
         read_statement += " where vms.uuid in (%s)" % ','.join("?" * len(uuids))
-        read_statement += " and hypervisors.jid != '%s'" % origin_hyp
+        read_statement += " and hypervisors.jid != ?"
         read_statement += " and hypervisors.status='Online'"
 
         self.log.debug("CENTRALAGENT: Check if vm uuids %s exist elsewhere " % uuids)
-        for row in self.database.request(read_statement, uuids):
+        for row in self.database.read(read_statement, uuids + [str(origin_hyp)]):
             ret.append({"uuid":row[0]})
         self.log.debug("CENTRALAGENT: We found %s on %s vms existing on others hypervistors." % (len(ret), len(uuids)))
         return ret
@@ -598,7 +1644,7 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         read_statement += " and (hypervisor='None' or hypervisor not in (select jid from hypervisors where status='Online'))"
 
         self.log.debug("CENTRALDB: Get parked vms from database")
-        for row in self.database.request(read_statement, uuids):
+        for row in self.database.read(read_statement, uuids):
             ret.append({"uuid":row[0], "domain":row[1]})
         self.log.debug("CENTRALDB: We found %s parked vms" % len(ret))
         return ret
@@ -619,7 +1665,42 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         @type entries: List
         @param entries: list of vms
         """
-        self.db_commit("insert into vms values(:uuid, :parker, :creation_date, :domain, :hypervisor, :name)",entries)
+        for entry in entries:
+            if not "jid" in entry:
+                entry["jid"] = self.get_jid_from_domain(entry["domain"])
+            if not entry.get("fingerprint"):
+                entry["fingerprint"] = self.get_domain_fingerprint(entry["domain"])
+        self.db_commit("insert into vms (%s, jid, fingerprint) values(:uuid, :parker, :creation_date, :domain, :hypervisor, :name, :jid, :fingerprint)" % ARCHIPEL_CENTRALDB_VMS_COLUMNS, entries)
+
+    def sync_vms(self, entries):
+        """
+        Compare the fingerprints of the definitions of the vms of a hypervisor
+        with the ones of the central db. The vms with the same definition are
+        only reassigned to the hypervisor.
+        @type entries: List
+        @param entries: list of vms, with uuid, fingerprint, hypervisor and name
+        @rtype: list
+        @return: the list of vms whose definition must be registered
+        """
+        known_fingerprints = {}
+        for i in range(0, len(entries), ARCHIPEL_CENTRALDB_MAX_VARIABLES):
+            uuids = [entry["uuid"] for entry in entries[i:i + ARCHIPEL_CENTRALDB_MAX_VARIABLES]]
+            read_statement = "select uuid, fingerprint from vms where uuid in (%s)" % ','.join("?" * len(uuids))
+            for uuid, fingerprint in self.database.read(read_statement, uuids):
+                known_fingerprints[uuid] = fingerprint
+
+        unchanged = []
+        changed = []
+        for entry in entries:
+            if entry.get("fingerprint") and known_fingerprints.get(entry["uuid"]) == entry["fingerprint"]:
+                unchanged.append({"uuid": entry["uuid"], "hypervisor": entry["hypervisor"], "name": entry["name"]})
+            else:
+                changed.append({"uuid": entry["uuid"]})
+
+        self.log.debug("CENTRALAGENT: sync of %d vms, %d definitions to register" % (len(entries), len(changed)))
+        if unchanged:
+            self.db_commit("update vms set hypervisor=:hypervisor, name=:name, parker=null, creation_date=null where uuid=:uuid", unchanged)
+        return changed
 
     def update_vms(self,entries):
         """
@@ -690,11 +1771,11 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
                     self.log.debug("CENTRALAGENT: previous description : %s" % str(previous_description))
                     new_domain.addChild(node=old_domain.getTag("description"))
                     result = "Central database updated with new information"
-                    entries_to_commit.append({"uuid": uuid, "domain": str(new_domain)})
+                    entries_to_commit.append({"uuid": uuid, "domain": str(new_domain), "fingerprint": self.get_domain_fingerprint(str(new_domain))})
                 results.append({"result": result, "uuid": uuid, "error": error})
 
         if len(entries_to_commit) > 0:
-            command = "update vms set domain=:domain where uuid=:uuid"
+            command = "update vms set domain=:domain, fingerprint=:fingerprint where uuid=:uuid"
             self.db_commit(command, entries_to_commit)
         return results
 
@@ -711,6 +1792,23 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         command = "update hypervisors set %s where jid=:jid" % (", ".join(update_snipplets))
         self.db_commit(command, entries)
 
+    def flush_stats(self):
+        """
+        Write the coalesced statistics updates of the hypervisors, one
+        batched statement per set of updated columns.
+        """
+        statements = {}
+        flushed = self.stats_buffer.flush()
+        for entry in flushed:
+            statements.setdefault(tuple(sorted(entry.keys())), []).append(entry)
+        for entries in statements.values():
+            self.update_hypervisors(entries)
+        if self.stats_history:
+            self.stats_history.append(flushed, time.time())
+        if statements:
+            self.log.debug("CENTRALAGENT: flushed the statistics of %d hypervisors" % sum(len(entries) for entries in statements.values()))
+        self.last_stats_flush = time.time()
+
     def unregister_hypervisors(self,entries):
         """
         Unregister a list of hypervisors from central db.
@@ -725,26 +1823,49 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         @type entries: List
         @param entries: list of vms
         """
-        # first, we extract jid so that the hypervisor can unregister them
+        # first, we get the jid so that the hypervisor can unregister them
         uuids = []
         for entry in entries:
             uuids.append(entry["uuid"])
-        where_statement = "uuid = '"
-        where_statement += "' or uuid='".join(uuids)
-        where_statement += "'"
 
         # list of vms which have been found in central db, including uuid and jid
-        cleaned_entries = self.read_vms("uuid,domain", where_statement)
-        for i in range(len(cleaned_entries)):
-            domain_xml = cleaned_entries[i]["domain"]
-            if domain_xml != "None":
-                domain = xmpp.simplexml.NodeBuilder(data=cleaned_entries[i]["domain"]).getDom()
-                cleaned_entries[i]["jid"] = xmpp.JID(domain.getTag("description").getData().split("::::")[0])
-                del(cleaned_entries[i]["domain"])
+        cleaned_entries = []
+        read_statement = "select uuid, jid from vms where uuid in (%s)" % ','.join("?" * len(uuids))
+        for uuid, jid in self.database.read(read_statement, uuids):
+            if jid:
+                cleaned_entries.append({"uuid": uuid, "jid": xmpp.JID(jid)})
+            else:
+                cleaned_entries.append({"uuid": uuid, "domain": "None"})
 
         self.db_commit("delete from vms where uuid=:uuid",cleaned_entries)
         return cleaned_entries
 
+    def get_jid_from_domain(self, domain_xml):
+        """
+        Extract the JID of the vm from the description of its domain.
+        @type domain_xml: string
+        @param domain_xml: the XML description of the domain
+        @rtype: string
+        @return: the bare JID of the vm, or None if it is not in the description
+        """
+        if not domain_xml or domain_xml == "None":
+            return None
+        try:
+            domain = xmpp.simplexml.NodeBuilder(data=str(domain_xml)).getDom()
+            return domain.getTag("description").getData().split("::::")[0]
+        except Exception:
+            return None
+
+    def get_domain_fingerprint(self, domain_xml):
+        """
+        Return the fingerprint of the definition of a vm, the same way the hypervisors compute it.
+        @type domain_xml: string
+        @param domain_xml: the XML description of the domain
+        @rtype: string
+        @return: the SHA1 of the description, or None if there is none
+        """
+        return get_domain_fingerprint(domain_xml)
+
     def unpack_entries(self, iq):
         """
         Unpack the list of entries from iq for database processing.
@@ -754,20 +1875,104 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         central_database_event = iq.getTag("query").getTag("archipel").getTag("event")
         entries = []
         for entry in central_database_event.getChildren():
+            if is_compact_entries_node(entry):
+                entries.extend(unpack_compact_entries(entry))
+                continue
             entry_dict = {}
             for entry_val in entry.getChildren():
                 entry_dict[entry_val.getAttr("key")] = entry_val.getAttr("value")
             entries.append(entry_dict)
         return entries
 
-    def pack_entries(self, entries):
+    def is_structured_query(self, read_event):
+        """
+        Check if a read event contains a structured query instead of a where_statement.
+        @type read_event: xmpp.Node
+        @param read_event: the event node of the read request
+        @rtype: bool
+        @return: True if the event uses filter, order or limit nodes
+        """
+        return bool(read_event.getTags("filter") or read_event.getTags("order") or read_event.getTag("limit"))
+
+    def unpack_query(self, read_event):
+        """
+        Unpack a structured query from a read event:
+            <event columns="uuid,name">
+                <filter column="name" operator="like" value="vm%"/>
+                <filter column="uuid" operator="in"><value value="..."/></filter>
+                <filter column="name" operator="after"><value value="name"/><value value="uuid"/></filter>
+                <order column="name" direction="asc"/>
+                <limit count="30" offset="0"/>
+            </event>
+        @type read_event: xmpp.Node
+        @param read_event: the event node of the read request
+        @rtype: dict
+        @return: the arguments of L{TNArchipelCentralAgent.read_table}
+        """
+        query = {"filters": [], "order": []}
+        if read_event.getAttr("columns") and read_event.getAttr("columns") != "*":
+            query["columns"] = [column.strip() for column in read_event.getAttr("columns").split(",")]
+        for filter_node in read_event.getTags("filter"):
+            operator = filter_node.getAttr("operator") or "="
+            if operator in ("in", "after"):
+                value = [value_node.getAttr("value") for value_node in filter_node.getTags("value")]
+            else:
+                value = filter_node.getAttr("value")
+            query["filters"].append((filter_node.getAttr("column"), operator, value))
+        for order_node in read_event.getTags("order"):
+            query["order"].append((order_node.getAttr("column"), order_node.getAttr("direction") or "asc"))
+        limit_node = read_event.getTag("limit")
+        if limit_node:
+            query["limit"] = limit_node.getAttr("count")
+            query["offset"] = limit_node.getAttr("offset")
+        return query
+
+    def get_chunk_size(self, iq):
+        """
+        Return the number of entries to reply at once to a read request.
+        @type iq: xmpp.Iq
+        @param iq: the read request
+        @rtype: int
+        @return: the chunk size asked by the request, None if the request is not chunked
+        """
+        chunk_size = iq.getTag("query").getTag("archipel").getAttr("chunk_size")
+        if not chunk_size:
+            return None
+        return max(1, min(int(chunk_size), ARCHIPEL_CENTRALDB_MAX_CHUNK_SIZE))
+
+    def add_chunk_to_reply(self, iq, reply, entries, token, remaining):
+        """
+        Add a chunk of a read to its reply, with the continuation token if
+        there are more entries to read.
+        @type iq: xmpp.Iq
+        @param iq: the read request
+        @type reply: xmpp.Iq
+        @param reply: the reply to the read request
+        @type entries: list
+        @param entries: the entries of the chunk
+        @type token: string
+        @param token: the continuation token, None if this is the last chunk
+        @type remaining: int
+        @param remaining: the number of entries left to read
+        """
+        for entry in self.pack_entries(entries, iq):
+            reply.addChild(node=entry)
+        if token:
+            reply.addChild("continuation", attrs={"token": token, "remaining": remaining})
+
+    def pack_entries(self, entries, iq=None):
         """
-        Pack the list of entries to send to remote entity.
+        Pack the list of entries to send to remote entity. If the request
+        announces the compact encoding, the entries are packed in one node.
         @rtype: list
-        @return: list of xmpp nodes, one per entry
+        @return: list of xmpp nodes, one per entry, or one compact node
         @type entries: list
         @param entries: list of dict entities
+        @type iq: xmpp.Iq
+        @param iq: the request the entries reply to
         """
+        if iq and ARCHIPEL_ENTRIES_ENCODING_COMPACT in get_encodings(iq.getTag("query").getTag("archipel")):
+            return [pack_compact_entries(entries)]
         packed_entries = []
         for entry in entries:
             entryTag = xmpp.Node(tag="entry")
@@ -779,29 +1984,48 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
     def db_commit(self, command, entries):
         if self.is_central_agent:
             self.log.debug("CENTRALAGENT: commit '%s' with entries %s" % (command, entries))
-            for entry in entries:
-                self.database.execute(command, entry)
+            self.database.executemany(command, entries)
         else:
             raise Exception("CENTRALAGENT: we are not central agent")
 
+    def load_liveness(self):
+        """
+        Load the last time each hypervisor has been seen from the database.
+        """
+        hypervisors = []
+        for jid, last_seen, status in self.database.request("select jid,last_seen,status from hypervisors;"):
+            try:
+                last_seen_date = datetime.datetime.strptime(last_seen, "%Y-%m-%d %H:%M:%S.%f")
+                last_seen_time = time.mktime(last_seen_date.timetuple()) + last_seen_date.microsecond / 1000000.0
+            except Exception:
+                last_seen_time = 0
+            hypervisors.append((jid, last_seen_time, status))
+        self.liveness_tracker.load(hypervisors)
+
+    def is_central_agent_lost(self):
+        """
+        Check if there is no active central agent. At start, we wait one
+        keepalive interval to hear an already started one.
+        @rtype: bool
+        @return: True if no keepalive has been heard for too long
+        """
+        if self.central_agent_jid_val:
+            timeout = self.active_keepalive_interval * 2
+        else:
+            timeout = self.keepalive_interval
+        return (datetime.datetime.now() - self.last_keepalive_heard).total_seconds() > timeout
+
     def check_hyps(self):
         """
-        Check that hypervisors are alive.
+        Check that hypervisors are alive. Only the hypervisors which timed out
+        since the last check are written in the database.
         """
         self.log.debug("CENTRALAGENT: Checking hypervisors state")
-        now                  = datetime.datetime.now()
-        rows                 = self.database.request("select jid,last_seen,status from hypervisors;")
         hypervisor_to_update = []
 
-        for row in rows:
-            jid, last_seen, status = row
-            last_seen_date = datetime.datetime.strptime(last_seen, "%Y-%m-%d %H:%M:%S.%f")
-            if (now - last_seen_date).total_seconds() > self.hypervisor_timeout_threshold and status == "Online":
-                self.log.warning("CENTRALAGENT: Hypervisor %s timed out" % jid)
-                hypervisor_to_update.append({"jid": jid, "status": "Unreachable"})
-            elif (now - last_seen_date).total_seconds() <= self.hypervisor_timeout_threshold and status == "Unreachable":
-                self.log.info("CENTRALAGENT: Hypervisor %s is back up Online" % jid)
-                hypervisor_to_update.append({"jid": jid, "status": "Online"})
+        for jid in self.liveness_tracker.expire(time.time()):
+            self.log.warning("CENTRALAGENT: Hypervisor %s timed out" % jid)
+            hypervisor_to_update.append({"jid": jid, "status": "Unreachable"})
 
         if hypervisor_to_update:
             self.update_hypervisors(hypervisor_to_update)
@@ -814,31 +2038,73 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         """
         Create, Update and / or recover the parking database
         """
-        self.database.execute("create table if not exists vms (uuid text unique on conflict replace, parker string, creation_date date, domain string, hypervisor string, name string)")
+        self.create_database()
+        self.database.execute("update vms set hypervisor='None';")
+
+    def create_database(self):
+        """
+        Create and / or update the tables of the database
+        """
+        self.database.execute("create table if not exists vms (uuid text unique on conflict replace, parker string, creation_date date, domain string, hypervisor string, name string, jid string, fingerprint string)")
         self.database.execute("create table if not exists hypervisors (jid text unique on conflict replace, last_seen date, status string, stat1 int, stat2 int, stat3 int)")
+        self.database.execute("create table if not exists hypervisors_stats (jid string, resolution int, timestamp real, count int, stat1 real, stat2 real, stat3 real)")
         self.updatedb()
-        self.database.execute("update vms set hypervisor='None';")
 
     def updatedb(self):
         """
-        Check if we need to alter table and fill it with proper value
+        Check if we need to alter table and fill it with proper value.
+        The revision of the schema is stored in the user_version of the
+        database, and each revision is applied in place:
+            - 1: add the name column
+            - 2: add the jid column, and the indexes used by the queries
+            - 3: index (name, uuid) for the keyset pagination of the vms
+            - 4: add the fingerprint column, the SHA1 of the domain
+            - 5: index of the hypervisors_stats table
         """
-        need_update = True
-        for item in self.database.request("pragma table_info('vms')"):
-            if item[1] == 'name':
-                need_update = False
+        version = list(self.database.request("pragma user_version"))[0][0]
+        if version >= ARCHIPEL_CENTRALDB_SCHEMA_VERSION:
+            return
+
+        self.log.info("Migrating database from schema revision %d to %d" % (version, ARCHIPEL_CENTRALDB_SCHEMA_VERSION))
+        vms_columns = [item[1] for item in self.database.request("pragma table_info('vms')")]
 
-        if need_update:
-            self.log.info("Migrating database to new schema")
+        if not 'name' in vms_columns:
             self.database.execute("alter table vms add column 'name' 'string'")
             # Populate this new value
-            for row in self.database.request('select * from vms'):
-                if row[3] != 'None':
-                    xml = xmpp.simplexml.NodeBuilder(row[3]).getDom()
+            names = []
+            for row in self.database.request('select uuid, domain from vms'):
+                if row[1] != 'None':
+                    xml = xmpp.simplexml.NodeBuilder(row[1]).getDom()
                     name = xml.getTag("name").getData()
                 else:
                     name = row[0]
-                self.database.execute("update vms set name='%s' where uuid =='%s'" % (name, row[0]))
+                names.append({"uuid": row[0], "name": name})
+            self.database.executemany("update vms set name=:name where uuid=:uuid", names)
+
+        if not 'jid' in vms_columns:
+            self.database.execute("alter table vms add column 'jid' 'string'")
+            # Populate this new value
+            jids = []
+            for row in self.database.request('select uuid, domain from vms'):
+                jids.append({"uuid": row[0], "jid": self.get_jid_from_domain(row[1])})
+            self.database.executemany("update vms set jid=:jid where uuid=:uuid", jids)
+
+        if not 'fingerprint' in vms_columns:
+            self.database.execute("alter table vms add column 'fingerprint' 'string'")
+            # Populate this new value
+            fingerprints = []
+            for row in self.database.request('select uuid, domain from vms'):
+                fingerprints.append({"uuid": row[0], "fingerprint": self.get_domain_fingerprint(row[1])})
+            self.database.executemany("update vms set fingerprint=:fingerprint where uuid=:uuid", fingerprints)
+
+        self.database.execute("create index if not exists vms_hypervisor on vms (hypervisor)")
+        self.database.execute("drop index if exists vms_name")
+        self.database.execute("create index if not exists vms_name_uuid on vms (name, uuid)")
+        self.database.execute("create index if not exists vms_name_nocase on vms (name collate nocase)")
+        self.database.execute("create index if not exists vms_jid on vms (jid)")
+        self.database.execute("create index if not exists hypervisors_status on hypervisors (status)")
+        self.database.execute("create index if not exists hypervisors_stats_resolution_timestamp on hypervisors_stats (resolution, timestamp)")
+        self.database.execute("pragma user_version=%d" % ARCHIPEL_CENTRALDB_SCHEMA_VERSION)
 
     # Event loop
 
@@ -846,13 +2112,22 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
 
         if self.xmpp_authenticated:
 
-            if not self.is_central_agent and self.central_agent_mode == "auto":
-                self.become_central_agent()
-            elif self.is_central_agent:
+            if not self.is_central_agent:
+                if self.central_agent_mode == "auto" and self.is_central_agent_lost():
+                    self.become_central_agent()
+                elif self.replication_enabled and self.central_agent_jid_val and self.central_agent_jid_val != self.jid and self.is_replication_peer(self.central_agent_jid_val):
+                    self.replicate()
+            else:
                 if (datetime.datetime.now() - self.last_keepalive_sent).total_seconds() >= self.keepalive_interval:
                     self.central_keepalive_pubsub.add_item(self.keepalive_event_with_date())
                     self.last_keepalive_sent = datetime.datetime.now()
 
+                if time.time() - self.last_stats_flush >= self.stats_flush_interval:
+                    self.flush_stats()
+
+                if self.stats_history and time.time() - self.stats_history.last_rollup >= ARCHIPEL_STATS_ROLLUP_INTERVAL:
+                    self.stats_history.rollup(time.time())
+
                 if self.ping_hypervisors:
                     if (datetime.datetime.now() - self.last_hyp_check).total_seconds() >= self.hypervisor_check_interval:
                         self.check_hyps()
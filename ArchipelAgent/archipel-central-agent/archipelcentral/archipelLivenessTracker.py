@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#
+# archipelLivenessTracker.py
+#
+# Copyright (C) 2013 Nicolas Ochem <nicolas.ochem@free.fr>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNHypervisorLivenessTracker}, the in memory liveness of the
+hypervisors known by the central agent.
+"""
+
+import heapq
+import threading
+
+
+ARCHIPEL_HYPERVISOR_STATUS_ONLINE       = "Online"
+ARCHIPEL_HYPERVISOR_STATUS_UNREACHABLE  = "Unreachable"
+
+
+class TNHypervisorLivenessTracker (object):
+    """
+    Keeps the last time each hypervisor has been seen, and a heap of their
+    deadlines. Checking the liveness only pops the expired deadlines, and
+    returns the hypervisors changing status, so the caller only has to
+    persist the transitions.
+    Deadlines of hypervisors seen again are left in the heap and skipped
+    when they are popped.
+    """
+
+    def __init__(self, timeout):
+        """
+        Initialize the TNHypervisorLivenessTracker.
+        @type timeout: float
+        @param timeout: the number of seconds after which a silent hypervisor is unreachable
+        """
+        self.timeout    = timeout
+        self.last_seen  = {}
+        self.status     = {}
+        self.deadlines  = []
+        self.lock       = threading.Lock()
+
+    def load(self, hypervisors):
+        """
+        Replace the tracked hypervisors.
+        @type hypervisors: list
+        @param hypervisors: list of (jid, last seen timestamp, status)
+        """
+        with self.lock:
+            self.last_seen  = {}
+            self.status     = {}
+            self.deadlines  = []
+            for jid, last_seen, status in hypervisors:
+                self.last_seen[jid] = last_seen
+                self.status[jid] = status
+                self.deadlines.append((last_seen + self.timeout, jid))
+            heapq.heapify(self.deadlines)
+
+    def seen(self, jid, now, status=None):
+        """
+        Record that a hypervisor has been seen.
+        @type jid: string
+        @param jid: the JID of the hypervisor
+        @type now: float
+        @param now: the current timestamp
+        @type status: string
+        @param status: the status sent by the hypervisor, if any
+        @rtype: bool
+        @return: True if the hypervisor was unreachable and is now back online
+        """
+        with self.lock:
+            previous_status = self.status.get(jid)
+            if status:
+                self.status[jid] = status
+            self.last_seen[jid] = now
+            heapq.heappush(self.deadlines, (now + self.timeout, jid))
+            if not status and previous_status == ARCHIPEL_HYPERVISOR_STATUS_UNREACHABLE:
+                self.status[jid] = ARCHIPEL_HYPERVISOR_STATUS_ONLINE
+                return True
+            return False
+
+    def forget(self, jid):
+        """
+        Stop tracking a hypervisor.
+        @type jid: string
+        @param jid: the JID of the hypervisor
+        """
+        with self.lock:
+            self.last_seen.pop(jid, None)
+            self.status.pop(jid, None)
+
+    def expire(self, now):
+        """
+        Pop the expired deadlines.
+        @type now: float
+        @param now: the current timestamp
+        @rtype: list
+        @return: the JIDs of the online hypervisors which are now unreachable
+        """
+        timed_out = []
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] < now:
+                deadline, jid = heapq.heappop(self.deadlines)
+                if not jid in self.last_seen or self.last_seen[jid] + self.timeout != deadline:
+                    continue
+                if self.status[jid] == ARCHIPEL_HYPERVISOR_STATUS_ONLINE:
+                    self.status[jid] = ARCHIPEL_HYPERVISOR_STATUS_UNREACHABLE
+                    timed_out.append(jid)
+        return timed_out
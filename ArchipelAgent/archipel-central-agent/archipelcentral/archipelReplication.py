@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+#
+# archipelReplication.py
+#
+# Copyright (C) 2013 Nicolas Ochem <nicolas.ochem@free.fr>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNReplicationLog}, the log of the writes of the active central
+agent, shipped to the standby central agents.
+
+The log does not contain the statements, but the rows they changed: each
+change is [table, "upsert", rowid, {column: value}] or [table, "delete",
+rowid, None]. The standby central agents build the statements applying them
+with L{compile_changes}, only for the replicated tables and their columns,
+and keep the same rowids as the active central agent.
+
+The standby central agents pull the log with "replicate" requests carrying
+the epoch and the sequence number of the last change they applied. When the
+log cannot continue their replica (first pull, other epoch, changes already
+dropped from the log), they get a snapshot of the tables instead, in chunks.
+"""
+
+import itertools
+import threading
+from collections import deque
+from uuid import uuid4
+
+
+ARCHIPEL_REPLICATION_LOG_ROWS           = 20000
+ARCHIPEL_REPLICATION_MAX_ROWS           = 2000
+ARCHIPEL_REPLICATION_SNAPSHOT_CHUNK     = 500
+ARCHIPEL_REPLICATION_DEFAULT_INTERVAL   = 2.0
+ARCHIPEL_REPLICATION_TIMEOUT            = 60.0
+ARCHIPEL_REPLICATION_TABLES             = ("vms", "hypervisors", "hypervisors_stats")
+
+
+class TNReplicationLog (object):
+    """
+    Keeps the rows changed by the last write statements executed on the
+    central database, with a sequence number per statement. The log is bounded
+    by the number of rows changed; the oldest statements are dropped first.
+    Each log has its own epoch, so a replica of another active central agent
+    is never continued.
+    """
+
+    def __init__(self, max_rows=ARCHIPEL_REPLICATION_LOG_ROWS):
+        """
+        Initialize the TNReplicationLog.
+        @type max_rows: int
+        @param max_rows: the maximum number of rows written by the kept statements
+        """
+        self.epoch      = uuid4().hex
+        self.seq        = 0
+        self.max_rows   = max_rows
+        self.rows       = 0
+        self.changes    = deque()
+        self.lock       = threading.Lock()
+
+    def append(self, changes):
+        """
+        Add the changes of a write statement to the log.
+        @type changes: list
+        @param changes: the rows changed by the statement, as [table, op, rowid, values]
+        @rtype: int
+        @return: the sequence number of the statement
+        """
+        rows = max(len(changes), 1)
+        with self.lock:
+            self.seq += 1
+            self.changes.append((self.seq, changes, rows))
+            self.rows += rows
+            while self.rows > self.max_rows and len(self.changes) > 1:
+                self.rows -= self.changes.popleft()[2]
+            return self.seq
+
+    def reset(self):
+        """
+        Start a new epoch, when the changes of the log may not have been
+        committed. The standby central agents will ask a new snapshot.
+        """
+        with self.lock:
+            self.epoch  = uuid4().hex
+            self.seq    = 0
+            self.rows   = 0
+            self.changes.clear()
+
+    def since(self, epoch, seq, max_rows=ARCHIPEL_REPLICATION_MAX_ROWS):
+        """
+        Return the changes of the statements following a given one.
+        @type epoch: string
+        @param epoch: the epoch of the replica
+        @type seq: int
+        @param seq: the sequence number of the last statement of the replica
+        @type max_rows: int
+        @param max_rows: the maximum number of rows written by the returned statements,
+                         at least one statement is returned
+        @rtype: tuple
+        @return: (list of (seq, changes), True if there are more statements),
+                 or None if the replica cannot be continued from this log
+        """
+        with self.lock:
+            if epoch != self.epoch or seq > self.seq:
+                return None
+            if seq == self.seq:
+                return [], False
+            if not self.changes or self.changes[0][0] > seq + 1:
+                return None
+            changes = []
+            rows = 0
+            for change_seq, statement_changes, change_rows in itertools.islice(self.changes, seq + 1 - self.changes[0][0], None):
+                if changes and rows + change_rows > max_rows:
+                    return changes, True
+                changes.append((change_seq, statement_changes))
+                rows += change_rows
+            return changes, False
+
+
+def compile_changes(changes, columns):
+    """
+    Build the statements applying replicated changes. Only the replicated
+    tables and their columns are accepted, nothing from the changes is put
+    in the statements but the names checked against them.
+    @type changes: list
+    @param changes: list of [table, op, rowid, values], op being "upsert", "delete" or "clear"
+    @type columns: dict
+    @param columns: the columns of each replicated table of the local database
+    @rtype: list
+    @return: list of (statement, parameters)
+    """
+    statements = []
+    for table, op, rowid, values in changes:
+        if not table in ARCHIPEL_REPLICATION_TABLES:
+            raise Exception("Table %s is not replicated" % table)
+        if op == "upsert":
+            names = sorted(values.keys())
+            for name in names:
+                if not name in columns[table]:
+                    raise Exception("Unknown column %s in table %s" % (name, table))
+            statements.append(("insert or replace into %s (rowid, %s) values (?, %s)" % (table, ", ".join(names), ", ".join("?" * len(names))),
+                               [int(rowid)] + [values[name] for name in names]))
+        elif op == "delete":
+            statements.append(("delete from %s where rowid=?" % table, (int(rowid),)))
+        elif op == "clear":
+            statements.append(("delete from %s" % table, ()))
+        else:
+            raise Exception("Unknown replication operation %s" % op)
+    return statements
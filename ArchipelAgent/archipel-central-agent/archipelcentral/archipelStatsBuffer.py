@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# archipelStatsBuffer.py
+#
+# Copyright (C) 2013 Nicolas Ochem <nicolas.ochem@free.fr>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNHypervisorStatsBuffer}, the buffer coalescing the statistics
+updates sent by the hypervisors to the central agent.
+"""
+
+import threading
+
+
+ARCHIPEL_STATS_DEFAULT_FLUSH_INTERVAL   = 5.0
+
+
+class TNHypervisorStatsBuffer (object):
+    """
+    Merges the statistics updates of the hypervisors until they are flushed
+    to the database. Only the latest value of each column is kept, so a
+    hypervisor updated several times during the window is written once.
+    The latest values stay available in memory after the flush.
+    """
+
+    def __init__(self):
+        """
+        Initialize the TNHypervisorStatsBuffer.
+        """
+        self.pending    = {}
+        self.latest     = {}
+        self.lock       = threading.Lock()
+
+    def add(self, entry):
+        """
+        Merge a statistics update.
+        @type entry: dict
+        @param entry: the update, with the "jid" key of the hypervisor
+        """
+        jid = entry["jid"]
+        with self.lock:
+            self.pending.setdefault(jid, {}).update(entry)
+            self.latest.setdefault(jid, {}).update(entry)
+
+    def flush(self):
+        """
+        Return the pending updates and empty the buffer.
+        @rtype: list
+        @return: list of dict, one per updated hypervisor
+        """
+        with self.lock:
+            pending = self.pending.values()
+            self.pending = {}
+        return pending
+
+    def forget(self, jid):
+        """
+        Drop the updates of a hypervisor.
+        @type jid: string
+        @param jid: the JID of the hypervisor
+        """
+        with self.lock:
+            self.pending.pop(jid, None)
+            self.latest.pop(jid, None)
+
+    def clear(self):
+        """
+        Drop all the updates.
+        """
+        with self.lock:
+            self.pending = {}
+            self.latest = {}
+
+    def get_latest(self, jid=None):
+        """
+        Return the latest statistics received.
+        @type jid: string
+        @param jid: the JID of a hypervisor, None for all of them
+        @rtype: dict
+        @return: the latest values of the hypervisor, or a dict of them by JID
+        """
+        with self.lock:
+            if jid:
+                return dict(self.latest.get(jid, {}))
+            return dict((hypervisor, dict(values)) for hypervisor, values in self.latest.iteritems())
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# archipelStatsHistory.py
+#
+# Copyright (C) 2013 Nicolas Ochem <nicolas.ochem@free.fr>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNHypervisorStatsHistory}, the history of the statistics of the
+hypervisors kept in the central database.
+
+The statistics are appended to the hypervisors_stats table at each flush of
+the statistics buffer (resolution 0, raw), then averaged by minute
+(resolution 60) and by hour (resolution 3600). Each resolution has its own
+retention. The rollups are weighted by the number of raw samples they
+summarize, kept in the count column.
+"""
+
+import time
+
+
+ARCHIPEL_STATS_RESOLUTION_RAW           = 0
+ARCHIPEL_STATS_RESOLUTION_MINUTE        = 60
+ARCHIPEL_STATS_RESOLUTION_HOUR          = 3600
+ARCHIPEL_STATS_RESOLUTIONS              = {"raw": ARCHIPEL_STATS_RESOLUTION_RAW,
+                                           "minute": ARCHIPEL_STATS_RESOLUTION_MINUTE,
+                                           "hour": ARCHIPEL_STATS_RESOLUTION_HOUR}
+# (resolution, resolution it is computed from)
+ARCHIPEL_STATS_ROLLUPS                  = ((ARCHIPEL_STATS_RESOLUTION_MINUTE, ARCHIPEL_STATS_RESOLUTION_RAW),
+                                           (ARCHIPEL_STATS_RESOLUTION_HOUR, ARCHIPEL_STATS_RESOLUTION_MINUTE))
+ARCHIPEL_STATS_DEFAULT_RETENTIONS       = {ARCHIPEL_STATS_RESOLUTION_RAW: 3600,
+                                           ARCHIPEL_STATS_RESOLUTION_MINUTE: 86400,
+                                           ARCHIPEL_STATS_RESOLUTION_HOUR: 2592000}
+ARCHIPEL_STATS_ROLLUP_INTERVAL          = 60
+ARCHIPEL_STATS_COLUMNS                  = ("stat1", "stat2", "stat3")
+
+
+class TNHypervisorStatsHistory (object):
+    """
+    Appends the statistics of the hypervisors to the central database,
+    rolls them up and applies the retentions. The writes go through the
+    database controller, so they are replicated like the other ones.
+    """
+
+    def __init__(self, database, retentions=None, rollup_delay=0):
+        """
+        Initialize the TNHypervisorStatsHistory.
+        @type database: L{TNDBController}
+        @param database: the central database
+        @type retentions: dict
+        @param retentions: the number of seconds each resolution is kept, the default ones for the missing resolutions
+        @type rollup_delay: float
+        @param rollup_delay: the number of seconds to wait before rolling up a period, so its samples are all written
+        """
+        self.database       = database
+        self.retentions     = dict(ARCHIPEL_STATS_DEFAULT_RETENTIONS)
+        self.retentions.update(retentions or {})
+        self.rollup_delay   = rollup_delay
+        self.rolled_up      = {}
+        self.last_rollup    = 0
+
+    def load(self):
+        """
+        Find the end of the last rollup of each resolution, so the rollups
+        continue where the previous central agent stopped.
+        """
+        self.rolled_up = {}
+        for resolution, source in ARCHIPEL_STATS_ROLLUPS:
+            last = list(self.database.request("select max(timestamp) from hypervisors_stats where resolution=?", (resolution,)))[0][0]
+            if last is not None:
+                self.rolled_up[resolution] = last + resolution
+        self.last_rollup = 0
+
+    def append(self, entries, now):
+        """
+        Append raw statistics.
+        @type entries: list
+        @param entries: list of dict, with the "jid" of the hypervisor and its statistics
+        @type now: float
+        @param now: the timestamp of the statistics
+        """
+        rows = []
+        for entry in entries:
+            if not any(column in entry for column in ARCHIPEL_STATS_COLUMNS):
+                continue
+            row = {"jid": entry["jid"], "timestamp": now}
+            for column in ARCHIPEL_STATS_COLUMNS:
+                row[column] = entry.get(column)
+            rows.append(row)
+        if rows:
+            self.database.executemany("insert into hypervisors_stats (jid, resolution, timestamp, count, stat1, stat2, stat3) values (:jid, 0, :timestamp, 1, :stat1, :stat2, :stat3)", rows)
+
+    def rollup(self, now):
+        """
+        Roll up the complete periods, then delete the rows older than the
+        retention of their resolution.
+        @type now: float
+        @param now: the current timestamp
+        """
+        for resolution, source in ARCHIPEL_STATS_ROLLUPS:
+            end = int((now - self.rollup_delay) / resolution) * resolution
+            start = self.rolled_up.get(resolution)
+            if start is None:
+                first = list(self.database.request("select min(timestamp) from hypervisors_stats where resolution=?", (source,)))[0][0]
+                if first is None:
+                    continue
+                start = int(first / resolution) * resolution
+            if start >= end:
+                continue
+            averages = ", ".join("sum(%s * count) / sum(count)" % column for column in ARCHIPEL_STATS_COLUMNS)
+            self.database.execute("insert into hypervisors_stats (jid, resolution, timestamp, count, %s) \
+                                   select jid, :resolution, cast(timestamp / :resolution as integer) * :resolution, sum(count), %s \
+                                   from hypervisors_stats where resolution=:source and timestamp>=:start and timestamp<:end \
+                                   group by jid, cast(timestamp / :resolution as integer)" % (", ".join(ARCHIPEL_STATS_COLUMNS), averages),
+                                  {"resolution": resolution, "source": source, "start": start, "end": end})
+            self.rolled_up[resolution] = end
+        for resolution, retention in self.retentions.iteritems():
+            self.database.execute("delete from hypervisors_stats where resolution=? and timestamp<?", (resolution, now - retention))
+        self.last_rollup = now
+
+    def get_resolution(self, start, now):
+        """
+        Return the finest resolution still kept at a given time.
+        @type start: float
+        @param start: the timestamp
+        @type now: float
+        @param now: the current timestamp
+        @rtype: int
+        @return: the resolution
+        """
+        for resolution in sorted(self.retentions.keys()):
+            if now - start <= self.retentions[resolution]:
+                return resolution
+        return max(self.retentions.keys())
+
+    def query(self, start=None, end=None, resolution=None, jid=None):
+        """
+        Return the statistics of the whole cluster, aggregated by period. For
+        the raw resolution, a period is a flush of the statistics buffer.
+        @type start: float
+        @param start: the timestamp of the first period, one hour ago by default
+        @type end: float
+        @param end: the timestamp after the last period, now by default
+        @type resolution: int
+        @param resolution: the resolution, the finest one kept at start if None
+        @type jid: string
+        @param jid: only aggregate the statistics of this hypervisor
+        @rtype: list
+        @return: list of dict, one per period, with the timestamp, the number of hypervisors,
+                 and the sum, average, minimum and maximum of each statistic
+        """
+        now = time.time()
+        end = end if end is not None else now
+        start = start if start is not None else end - ARCHIPEL_STATS_RESOLUTION_HOUR
+        if resolution is None:
+            resolution = self.get_resolution(start, now)
+        aggregates = []
+        names = ["timestamp", "hypervisors"]
+        for column in ARCHIPEL_STATS_COLUMNS:
+            for function in ("sum", "avg", "min", "max"):
+                aggregates.append("%s(%s)" % (function, column))
+                names.append("%s_%s" % (column, function))
+        statement = "select timestamp, count(distinct jid), %s from hypervisors_stats where resolution=? and timestamp>=? and timestamp<?" % ", ".join(aggregates)
+        params = [resolution, start, end]
+        if jid:
+            statement += " and jid=?"
+            params.append(jid)
+        statement += " group by timestamp order by timestamp"
+        return [dict(zip(names, row)) for row in self.database.read(statement, tuple(params))]
@@ -90,7 +90,8 @@ setup(name='archipel-central-agent',
         """,
       scripts = [
         'install/bin/runcentralagent',
-        'install/bin/archipel-central-agent-initinstall'
+        'install/bin/archipel-central-agent-initinstall',
+        'install/bin/archipel-central-agent-benchmark'
         ],
       data_files=[
         ('install/var/lib/archipel/avatars'             , create_avatar_list("install/var/lib/archipel/avatars/")),
@@ -35,7 +35,7 @@ from pkg_resources import iter_entry_points,load_entry_point
 
 from archipelcore.archipelAvatarControllableEntity import TNAvatarControllableEntity
 from archipelcore.archipelFileTransferCapableEntity import TNFileTransferCapableEntity
-from archipelcore.archipelHookableEntity import TNHookableEntity
+from archipelcore.archipelHookableEntity import TNHookableEntity, get_hook_worker_pool
 from archipelcore.archipelPermissionCenter import TNArchipelPermissionCenter
 from archipelcore.archipelRosterQueryableEntity import TNRosterQueryableEntity
 from archipelcore.archipelTaggableEntity import TNTaggableEntity
@@ -116,6 +116,8 @@ class TNArchipelEntity (object):
         self.auto_register          = auto_register
         self.auto_reconnect         = auto_reconnect
         self.messages_registrar     = []
+        self.messages_index         = {}
+        self.messages_help_cache    = {}
         self.isAuth                 = False
         self.loop_status            = ARCHIPEL_XMPP_LOOP_OFF
         self.pubsubserver           = self.configuration.get("GLOBAL", "xmpp_pubsub_server")
@@ -130,9 +132,16 @@ class TNArchipelEntity (object):
         self.permission_db_file     = "permissions.sqlite3"
         self.permission_admin_names = dict(map(lambda x: ("STATIC_%s" % x, x), self.configuration.get("GLOBAL", "archipel_root_admins").split()))
         self.permission_center      = TNArchipelPermissionCenter(root_admins=self.permission_admin_names)
+        self.stream_multiplexer     = None
+        self.multiplexed_roster_path = None
+        self.reactor                = None
 
         if isinstance(self, TNHookableEntity):
-            TNHookableEntity.__init__(self, self.log)
+            if self.configuration.has_option("GLOBAL", "hooks_worker_pool_size"):
+                hooks_worker_pool = get_hook_worker_pool(self.configuration.getint("GLOBAL", "hooks_worker_pool_size"))
+            else:
+                hooks_worker_pool = get_hook_worker_pool()
+            TNHookableEntity.__init__(self, self.log, worker_pool=hooks_worker_pool)
         if isinstance(self, TNAvatarControllableEntity):
             TNAvatarControllableEntity.__init__(self, configuration, self.permission_center, self.xmppclient, self.log)
         if isinstance(self, TNTaggableEntity):
@@ -262,6 +271,8 @@ class TNArchipelEntity (object):
         """
         if isinstance(self, TNRosterQueryableEntity):
             TNRosterQueryableEntity.init_vocabulary(self)
+        if isinstance(self, TNHookableEntity):
+            TNHookableEntity.init_vocabulary(self)
 
 
     ### Permissions
@@ -278,6 +289,8 @@ class TNArchipelEntity (object):
             TNAvatarControllableEntity.init_permissions(self)
         if isinstance(self, TNFileTransferCapableEntity):
             TNFileTransferCapableEntity.init_permissions(self)
+        if isinstance(self, TNHookableEntity):
+            TNHookableEntity.init_permissions(self)
 
         self.permission_center.create_permission("all", "All permissions are granted", False)
         self.permission_center.create_permission("presence", "Authorizes users to request presences", False)
@@ -320,6 +333,8 @@ class TNArchipelEntity (object):
         @rtype: Boolean
         @return: True in case of success
         """
+        if self.stream_multiplexer:
+            return self.connect_multiplexed_xmpp()
         debug_mode = []
         if self.configuration.has_option("LOGGING", "xmpppy_debug") and self.configuration.getboolean("LOGGING", "xmpppy_debug"):
             debug_mode = ['always', 'nodebuilder']
@@ -338,22 +353,43 @@ class TNArchipelEntity (object):
         self.perform_hooks("HOOK_ARCHIPELENTITY_XMPP_CONNECTED")
         return True
 
+    def connect_multiplexed_xmpp(self):
+        """
+        Attach the entity to the shared stream of its stream multiplexer
+        instead of opening its own connection.
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        self.xmppclient = self.stream_multiplexer.attach(self.jid, self.log, roster_path=self.multiplexed_roster_path)
+        if not self.xmppclient:
+            self.loop_status = ARCHIPEL_XMPP_LOOP_RESTART
+            self.log.warning("Shared XMPP stream is not ready. Waiting 5 seconds for reconnection")
+            time.sleep(5)
+            return False
+        self.loop_status = ARCHIPEL_XMPP_LOOP_ON
+        self.log.info("Successfully attached to shared XMPP stream with JID %s" % str(self.jid))
+        self.perform_hooks("HOOK_ARCHIPELENTITY_XMPP_CONNECTED")
+        return True
+
     def auth_xmpp(self):
         """
         Authentify the client to the XMPP server.
         """
-        self.log.info("Trying to authentify the client with username %s and resource %s" % (self.jid.getNode(), self.resource))
-        result = self.xmppclient.auth(self.jid.getNode(), self.password, self.resource)
-        if result == None:
-            self.isAuth = False
-            if self.auto_register:
-                self.log.info("Starting registration, according to propertie auto_register.")
-                self.inband_registration()
-                return
-            self.log.error("Bad authentication or unable to register account. Exiting.")
-            self.loop_status = ARCHIPEL_XMPP_LOOP_OFF
-            raise Exception("Unable to authenticate user. exiting")
-        self.log.info("Successfully authenticated.")
+        if self.stream_multiplexer:
+            self.log.info("Using the already authenticated shared XMPP stream.")
+        else:
+            self.log.info("Trying to authentify the client with username %s and resource %s" % (self.jid.getNode(), self.resource))
+            result = self.xmppclient.auth(self.jid.getNode(), self.password, self.resource)
+            if result == None:
+                self.isAuth = False
+                if self.auto_register:
+                    self.log.info("Starting registration, according to propertie auto_register.")
+                    self.inband_registration()
+                    return
+                self.log.error("Bad authentication or unable to register account. Exiting.")
+                self.loop_status = ARCHIPEL_XMPP_LOOP_OFF
+                raise Exception("Unable to authenticate user. exiting")
+            self.log.info("Successfully authenticated.")
         self.isAuth = True
         self.loop_status = ARCHIPEL_XMPP_LOOP_ON
         self.xmppclient.sendPresence(requestRoster=1)
@@ -379,6 +415,11 @@ class TNArchipelEntity (object):
             self.isAuth = False
             self.loop_status = ARCHIPEL_XMPP_LOOP_OFF
             self.perform_hooks("HOOK_ARCHIPELENTITY_XMPP_DISCONNECTED")
+            if self.stream_multiplexer:
+                # there is no loop that will close the client for us
+                self.xmppclient.disconnect()
+            elif self.reactor:
+                self.reactor.check_entity(self)
         else:
             self.log.warning("Trying to disconnect, but not connected. Ignoring.")
 
@@ -952,7 +993,13 @@ class TNArchipelEntity (object):
         """
         Do a in-band unregistration.
         """
+        if self.stream_multiplexer:
+            # there is no loop to handle the REMOVE_USER status
+            self.process_inband_unregistration()
+            return
         self.loop_status = ARCHIPEL_XMPP_LOOP_REMOVE_USER
+        if self.reactor:
+            self.reactor.check_entity(self)
 
     def process_inband_unregistration(self):
         """
@@ -962,6 +1009,12 @@ class TNArchipelEntity (object):
         self.is_unregistering = True
         self.remove_pubsubs()
         self.unregister_handlers()
+        if self.stream_multiplexer:
+            # multiplexed entities have no account on the server
+            self.xmppclient.disconnect()
+            self.log.info("Detached from shared XMPP stream.")
+            self.loop_status = ARCHIPEL_XMPP_LOOP_OFF
+            return
         self.log.info("Trying to unregister.")
         iq = (xmpp.Iq(typ='set', to=self.jid.getDomain()))
         iq.setQueryNS("jabber:iq:register")
@@ -1016,8 +1069,17 @@ class TNArchipelEntity (object):
         @type item: dictionnary
         @param item: the dictionnary describing the registrar item
         """
-        self.log.debug("Plugin have registered a method %s for commands %s" % (str(item["method"]), str(item["commands"])))
+        self.log.debug("Plugin have registered a method %s for commands %s", item["method"], item["commands"])
+        item_position = len(self.messages_registrar)
         self.messages_registrar.append(item)
+        for cmd_position, cmd in enumerate(item["commands"]):
+            node = self.messages_index
+            for char in cmd:
+                node = node.setdefault(char, {})
+            # keep the first registration, as the registrar is searched in order
+            if not None in node:
+                node[None] = ((item_position, cmd_position), item)
+        self.messages_help_cache = {}
 
     def add_message_registrar_items(self, items):
         """
@@ -1045,6 +1107,28 @@ class TNArchipelEntity (object):
             self.log.info("Message ignored from %s (%s)" % (msg.getFrom(), msg.getType()))
             return False
 
+    def get_message_registrar_item(self, body):
+        """
+        Return the first registered item having a command the body starts with.
+        This walks the commands index, so it costs the length of the
+        command instead of the number of registered commands.
+        @type body: string
+        @param body: the lowered body of the message
+        @rtype: dict
+        @return: the registrar item or None
+        """
+        node = self.messages_index
+        match = None
+        for char in body:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node and (not match or node[None][0] < match[0]):
+                match = node[None]
+        if match:
+            return match[1]
+        return None
+
     def build_reply(self, reply_stanza, msg):
         """
         Parse the registrar and execute commands if necessary.
@@ -1058,23 +1142,17 @@ class TNArchipelEntity (object):
         if body.find("help", 0, len("help")) >= 0:
             reply_stanza.setBody(self.build_help(msg))
         else:
-            loop = True
-            for registrar_item in self.messages_registrar:
-                for cmd in registrar_item["commands"]:
-                    if body.find(cmd, 0, len(cmd)) >= 0:
-                        granted = True
-                        if "permissions" in registrar_item:
-                            granted = self.permission_center.check_permissions(msg.getFrom().getStripped(), registrar_item["permissions"])
-                        if granted:
-                            m = registrar_item["method"]
-                            resp = m(msg)
-                            reply_stanza.setBody(resp)
-                        else:
-                            reply_stanza.setBody("Sorry, you do not have the needed permission to execute this command.")
-                        loop = False
-                        break
-                if not loop:
-                    break
+            registrar_item = self.get_message_registrar_item(body)
+            if registrar_item:
+                granted = True
+                if "permissions" in registrar_item:
+                    granted = self.permission_center.check_permissions(msg.getFrom().getStripped(), registrar_item["permissions"])
+                if granted:
+                    m = registrar_item["method"]
+                    resp = m(msg)
+                    reply_stanza.setBody(resp)
+                else:
+                    reply_stanza.setBody("Sorry, you do not have the needed permission to execute this command.")
         return reply_stanza
 
     def build_help(self, msg):
@@ -1084,24 +1162,36 @@ class TNArchipelEntity (object):
         @param msg: the received message
         @return the string containing the help message
         """
-        resp = ARCHIPEL_MESSAGING_HELP_MESSAGE
-        for registrar_item in self.messages_registrar:
+        granted_items = []
+        for position, registrar_item in enumerate(self.messages_registrar):
             if not "ignore" in registrar_item:
-                granted = True
-                if "permissions" in registrar_item:
-                    granted = self.permission_center.check_permissions(msg.getFrom().getStripped(), registrar_item["permissions"])
-                if granted:
-                    cmds = str(registrar_item["commands"])
-                    desc = registrar_item["description"]
-                    params = registrar_item["parameters"]
-                    params_string = ""
-                    for p in params:
-                        params_string += "%s: %s\n" % (p["name"], p["description"])
-                    if params_string == "":
-                        params_string = "No parameters"
-                    else:
-                        params_string = params_string[:-1]
-                    resp += "%s: %s\n%s\n\n" % (cmds, desc, params_string)
+                if not "permissions" in registrar_item or self.permission_center.check_permissions(msg.getFrom().getStripped(), registrar_item["permissions"]):
+                    granted_items.append(position)
+        granted_items = tuple(granted_items)
+        if not granted_items in self.messages_help_cache:
+            self.messages_help_cache[granted_items] = self.render_help([self.messages_registrar[i] for i in granted_items])
+        return self.messages_help_cache[granted_items]
+
+    def render_help(self, registrar_items):
+        """
+        Render the help message of the given registrar items.
+        @type registrar_items: list
+        @param registrar_items: the registrar items to describe
+        @return the string containing the help message
+        """
+        resp = ARCHIPEL_MESSAGING_HELP_MESSAGE
+        for registrar_item in registrar_items:
+            cmds = str(registrar_item["commands"])
+            desc = registrar_item["description"]
+            params = registrar_item["parameters"]
+            params_string = ""
+            for p in params:
+                params_string += "%s: %s\n" % (p["name"], p["description"])
+            if params_string == "":
+                params_string = "No parameters"
+            else:
+                params_string = params_string[:-1]
+            resp += "%s: %s\n%s\n\n" % (cmds, desc, params_string)
         return resp
 
 
@@ -1240,6 +1330,16 @@ class TNArchipelEntity (object):
         """
         This is the main loop of the client.
         """
+        if self.stream_multiplexer:
+            # stanzas are processed by the thread of the shared stream,
+            # we only have to wait for it to accept us
+            while self.loop_status == ARCHIPEL_XMPP_LOOP_RESTART:
+                self.connect()
+            return
+        if self.reactor:
+            # the shared reactor will process our stream from now
+            self.reactor.register_entity(self)
+            return
         while not self.loop_status == ARCHIPEL_XMPP_LOOP_OFF:
             try:
                 if self.loop_status == ARCHIPEL_XMPP_LOOP_REMOVE_USER:
@@ -19,23 +19,152 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import Queue
+import collections
 import sys
+import threading
+import time
 import traceback
 
 
+ARCHIPEL_HOOKS_WORKER_POOL_SIZE     = 8
+ARCHIPEL_HOOKS_SLOW_THRESHOLD       = 1.0
+ARCHIPEL_HOOKS_HISTOGRAM_BUCKETS    = (0.001, 0.01, 0.1, 1.0, 10.0, 60.0)
+
+
+class TNHookWorkerPool (object):
+    """
+    Bounded pool of threads running the asynchronous hooks. Tasks of the
+    same entity are run one at a time, in the order they were submitted.
+    """
+
+    def __init__(self, size=ARCHIPEL_HOOKS_WORKER_POOL_SIZE):
+        """
+        Initialize the TNHookWorkerPool.
+        @type size: int
+        @param size: the number of worker threads
+        """
+        self.size       = size
+        self.ready      = Queue.Queue()
+        self.tasks      = {}
+        self.scheduled  = set()
+        self.lock       = threading.Lock()
+        for i in range(size):
+            worker = threading.Thread(target=self.work)
+            worker.setDaemon(True)
+            worker.start()
+
+    def submit(self, key, task):
+        """
+        Queue a task.
+        @type key: object
+        @param key: the ordering key (the entity)
+        @type task: function
+        @param task: the function to run
+        """
+        with self.lock:
+            self.tasks.setdefault(key, collections.deque()).append(task)
+            if key in self.scheduled:
+                return
+            self.scheduled.add(key)
+        self.ready.put(key)
+
+    def work(self):
+        """
+        Worker thread main loop. Run one task of a ready key, then
+        put the key back at the end of the queue if it has other tasks.
+        """
+        while True:
+            key = self.ready.get()
+            with self.lock:
+                task = self.tasks[key].popleft()
+            try:
+                task()
+            except Exception:
+                pass
+            with self.lock:
+                if self.tasks[key]:
+                    requeue = True
+                else:
+                    del self.tasks[key]
+                    self.scheduled.discard(key)
+                    requeue = False
+            if requeue:
+                self.ready.put(key)
+
+
+_hook_worker_pool = None
+_hook_worker_pool_lock = threading.Lock()
+
+def get_hook_worker_pool(size=ARCHIPEL_HOOKS_WORKER_POOL_SIZE):
+    """
+    Return the hook worker pool of the process, creating it if needed.
+    @type size: int
+    @param size: the number of worker threads, if the pool is created
+    @rtype: L{TNHookWorkerPool}
+    @return: the worker pool
+    """
+    global _hook_worker_pool
+    with _hook_worker_pool_lock:
+        if not _hook_worker_pool:
+            _hook_worker_pool = TNHookWorkerPool(size)
+        return _hook_worker_pool
+
+
+class TNHookStatistics (object):
+    """
+    Duration histogram of a hook method. Hooks run in several threads,
+    so the histogram is updated with a lock.
+    """
+
+    def __init__(self):
+        self.count      = 0
+        self.total      = 0.0
+        self.max        = 0.0
+        self.buckets    = [0] * (len(ARCHIPEL_HOOKS_HISTOGRAM_BUCKETS) + 1)
+        self.lock       = threading.Lock()
+
+    def add(self, duration):
+        """
+        Record a duration.
+        @type duration: float
+        @param duration: the duration in seconds
+        """
+        with self.lock:
+            self.count += 1
+            self.total += duration
+            self.max = max(self.max, duration)
+            for i, bound in enumerate(ARCHIPEL_HOOKS_HISTOGRAM_BUCKETS):
+                if duration < bound:
+                    self.buckets[i] += 1
+                    return
+            self.buckets[-1] += 1
+
+    def __str__(self):
+        bounds = ["<%ss" % b for b in ARCHIPEL_HOOKS_HISTOGRAM_BUCKETS] + [">=%ss" % ARCHIPEL_HOOKS_HISTOGRAM_BUCKETS[-1]]
+        with self.lock:
+            histogram = " ".join(["%s:%d" % (b, c) for b, c in zip(bounds, self.buckets)])
+            return "count:%d avg:%.3fs max:%.3fs [%s]" % (self.count, self.total / max(self.count, 1), self.max, histogram)
+
+
 class TNHookableEntity (object):
     """
     This class make a TNArchipelEntity hooking capable.
     """
 
-    def __init__(self, log):
+    def __init__(self, log, worker_pool=None):
         """
         Initialize the TNHookableEntity.
         @type log: TNArchipelLog
         @param log: the logger of the entity
+        @type worker_pool: L{TNHookWorkerPool}
+        @param worker_pool: the pool running asynchronous hooks (default: the pool of the process)
         """
-        self.hooks  = {}
-        self.log    = log
+        self.hooks              = {}
+        self.hooks_statistics   = {}
+        self.hooks_statistics_lock = threading.Lock()
+        self.hooks_worker_pool  = worker_pool
+        self.log                = log
 
     # Hooks management
 
@@ -66,10 +195,13 @@ class TNHookableEntity (object):
         self.log.info("HOOK: removing hook with name %s" % hookname)
         return True
 
-    def register_hook(self, hookname, method, user_info=None, oneshot=False):
+    def register_hook(self, hookname, method, user_info=None, oneshot=False, asynchronous=False):
         """
         Register a method that will be triggered by a hook. The methood must use
         the following prototype: method(origin, user_info, arguments).
+        Asynchronous methods are run by the hook worker pool, so perform_hooks
+        does not wait for them. Asynchronous methods of the same entity are
+        run one at a time, in the order the hooks have been performed.
         @type hookname: string
         @param hookname: the name of the hook
         @type method: function
@@ -78,12 +210,14 @@ class TNHookableEntity (object):
         @param user_info: user info you want to pass to the method when it'll be peformed
         @type oneshot: boolean
         @param oneshot: if True, the method will be unregistered after first performing
+        @type asynchronous: boolean
+        @param asynchronous: if True, the method will be run by the hook worker pool
         """
         # If the hook is not existing, we create it.
         if hookname not in self.hooks:
             self.create_hook(hookname)
-        self.hooks[hookname].append({"method": method, "oneshot": oneshot, "user_info": user_info})
-        self.log.info("HOOK: registering hook method %s for hook name %s (oneshot: %s)" % (method.__name__, hookname, str(oneshot)))
+        self.hooks[hookname].append({"method": method, "oneshot": oneshot, "user_info": user_info, "asynchronous": asynchronous})
+        self.log.info("HOOK: registering hook method %s for hook name %s (oneshot: %s, asynchronous: %s)", method.__name__, hookname, oneshot, asynchronous)
 
     def unregister_hook(self, hookname, method):
         """
@@ -112,26 +246,111 @@ class TNHookableEntity (object):
         @type arguments: object
         @param arguments: random object that will be given to the registered methods as "argument" kargs
         """
-        self.log.info("HOOK: going to run methods for hook %s" % hookname)
+        self.log.info("HOOK: going to run methods for hook %s", hookname)
         hook_to_remove = []
         if hookname not in self.hooks:
-            self.log.warning("No hook with name %s found" % hookname)
+            self.log.warning("No hook with name %s found", hookname)
             return
-        for info in self.hooks[hookname]:
+        for info in list(self.hooks[hookname]):
             m           = info["method"]
             oneshot     = info["oneshot"]
             user_info   = info["user_info"]
-            try:
-                self.log.debug("HOOK: performing method %s registered in hook with name %s and user_info: %s (oneshot: %s)" % (m.__name__, hookname, str(user_info), str(oneshot)))
-                m(self, user_info, arguments)
+            if info.get("asynchronous"):
+                self.log.debug("HOOK: queuing method %s registered in hook with name %s", m.__name__, hookname)
+                if not self.hooks_worker_pool:
+                    self.hooks_worker_pool = get_hook_worker_pool()
+                self.hooks_worker_pool.submit(self, lambda m=m, user_info=user_info: self.run_hook_method(hookname, m, user_info, arguments))
                 if oneshot:
-                    self.log.info("HOOK: this hook was oneshot. Registering for deletion.")
-                    hook_to_remove.append(m)
-            except Exception as ex:
-                    self.log.error("HOOK: error when performing method %s for hookname %s: %s" % (m.__name__, hookname, str(ex)))
-                    t, v, tr = sys.exc_info()
-                    self.log.debug("\n".join(traceback.format_exception(t,v,tr)))
+                    # remove it now, so it can't be queued twice
+                    self.unregister_hook(hookname, m)
+                continue
+            self.log.debug("HOOK: performing method %s registered in hook with name %s and user_info: %s (oneshot: %s)", m.__name__, hookname, user_info, oneshot)
+            if self.run_hook_method(hookname, m, user_info, arguments) and oneshot:
+                self.log.info("HOOK: this hook was oneshot. Registering for deletion.")
+                hook_to_remove.append(m)
 
         for hook_method in hook_to_remove:
             self.log.info("HOOK: removing registred hook for deletion %s" % (hook_method.__name__))
             self.unregister_hook(hookname, hook_method)
+
+    def run_hook_method(self, hookname, method, user_info, arguments):
+        """
+        Run a hook method and record its duration.
+        @type hookname: string
+        @param hookname: the name of the hook
+        @type method: function
+        @param method: the method to run
+        @type user_info: object
+        @param user_info: user info given at registration
+        @type arguments: object
+        @param arguments: the arguments of the hook
+        @rtype: boolean
+        @return: True if the method didn't raise
+        """
+        start = time.time()
+        try:
+            method(self, user_info, arguments)
+            return True
+        except Exception as ex:
+            self.log.error("HOOK: error when performing method %s for hookname %s: %s", method.__name__, hookname, ex)
+            t, v, tr = sys.exc_info()
+            self.log.debug("\n".join(traceback.format_exception(t,v,tr)))
+            return False
+        finally:
+            duration = time.time() - start
+            method_name = method.__name__
+            if hasattr(method, "im_self") and method.im_self is not None:
+                method_name = "%s.%s" % (method.im_self.__class__.__name__, method_name)
+            key = (hookname, method_name)
+            with self.hooks_statistics_lock:
+                if not key in self.hooks_statistics:
+                    self.hooks_statistics[key] = TNHookStatistics()
+                statistics = self.hooks_statistics[key]
+            statistics.add(duration)
+            if duration >= ARCHIPEL_HOOKS_SLOW_THRESHOLD:
+                self.log.warning("HOOK: method %s for hookname %s took %.3fs", method_name, hookname, duration)
+
+    def get_hooks_statistics(self):
+        """
+        Return the duration statistics of the hook methods.
+        @rtype: dict
+        @return: L{TNHookStatistics} indexed by (hookname, method name)
+        """
+        with self.hooks_statistics_lock:
+            return dict(self.hooks_statistics)
+
+
+    ### Vocabulary and permissions
+
+    def init_vocabulary(self):
+        """
+        Initialize the vocabulary.
+        """
+        item = {"commands" : ["hooks"],
+                "parameters": [],
+                "permissions": ["hooks_statistics"],
+                "method": self.message_hooks_statistics,
+                "description": "I'll give you the duration statistics of my hooks"}
+        self.add_message_registrar_item(item)
+
+    def init_permissions(self):
+        """
+        Initialize the permissions.
+        """
+        self.permission_center.create_permission("hooks_statistics", "Authorizes users to get the duration statistics of hooks", False)
+
+    def message_hooks_statistics(self, msg):
+        """
+        Handle the hooks statistics message.
+        @type msg: xmpp.Protocol.Message
+        @param msg: the message containing the request
+        @rtype: string
+        @return: the answer
+        """
+        stats = self.get_hooks_statistics()
+        if not stats:
+            return "No hook has been performed yet."
+        lines = []
+        for (hookname, method_name), stat in sorted(stats.items(), key=lambda x: x[1].total, reverse=True):
+            lines.append("%s / %s: %s" % (hookname, method_name, stat))
+        return "\n".join(lines)
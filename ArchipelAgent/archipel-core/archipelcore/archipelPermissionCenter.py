@@ -20,6 +20,10 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import threading
+from collections import OrderedDict
+
 from sqlalchemy import Table, Column, Integer, String, ForeignKey, create_engine
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
@@ -27,6 +31,9 @@ from sqlalchemy.orm import sessionmaker, relationship, backref
 from sqlalchemy.orm.exc import NoResultFound
 
 Base = declarative_base()
+SharedBase = declarative_base()
+
+ARCHIPEL_PERMISSION_CACHE_SIZE = 4096
 
 
 users_have_permissions = Table('users_have_permissions', Base.metadata,
@@ -63,21 +70,80 @@ class TNArchipelPermission (Base):
         return "<TNArchipelPermission('%s', '%s', '%s')>" % (self.name, self.description, self.defaultValue)
 
 
+class TNArchipelSharedPermission (SharedBase):
+    __tablename__ = 'shared_permissions'
+
+    name = Column(String, primary_key=True)
+    description = Column(String)
+    defaultValue = Column(Integer)
+
+    def __init__(self, name, description, default_value):
+        self.name = name
+        self.description = description
+        self.defaultValue = default_value
+
+    def __repr__(self):
+        return "<TNArchipelSharedPermission('%s', '%s', '%s')>" % (self.name, self.description, self.defaultValue)
+
+class TNArchipelScopedUser (SharedBase):
+    __tablename__ = 'scoped_users'
+
+    scope = Column(String, primary_key=True)
+    name = Column(String, primary_key=True)
+
+    def __init__(self, scope, name):
+        self.scope = scope
+        self.name = name
+
+    def __repr__(self):
+        return "<TNArchipelScopedUser('%s', '%s')>" % (self.scope, self.name)
+
+class TNArchipelScopedGrant (SharedBase):
+    __tablename__ = 'scoped_grants'
+
+    scope = Column(String, primary_key=True)
+    user = Column(String, primary_key=True)
+    permission = Column(String, primary_key=True)
+
+    def __init__(self, scope, user, permission):
+        self.scope = scope
+        self.user = user
+        self.permission = permission
+
+    def __repr__(self):
+        return "<TNArchipelScopedGrant('%s', '%s', '%s')>" % (self.scope, self.user, self.permission)
+
+class TNArchipelImportedScope (SharedBase):
+    __tablename__ = 'imported_scopes'
+
+    scope = Column(String, primary_key=True)
+
+    def __init__(self, scope):
+        self.scope = scope
+
+
 class TNArchipelPermissionCenter:
 
-    def __init__(self, database_file=None, root_admins={}):
+    def __init__(self, database_file=None, root_admins={}, cache_size=ARCHIPEL_PERMISSION_CACHE_SIZE):
         """
         Initialize the permission center.
         @type database_file: string
         @param database_file: the path to the db file
         @type root_admins: array
         @param root_admins: the root users JID
+        @type cache_size: int
+        @param cache_size: the max number of (user, permission) decisions to keep in memory
         """
         self.root_admins = root_admins
         self.database_file = database_file
         self.engine = None
         self.metadata = None
         self.session = None
+        self.cache_size = cache_size
+        self.decisions_cache = OrderedDict()
+        self.decisions_cache_lock = threading.Lock()
+        # bumped by each invalidation, so a decision computed before is not cached
+        self.decisions_cache_generation = 0
 
     def start(self, database_file=None, root_admins={}):
         """
@@ -87,6 +153,7 @@ class TNArchipelPermissionCenter:
             self.database_file = database_file
         if len(root_admins) > 0:
             self.root_admins = root_admins
+        self.invalidate_cache()
 
         connection_string = 'sqlite:///%s' % self.database_file
         self.engine = create_engine(connection_string)
@@ -112,6 +179,7 @@ class TNArchipelPermissionCenter:
         """
         if not new_account in self.root_admins.values():
             self.root_admins[key] = new_account
+            self.invalidate_cache()
 
     def del_admin(self, key):
         """
@@ -121,6 +189,7 @@ class TNArchipelPermissionCenter:
         """
         if key in self.root_admins:
             del self.root_admins[key]
+            self.invalidate_cache()
 
     def admins(self):
         """
@@ -130,6 +199,60 @@ class TNArchipelPermissionCenter:
         """
         return self.root_admins
 
+    ### Decisions cache
+
+    def invalidate_cache(self, user_name=None, permission_name=None):
+        """
+        Remove decisions from the cache. If neither user_name nor permission_name
+        is given, the whole cache is cleared.
+        @type user_name: string
+        @param user_name: if set, only remove the decisions of this user
+        @type permission_name: string
+        @param permission_name: if set, only remove the decisions about this permission
+        """
+        with self.decisions_cache_lock:
+            self.decisions_cache_generation += 1
+            if not user_name and not permission_name:
+                self.decisions_cache.clear()
+                return
+            for key in self.decisions_cache.keys():
+                if (not user_name or key[0] == user_name) and (not permission_name or key[1] == permission_name):
+                    del self.decisions_cache[key]
+
+    def _get_cached_decision(self, user_name, permission_name):
+        """
+        @rtype: Boolean
+        @return: the cached decision or None if not cached
+        """
+        key = (user_name, permission_name)
+        with self.decisions_cache_lock:
+            decision = self.decisions_cache.pop(key, None)
+            if decision is not None:
+                self.decisions_cache[key] = decision
+            return decision
+
+    def _get_cache_generation(self):
+        """
+        @rtype: int
+        @return: the current generation of the cache
+        """
+        with self.decisions_cache_lock:
+            return self.decisions_cache_generation
+
+    def _set_cached_decision(self, user_name, permission_name, decision, generation):
+        """
+        Store a decision, evicting the least recently used one if the cache is full.
+        The decision is dropped if the cache has been invalidated since it was computed.
+        @type generation: int
+        @param generation: the generation of the cache read before computing the decision
+        """
+        with self.decisions_cache_lock:
+            if generation != self.decisions_cache_generation:
+                return
+            self.decisions_cache[(user_name, permission_name)] = decision
+            if len(self.decisions_cache) > self.cache_size:
+                self.decisions_cache.popitem(last=False)
+
     ### Permission management
 
     def create_permission(self, name, description="", default_permission=False, currentsession=None):
@@ -151,6 +274,7 @@ class TNArchipelPermissionCenter:
             session.add(p)
             session.commit()
             if not currentsession: session.close()
+            self.invalidate_cache(permission_name=name)
             return True
         except IntegrityError:
             return False
@@ -187,6 +311,9 @@ class TNArchipelPermissionCenter:
             session.delete(p)
             session.commit()
             if not currentsession: session.close()
+            self.invalidate_cache(permission_name=name)
+            if name == "all":
+                self.invalidate_cache()
             return True
         except NoResultFound:
             return False
@@ -220,6 +347,7 @@ class TNArchipelPermissionCenter:
             session.add(u)
             session.commit()
             if not currentsession: session.close()
+            self.invalidate_cache(user_name=name)
             return u
         except IntegrityError:
             return None
@@ -256,6 +384,7 @@ class TNArchipelPermissionCenter:
             session.delete(u)
             session.commit()
             if not currentsession: session.close()
+            self.invalidate_cache(user_name=name)
             return True
         except NoResultFound:
             return False
@@ -280,6 +409,7 @@ class TNArchipelPermissionCenter:
             u.permissions.append(p)
             session.commit()
         if not currentsession: session.close()
+        self.invalidate_cache(user_name=user_name)
         return True
 
     def revoke_permission_to_user(self, permission_name, user_name, currentsession=None):
@@ -303,6 +433,7 @@ class TNArchipelPermissionCenter:
         u.permissions.remove(p)
         session.commit()
         if not currentsession: session.close()
+        self.invalidate_cache(user_name=user_name)
         return True
 
     def user_has_permission(self, user_name, permission_name, currentsession=None):
@@ -357,21 +488,39 @@ class TNArchipelPermissionCenter:
         @rtype: Boolean
         @return: True in case of success
         """
-        permObject = self.get_permission(permission_name)
+        decision = self._get_cached_decision(user_name, permission_name)
+        if decision is None:
+            generation = self._get_cache_generation()
+            decision = self._compute_permission(user_name, permission_name)
+            self._set_cached_decision(user_name, permission_name, decision, generation)
+        return decision
+
+    def _compute_permission(self, user_name, permission_name):
+        """
+        Compute the decision of check_permission from the database, using one session.
+        @type user_name: string
+        @param user_name: the name of the user
+        @type permission_name: string
+        @param permission_name: the name of the permission
+        @rtype: Boolean
+        @return: True if granted
+        """
         if user_name in self.root_admins.values():
             return True
-        if self.user_has_permission(user_name, "all"):
-            return True
-        if not self.get_user(user_name):
-            if permObject and permObject.defaultValue == 1:
+        session = self.create_session()
+        try:
+            permObject = self.get_permission(permission_name, currentsession=session)
+            userObject = self.get_user(user_name, currentsession=session)
+            if not userObject:
+                return bool(permObject and permObject.defaultValue == 1)
+            granted = [p.name for p in userObject.permissions]
+            if "all" in granted:
                 return True
-            else:
+            if not permObject:
                 return False
-        if not permObject:
-            return False
-        if self.user_has_permission(user_name, permission_name):
-            return True
-        return False
+            return permission_name in granted
+        finally:
+            session.close()
 
     def check_permissions(self, user_name, permissions):
         """
@@ -395,4 +544,412 @@ class TNArchipelPermissionCenter:
         self.session.close_all()
         self.engine.dispose()
         del self.session
-        del self.engine
\ No newline at end of file
+        del self.engine
+
+class TNArchipelSharedPermissionStore:
+
+    def __init__(self, database_file):
+        """
+        Initialize the shared permission store.
+        @type database_file: string
+        @param database_file: the path to the shared db file
+        """
+        self.database_file = database_file
+        self.engine = None
+        self.session = None
+        self.definitions = set()
+        self.definitions_lock = threading.Lock()
+
+    def start(self):
+        """
+        Open the shared database and load the known permission definitions.
+        """
+        connection_string = 'sqlite:///%s' % self.database_file
+        self.engine = create_engine(connection_string, connect_args={"timeout": 30})
+        SharedBase.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)
+        session = self.create_session()
+        self.definitions = set([p.name for p in session.query(TNArchipelSharedPermission).all()])
+        session.close()
+
+    def create_session(self):
+        """
+        Create a new SQL session
+        @rtype: Session
+        @return: the new session
+        """
+        return self.session()
+
+    def register_permission(self, name, description="", default_permission=False):
+        """
+        Register a permission definition. Definitions are shared by all the
+        scopes, so only the first registration of a name hits the database.
+        @type name: string
+        @param name: the name of the permission
+        @type description: string
+        @param description: the description of the permission
+        @type default_permission: Boolean
+        @param default_permission: the default value of permission if not set
+        @rtype: Boolean
+        @return: True if the permission was not known yet
+        """
+        with self.definitions_lock:
+            if name in self.definitions:
+                return False
+            session = self.create_session()
+            session.merge(TNArchipelSharedPermission(name, description, default_permission))
+            session.commit()
+            session.close()
+            self.definitions.add(name)
+            return True
+
+
+_shared_permission_stores = {}
+_shared_permission_stores_lock = threading.Lock()
+
+def get_shared_permission_store(database_file):
+    """
+    Return the started shared permission store of the given file.
+    There is only one store per file and per process.
+    @type database_file: string
+    @param database_file: the path to the shared db file
+    @rtype: L{TNArchipelSharedPermissionStore}
+    @return: the shared store
+    """
+    with _shared_permission_stores_lock:
+        if not database_file in _shared_permission_stores:
+            store = TNArchipelSharedPermissionStore(database_file)
+            store.start()
+            _shared_permission_stores[database_file] = store
+        return _shared_permission_stores[database_file]
+
+
+class TNArchipelScopedPermissionCenter (TNArchipelPermissionCenter):
+    """
+    Permission center storing its users and grants in a
+    L{TNArchipelSharedPermissionStore}, scoped by the entity JID.
+    """
+
+    def __init__(self, store, scope, root_admins={}, cache_size=ARCHIPEL_PERMISSION_CACHE_SIZE):
+        """
+        Initialize the scoped permission center.
+        @type store: L{TNArchipelSharedPermissionStore}
+        @param store: the shared store
+        @type scope: string
+        @param scope: the scope of the entity (its bare JID)
+        @type root_admins: array
+        @param root_admins: the root users JID
+        @type cache_size: int
+        @param cache_size: the max number of (user, permission) decisions to keep in memory
+        """
+        TNArchipelPermissionCenter.__init__(self, root_admins=root_admins, cache_size=cache_size)
+        self.store = store
+        self.scope = scope
+
+    def start(self, database_file=None, root_admins={}):
+        """
+        Be ready to use permissions. If the entity has a legacy
+        permission database not imported yet, import it.
+        @type database_file: string
+        @param database_file: the path of the legacy db file of the entity
+        """
+        if database_file:
+            self.database_file = database_file
+        if len(root_admins) > 0:
+            self.root_admins = root_admins
+        self.invalidate_cache()
+        if self.database_file and os.path.exists(self.database_file):
+            self.import_database(self.database_file)
+
+    def create_session(self):
+        """
+        Create a new SQL session on the shared store
+        @rtype: Session
+        @return: the new session
+        """
+        return self.store.create_session()
+
+    ### Scope import and export
+
+    def import_database(self, database_file):
+        """
+        Import the users and grants of a legacy permission database, once.
+        @type database_file: string
+        @param database_file: the path to the legacy db file
+        @rtype: Boolean
+        @return: True if the database has been imported
+        """
+        session = self.create_session()
+        if session.query(TNArchipelImportedScope).filter(TNArchipelImportedScope.scope == self.scope).count():
+            session.close()
+            return False
+        engine = create_engine('sqlite:///%s' % database_file)
+        legacy_session = sessionmaker(bind=engine)()
+        try:
+            for p in legacy_session.query(TNArchipelPermission).all():
+                self.store.register_permission(p.name, p.description, p.defaultValue)
+            for u in legacy_session.query(TNArchipelUser).all():
+                session.merge(TNArchipelScopedUser(self.scope, u.name))
+                for p in u.permissions:
+                    session.merge(TNArchipelScopedGrant(self.scope, u.name, p.name))
+            session.add(TNArchipelImportedScope(self.scope))
+            session.commit()
+        finally:
+            legacy_session.close()
+            engine.dispose()
+            session.close()
+        self.invalidate_cache()
+        return True
+
+    def export_database(self, database_file):
+        """
+        Write the users and grants of the scope into a legacy permission
+        database, so another hypervisor can import it (i.e. after migration).
+        @type database_file: string
+        @param database_file: the path to the legacy db file
+        """
+        if os.path.exists(database_file):
+            os.unlink(database_file)
+        engine = create_engine('sqlite:///%s' % database_file)
+        Base.metadata.create_all(engine)
+        legacy_session = sessionmaker(bind=engine)()
+        session = self.create_session()
+        try:
+            permissions = {}
+            for p in session.query(TNArchipelSharedPermission).all():
+                permissions[p.name] = TNArchipelPermission(p.name, p.description, p.defaultValue)
+                legacy_session.add(permissions[p.name])
+            for u in session.query(TNArchipelScopedUser).filter(TNArchipelScopedUser.scope == self.scope).all():
+                legacy_user = TNArchipelUser(u.name)
+                for g in session.query(TNArchipelScopedGrant).filter(TNArchipelScopedGrant.scope == self.scope, TNArchipelScopedGrant.user == u.name).all():
+                    if g.permission in permissions:
+                        legacy_user.permissions.append(permissions[g.permission])
+                legacy_session.add(legacy_user)
+            legacy_session.commit()
+        finally:
+            session.close()
+            legacy_session.close()
+            engine.dispose()
+
+    def drop_scope(self):
+        """
+        Remove all the users and grants of the scope.
+        """
+        session = self.create_session()
+        session.query(TNArchipelScopedGrant).filter(TNArchipelScopedGrant.scope == self.scope).delete()
+        session.query(TNArchipelScopedUser).filter(TNArchipelScopedUser.scope == self.scope).delete()
+        session.query(TNArchipelImportedScope).filter(TNArchipelImportedScope.scope == self.scope).delete()
+        session.commit()
+        session.close()
+        self.invalidate_cache()
+
+    ### Permission management
+
+    def create_permission(self, name, description="", default_permission=False, currentsession=None):
+        """
+        Register a permission definition in the shared store.
+        @type name: string
+        @param name: the name of the permission
+        @type description: string
+        @param description: the description of the permission
+        @type default_permission: Boolean
+        @param default_permission: the default value of permission if not set
+        @rtype: Boolean
+        @return: True if the permission was not known yet
+        """
+        if self.store.register_permission(name, description, default_permission):
+            self.invalidate_cache(permission_name=name)
+            return True
+        return False
+
+    def get_permission(self, name, currentsession=None):
+        """
+        Get the permission by name.
+        @type name: string
+        @param name: the name of the permission
+        @rtype: L{TNArchipelSharedPermission}
+        @return: the L{TNArchipelSharedPermission} object or None
+        """
+        if currentsession: session = currentsession
+        else: session = self.create_session()
+        p = session.query(TNArchipelSharedPermission).filter(TNArchipelSharedPermission.name == name).first()
+        if not currentsession: session.close()
+        return p
+
+    def delete_permission(self, name, currentsession=None):
+        """
+        Remove the grants of the permission in the scope. The definition
+        itself is shared, so it is kept.
+        @type name: string
+        @param name: the name of the permission
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        if currentsession: session = currentsession
+        else: session = self.create_session()
+        session.query(TNArchipelScopedGrant).filter(TNArchipelScopedGrant.scope == self.scope, TNArchipelScopedGrant.permission == name).delete()
+        session.commit()
+        if not currentsession: session.close()
+        self.invalidate_cache(permission_name=name)
+        if name == "all":
+            self.invalidate_cache()
+        return True
+
+    def get_permissions(self, currentsession=None):
+        """
+        Return all permissions.
+        """
+        if currentsession: session = currentsession
+        else: session = self.create_session()
+        permissions = session.query(TNArchipelSharedPermission).all()
+        if not currentsession: session.close()
+        return permissions
+
+    ### Users management
+
+    def create_user(self, name, currentsession=None):
+        """
+        Create a new user in the scope.
+        @type name: string
+        @param name: the name of the user
+        @rtype: L{TNArchipelScopedUser}
+        @return: the user or None if it already exists
+        """
+        if self.get_user(name, currentsession=currentsession):
+            return None
+        if currentsession: session = currentsession
+        else: session = self.create_session()
+        u = TNArchipelScopedUser(self.scope, name)
+        session.add(u)
+        session.commit()
+        if not currentsession: session.close()
+        self.invalidate_cache(user_name=name)
+        return u
+
+    def get_user(self, name, currentsession=None):
+        """
+        Get the user of the scope by name.
+        @type name: string
+        @param name: the name of the user
+        @rtype: L{TNArchipelScopedUser}
+        @return: the L{TNArchipelScopedUser} object or None
+        """
+        if currentsession: session = currentsession
+        else: session = self.create_session()
+        u = session.query(TNArchipelScopedUser).filter(TNArchipelScopedUser.scope == self.scope, TNArchipelScopedUser.name == name).first()
+        if not currentsession: session.close()
+        return u
+
+    def delete_user(self, name, currentsession=None):
+        """
+        Delete the user of the scope by name.
+        @type name: string
+        @param name: the name of the user
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        if currentsession: session = currentsession
+        else: session = self.create_session()
+        session.query(TNArchipelScopedGrant).filter(TNArchipelScopedGrant.scope == self.scope, TNArchipelScopedGrant.user == name).delete()
+        deleted = session.query(TNArchipelScopedUser).filter(TNArchipelScopedUser.scope == self.scope, TNArchipelScopedUser.name == name).delete()
+        session.commit()
+        if not currentsession: session.close()
+        self.invalidate_cache(user_name=name)
+        return deleted > 0
+
+    def grant_permission_to_user(self, permission_name, user_name, currentsession=None):
+        """
+        Grant given permission to given user.
+        @type permission_name: string
+        @param permission_name: the name of the permission
+        @type user_name: string
+        @param user_name: the name of the user
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        if currentsession: session = currentsession
+        else: session = self.create_session()
+        session.merge(TNArchipelScopedUser(self.scope, user_name))
+        session.merge(TNArchipelScopedGrant(self.scope, user_name, permission_name))
+        session.commit()
+        if not currentsession: session.close()
+        self.invalidate_cache(user_name=user_name)
+        return True
+
+    def revoke_permission_to_user(self, permission_name, user_name, currentsession=None):
+        """
+        Revoke given permission to given user.
+        @type permission_name: string
+        @param permission_name: the name of the permission
+        @type user_name: string
+        @param user_name: the name of the user
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        if currentsession: session = currentsession
+        else: session = self.create_session()
+        session.query(TNArchipelScopedGrant).filter(TNArchipelScopedGrant.scope == self.scope, TNArchipelScopedGrant.user == user_name, TNArchipelScopedGrant.permission == permission_name).delete()
+        session.commit()
+        if not currentsession: session.close()
+        self.invalidate_cache(user_name=user_name)
+        return True
+
+    def user_has_permission(self, user_name, permission_name, currentsession=None):
+        """
+        Check if user has permission.
+        @type user_name: string
+        @param user_name: the name of the user
+        @type permission_name: string
+        @param permission_name: the name of the permission
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        return permission_name in [p.name for p in self.get_user_permissions(user_name, currentsession=currentsession)]
+
+    def get_user_permissions(self, user_name, currentsession=None):
+        """
+        Get permissions of user.
+        @type user_name: string
+        @param user_name: the name of the user
+        @rtype: list of L{TNArchipelSharedPermission}
+        @return: the list L{TNArchipelSharedPermission} of user
+        """
+        if currentsession: session = currentsession
+        else: session = self.create_session()
+        ret = session.query(TNArchipelSharedPermission).join(TNArchipelScopedGrant, TNArchipelScopedGrant.permission == TNArchipelSharedPermission.name).filter(TNArchipelScopedGrant.scope == self.scope, TNArchipelScopedGrant.user == user_name).all()
+        if not currentsession: session.close()
+        return ret
+
+    ### User permissions verification
+
+    def _compute_permission(self, user_name, permission_name):
+        """
+        Compute the decision of check_permission from the shared database.
+        @type user_name: string
+        @param user_name: the name of the user
+        @type permission_name: string
+        @param permission_name: the name of the permission
+        @rtype: Boolean
+        @return: True if granted
+        """
+        if user_name in self.root_admins.values():
+            return True
+        session = self.create_session()
+        try:
+            permObject = self.get_permission(permission_name, currentsession=session)
+            if not self.get_user(user_name, currentsession=session):
+                return bool(permObject and permObject.defaultValue == 1)
+            granted = [p.name for p in self.get_user_permissions(user_name, currentsession=session)]
+            if "all" in granted:
+                return True
+            if not permObject:
+                return False
+            return permission_name in granted
+        finally:
+            session.close()
+
+    def close_database(self):
+        """
+        The shared store stays open for the other scopes. Just drop the cache.
+        """
+        self.invalidate_cache()
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+#
+# archipelReactor.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNArchipelReactor}, a single event loop that processes the XMPP
+streams of all the entities of a process.
+
+Instead of running one thread per entity that wakes up every 3 seconds, the
+reactor waits on all the entity sockets at once (epoll, or poll when epoll is
+not available), processes only the readable streams, and runs the periodic
+on_xmpp_loop_tick callbacks from a timer wheel. Entities that do not override
+on_xmpp_loop_tick do not cost any wakeup while idle.
+"""
+
+import collections
+import math
+import os
+import select
+import sys
+import threading
+import time
+import traceback
+from threading import Thread
+
+import archipelcore.archipelEntity
+
+
+ARCHIPEL_REACTOR_TICK_INTERVAL      = 3.0
+ARCHIPEL_REACTOR_RECONNECT_DELAY    = 5.0
+ARCHIPEL_REACTOR_WHEEL_RESOLUTION   = 0.1
+ARCHIPEL_REACTOR_WHEEL_SLOTS        = 512
+
+
+class TNReactorTimer (object):
+    """
+    A timer scheduled in a L{TNTimerWheel}.
+    """
+
+    def __init__(self, callback, delay, interval=None):
+        """
+        Initialize the TNReactorTimer.
+        @type callback: function
+        @param callback: the function to call
+        @type delay: float
+        @param delay: the delay before the first call
+        @type interval: float
+        @param interval: if set, the timer is re-armed with this interval after each call
+        """
+        self.callback   = callback
+        self.delay      = delay
+        self.interval   = interval
+        self.rounds     = 0
+        self.cancelled  = False
+
+    def cancel(self):
+        """
+        Cancel the timer. It will be dropped the next time its slot is reached.
+        """
+        self.cancelled = True
+
+
+class TNTimerWheel (object):
+    """
+    Hashed timer wheel. Scheduling and cancelling are O(1), and advancing
+    only looks at the slots that have expired.
+    """
+
+    def __init__(self, resolution=ARCHIPEL_REACTOR_WHEEL_RESOLUTION, slots=ARCHIPEL_REACTOR_WHEEL_SLOTS):
+        """
+        Initialize the TNTimerWheel.
+        @type resolution: float
+        @param resolution: the duration of one slot in seconds
+        @type slots: int
+        @param slots: the number of slots of the wheel
+        """
+        self.resolution = resolution
+        self.slots      = [[] for i in range(slots)]
+        self.current    = 0
+        self.last       = time.time()
+        self.count      = 0
+
+    def schedule(self, timer, delay):
+        """
+        Place a timer in the wheel.
+        @type timer: L{TNReactorTimer}
+        @param timer: the timer
+        @type delay: float
+        @param delay: the delay in seconds
+        """
+        ticks = max(1, int(math.ceil(delay / self.resolution)))
+        # the wheel is only advanced by the reactor loop, count the ticks elapsed since
+        ticks += max(0, int((time.time() - self.last) / self.resolution))
+        timer.rounds = (ticks - 1) / len(self.slots)
+        self.slots[(self.current + ticks) % len(self.slots)].append(timer)
+        self.count += 1
+
+    def advance(self, now):
+        """
+        Advance the wheel up to now.
+        @type now: float
+        @param now: the current time
+        @rtype: list
+        @return: the expired timers
+        """
+        expired = []
+        ticks = int((now - self.last) / self.resolution)
+        if not self.count:
+            self.current = (self.current + ticks) % len(self.slots)
+            self.last += ticks * self.resolution
+            return expired
+        for i in range(ticks):
+            self.current = (self.current + 1) % len(self.slots)
+            slot = self.slots[self.current]
+            if not slot:
+                continue
+            remaining = []
+            for timer in slot:
+                if timer.cancelled:
+                    self.count -= 1
+                elif timer.rounds > 0:
+                    timer.rounds -= 1
+                    remaining.append(timer)
+                else:
+                    self.count -= 1
+                    expired.append(timer)
+            self.slots[self.current] = remaining
+        self.last += ticks * self.resolution
+        return expired
+
+    def next_timeout(self, now):
+        """
+        @type now: float
+        @param now: the current time
+        @rtype: float
+        @return: the time until the next non empty slot or None if the wheel is empty
+        """
+        if not self.count:
+            return None
+        for i in range(1, len(self.slots) + 1):
+            if self.slots[(self.current + i) % len(self.slots)]:
+                return max(0.0, self.last + i * self.resolution - now)
+        return None
+
+
+class TNArchipelReactor (object):
+    """
+    Event loop owning the XMPP sockets of several L{TNArchipelEntity}.
+    All entity processing happens in the thread calling run(). Other threads
+    must use call_soon() to interact with it.
+    """
+
+    def __init__(self, log):
+        """
+        Initialize the TNArchipelReactor.
+        @type log: TNArchipelLogger
+        @param log: the logger to use
+        """
+        self.log            = log
+        self.entities       = {}
+        self.tick_timers    = {}
+        self.wheel          = TNTimerWheel()
+        self.pending        = collections.deque()
+        self.running        = False
+        self.thread         = None
+        self._lock          = threading.Lock()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self._poll_event = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+            self._poll_factor = 1.0
+        else:
+            self.poller = select.poll()
+            self._poll_event = select.POLLIN | select.POLLERR | select.POLLHUP
+            self._poll_factor = 1000.0
+        self.poller.register(self._wakeup_read, self._poll_event)
+
+
+    ### Scheduling
+
+    def call_soon(self, callback, *args):
+        """
+        Ask the reactor thread to run the given callback. Thread safe.
+        @type callback: function
+        @param callback: the function to call
+        """
+        with self._lock:
+            self.pending.append((callback, args))
+        os.write(self._wakeup_write, "x")
+
+    def call_later(self, delay, callback):
+        """
+        Schedule a callback. Must be called from the reactor thread (use call_soon otherwise).
+        @type delay: float
+        @param delay: the delay in seconds
+        @type callback: function
+        @param callback: the function to call
+        @rtype: L{TNReactorTimer}
+        @return: the timer
+        """
+        timer = TNReactorTimer(callback, delay)
+        self.wheel.schedule(timer, delay)
+        return timer
+
+    def call_every(self, interval, callback):
+        """
+        Schedule a periodic callback. Must be called from the reactor thread.
+        @type interval: float
+        @param interval: the interval in seconds
+        @type callback: function
+        @param callback: the function to call
+        @rtype: L{TNReactorTimer}
+        @return: the timer
+        """
+        timer = TNReactorTimer(callback, interval, interval)
+        self.wheel.schedule(timer, interval)
+        return timer
+
+
+    ### Entities
+
+    def register_entity(self, entity):
+        """
+        Give the XMPP stream of a connected entity to the reactor. Thread safe.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        """
+        self.call_soon(self._add_entity, entity)
+
+    def check_entity(self, entity):
+        """
+        Ask the reactor to act according to the loop status of the entity. Thread safe.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        """
+        self.call_soon(self._check_entity, entity)
+
+    def _fileno(self, entity):
+        """
+        @rtype: int
+        @return: the file descriptor of the XMPP stream of the entity
+        """
+        return entity.xmppclient.Connection._sock.fileno()
+
+    def _has_tick(self, entity):
+        """
+        @rtype: Boolean
+        @return: True if the entity overrides on_xmpp_loop_tick
+        """
+        return not entity.on_xmpp_loop_tick.im_func is archipelcore.archipelEntity.TNArchipelEntity.on_xmpp_loop_tick.im_func
+
+    def _add_entity(self, entity):
+        """
+        Start watching the stream of the entity.
+        """
+        if not entity.xmppclient or not entity.xmppclient.isConnected():
+            self._check_entity(entity)
+            return
+        fd = self._fileno(entity)
+        self.entities[fd] = entity
+        self.poller.register(fd, self._poll_event)
+        if self._has_tick(entity) and not entity in self.tick_timers:
+            self.tick_timers[entity] = self.call_every(ARCHIPEL_REACTOR_TICK_INTERVAL, entity.on_xmpp_loop_tick)
+        # some data may already have been buffered during authentication
+        self._process_entity(fd, entity)
+
+    def _remove_entity(self, entity):
+        """
+        Stop watching the stream of the entity.
+        """
+        for fd, e in self.entities.items():
+            if e is entity:
+                del self.entities[fd]
+                try:
+                    self.poller.unregister(fd)
+                except Exception:
+                    pass
+        if entity in self.tick_timers:
+            self.tick_timers.pop(entity).cancel()
+
+    def _process_entity(self, fd, entity):
+        """
+        Process all the available data of the stream of the entity.
+        """
+        try:
+            if not entity.loop_status == archipelcore.archipelEntity.ARCHIPEL_XMPP_LOOP_ON:
+                self._check_entity(entity)
+                return
+            entity.xmppclient.Process(0)
+            while entity.xmppclient.isConnected() and entity.xmppclient.Connection.pending_data(0):
+                entity.xmppclient.Process(0)
+            if not entity.xmppclient.isConnected():
+                raise Exception("Stream closed")
+        except Exception as ex:
+            if str(ex).upper().find('USER REMOVED') > -1:
+                entity.log.info("REACTOR: Account has been removed from server.")
+                entity.loop_status = archipelcore.archipelEntity.ARCHIPEL_XMPP_LOOP_OFF
+            else:
+                if str(ex).upper().find('SYSTEM-SHUTDOWN') > -1:
+                    entity.log.warning("REACTOR: The XMPP server has been shut down.")
+                else:
+                    t, v, tr = sys.exc_info()
+                    entity.log.error("REACTOR: Disconnected from server: %s" % "\n".join(traceback.format_exception(t, v, tr)))
+                entity.loop_status = archipelcore.archipelEntity.ARCHIPEL_XMPP_LOOP_RESTART
+        self._check_entity(entity)
+
+    def _check_entity(self, entity):
+        """
+        Act according to the loop status of the entity.
+        """
+        status = entity.loop_status
+        if status == archipelcore.archipelEntity.ARCHIPEL_XMPP_LOOP_ON:
+            return
+        self._remove_entity(entity)
+        if status == archipelcore.archipelEntity.ARCHIPEL_XMPP_LOOP_OFF:
+            if entity.xmppclient and entity.xmppclient.isConnected():
+                entity.xmppclient.disconnect()
+        elif status == archipelcore.archipelEntity.ARCHIPEL_XMPP_LOOP_REMOVE_USER:
+            # unregistration waits for the server answer, so don't block the reactor
+            Thread(target=entity.process_inband_unregistration).start()
+        elif status == archipelcore.archipelEntity.ARCHIPEL_XMPP_LOOP_RESTART:
+            entity.log.warning("REACTOR: Trying to reconnect in %d seconds." % ARCHIPEL_REACTOR_RECONNECT_DELAY)
+            self.call_later(ARCHIPEL_REACTOR_RECONNECT_DELAY, lambda: Thread(target=self._reconnect, args=(entity,)).start())
+
+    def _reconnect(self, entity):
+        """
+        Reconnect the entity. Runs in its own thread as connection is blocking.
+        """
+        try:
+            if entity.xmppclient and entity.xmppclient.isConnected():
+                entity.xmppclient.disconnect()
+            entity.connect()
+        except Exception as ex:
+            entity.log.error("REACTOR: Unable to reconnect: %s" % str(ex))
+            entity.loop_status = archipelcore.archipelEntity.ARCHIPEL_XMPP_LOOP_RESTART
+        self.register_entity(entity)
+
+
+    ### Loop
+
+    def _run_pending(self):
+        """
+        Run the callbacks queued with call_soon.
+        """
+        try:
+            os.read(self._wakeup_read, 4096)
+        except OSError:
+            pass
+        with self._lock:
+            pending = list(self.pending)
+            self.pending.clear()
+        for callback, args in pending:
+            try:
+                callback(*args)
+            except Exception as ex:
+                self.log.error("REACTOR: Error while running %s: %s" % (callback, str(ex)))
+
+    def _run_timers(self):
+        """
+        Run the expired timers and re-arm the periodic ones.
+        """
+        for timer in self.wheel.advance(time.time()):
+            try:
+                timer.callback()
+            except Exception as ex:
+                t, v, tr = sys.exc_info()
+                self.log.error("REACTOR: Error in timer %s: %s" % (timer.callback, "\n".join(traceback.format_exception(t, v, tr))))
+            if timer.interval and not timer.cancelled:
+                self.wheel.schedule(timer, timer.interval)
+
+    def run(self):
+        """
+        Run the reactor until stop() is called.
+        """
+        self.running = True
+        self.thread = threading.currentThread()
+        self.log.info("REACTOR: started")
+        while self.running:
+            timeout = self.wheel.next_timeout(time.time())
+            if timeout is None:
+                timeout = -1
+            else:
+                timeout = timeout * self._poll_factor
+            try:
+                events = self.poller.poll(timeout)
+            except (IOError, select.error) as ex:
+                # interrupted system call
+                events = []
+            for fd, event in events:
+                if fd == self._wakeup_read:
+                    self._run_pending()
+                elif fd in self.entities:
+                    self._process_entity(fd, self.entities[fd])
+            self._run_timers()
+        self.log.info("REACTOR: stopped")
+
+    def stop(self):
+        """
+        Stop the reactor. Thread safe.
+        """
+        def _stop():
+            self.running = False
+        self.call_soon(_stop)
@@ -0,0 +1,781 @@
+# -*- coding: utf-8 -*-
+#
+# archipelStreamMultiplexer.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNXMPPStreamMultiplexer}, that allows a lot of entities to share
+one single XMPP stream.
+
+The multiplexer opens one XEP-0114 component connection. Every entity whose
+JID belongs to the component domain is attached to it and receives a
+L{TNMultiplexedClient}, that mimics the parts of xmpp.Client the entities use
+(handlers, send, presence and roster). Incoming stanzas are routed to the
+right client according to their bare 'to' JID.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+import xmpp
+from threading import Thread
+
+
+ARCHIPEL_MULTIPLEXER_DEFAULT_PORT       = 5347
+ARCHIPEL_MULTIPLEXER_RESPONSE_TIMEOUT   = 25
+
+
+class TNMultiplexedRoster (object):
+    """
+    Roster of a multiplexed entity. Components have no server side roster,
+    so subscriptions are tracked from the presence stanzas the entity sends
+    and receives. If a path is given, the items are saved in this file, so
+    the subscribers are still known after a restart.
+    """
+
+    def __init__(self, client, path=None):
+        """
+        Initialize the TNMultiplexedRoster.
+        @type client: L{TNMultiplexedClient}
+        @param client: the client owning this roster
+        @type path: string
+        @param path: the file where the roster is saved, or None to keep it in memory only
+        """
+        self.client = client
+        self.path   = path
+        self._data  = {}
+        self._lock  = threading.RLock()
+        self._load()
+
+    def _load(self):
+        """
+        Load the items saved in the roster file, if any.
+        """
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as roster_file:
+                items = json.load(roster_file)
+            for jid, saved_item in items.iteritems():
+                item = self._item(jid)
+                item["name"] = saved_item.get("name")
+                item["groups"] = saved_item.get("groups", [])
+                item["subscription"] = saved_item.get("subscription", "none")
+        except Exception as ex:
+            self.client.log.error("MULTIPLEXER: unable to load the roster %s: %s" % (self.path, str(ex)))
+
+    def _save(self):
+        """
+        Save the items in the roster file. Must be called with the lock.
+        """
+        if not self.path:
+            return
+        items = {}
+        for jid, item in self._data.iteritems():
+            items[jid] = {"name": item["name"], "groups": item["groups"], "subscription": item["subscription"]}
+        try:
+            with open("%s.tmp" % self.path, "w") as roster_file:
+                json.dump(items, roster_file)
+            os.rename("%s.tmp" % self.path, self.path)
+        except Exception as ex:
+            self.client.log.error("MULTIPLEXER: unable to save the roster %s: %s" % (self.path, str(ex)))
+
+    def _item(self, jid):
+        """
+        Return the internal item of the given JID, creating it if needed.
+        @type jid: string or xmpp.JID
+        @param jid: the JID
+        @rtype: dict
+        @return: the roster item
+        """
+        jid = str(xmpp.JID(jid).getStripped())
+        if not jid in self._data:
+            self._data[jid] = {"name": None, "groups": [], "subscription": "none", "ask": None, "resources": {}}
+        return self._data[jid]
+
+    def _add_subscription(self, jid, direction):
+        """
+        Add a subscription direction ("to" or "from") to the given JID.
+        """
+        item = self._item(jid)
+        subscription = item["subscription"]
+        if item["subscription"] in ("none", direction):
+            item["subscription"] = direction
+        else:
+            item["subscription"] = "both"
+        if not item["subscription"] == subscription:
+            self._save()
+
+    def _remove_subscription(self, jid, direction):
+        """
+        Remove a subscription direction ("to" or "from") from the given JID.
+        """
+        item = self._item(jid)
+        subscription = item["subscription"]
+        if item["subscription"] == "both":
+            item["subscription"] = "from" if direction == "to" else "to"
+        elif item["subscription"] == direction:
+            item["subscription"] = "none"
+        if not item["subscription"] == subscription:
+            self._save()
+
+
+    ### xmpp.Roster API
+
+    def getItems(self):
+        """
+        @rtype: list
+        @return: the bare JIDs in the roster
+        """
+        with self._lock:
+            return self._data.keys()
+
+    def getItem(self, jid):
+        """
+        @rtype: dict
+        @return: the roster item of the given JID or None
+        """
+        with self._lock:
+            return self._data.get(str(xmpp.JID(jid).getStripped()))
+
+    def getResources(self, jid):
+        """
+        @rtype: list
+        @return: the online resources of the given JID
+        """
+        with self._lock:
+            return self._data[str(xmpp.JID(jid).getStripped())]["resources"].keys()
+
+    def getSubscription(self, jid):
+        """
+        @rtype: string
+        @return: the subscription state of the given JID
+        """
+        with self._lock:
+            return self._data[str(xmpp.JID(jid).getStripped())]["subscription"]
+
+    def getStatus(self, jid):
+        """
+        @rtype: string
+        @return: the status of the first online resource of the given JID or None
+        """
+        with self._lock:
+            resources = self._data[str(xmpp.JID(jid).getStripped())]["resources"]
+            for resource in resources.values():
+                return resource["status"]
+            return None
+
+    def setItem(self, jid, name=None, groups=[]):
+        """
+        Add or update an item in the roster.
+        """
+        with self._lock:
+            item = self._item(jid)
+            item["name"] = name
+            item["groups"] = groups
+            self._save()
+
+    def delItem(self, jid):
+        """
+        Remove an item from the roster, cancelling both subscriptions.
+        """
+        with self._lock:
+            bare = str(xmpp.JID(jid).getStripped())
+            if bare in self._data:
+                del self._data[bare]
+                self._save()
+        self.client.send(xmpp.Presence(to=jid, typ="unsubscribe"))
+        self.client.send(xmpp.Presence(to=jid, typ="unsubscribed"))
+
+    def Subscribe(self, jid):
+        """
+        Ask for subscription to the given JID.
+        """
+        with self._lock:
+            self._item(jid)["ask"] = "subscribe"
+        self.client.send(xmpp.Presence(to=jid, typ="subscribe"))
+
+    def Unsubscribe(self, jid):
+        """
+        Cancel the subscription to the given JID.
+        """
+        with self._lock:
+            self._remove_subscription(jid, "to")
+        self.client.send(xmpp.Presence(to=jid, typ="unsubscribe"))
+
+    def Authorize(self, jid):
+        """
+        Authorize the given JID to see the presence of the entity.
+        """
+        with self._lock:
+            self._add_subscription(jid, "from")
+        self.client.send(xmpp.Presence(to=jid, typ="subscribed"))
+        self.client.send_last_presence(jid)
+
+    def Unauthorize(self, jid):
+        """
+        Forbid the given JID to see the presence of the entity.
+        """
+        with self._lock:
+            self._remove_subscription(jid, "from")
+        self.client.send(xmpp.Presence(to=jid, typ="unsubscribed"))
+
+    def subscribers(self):
+        """
+        @rtype: list
+        @return: the bare JIDs allowed to receive the presence of the entity
+        """
+        with self._lock:
+            return [jid for jid, item in self._data.iteritems() if item["subscription"] in ("from", "both")]
+
+    def on_presence(self, presence):
+        """
+        Update the roster according to a received presence.
+        @type presence: xmpp.Presence
+        @param presence: the received presence
+        """
+        jid = presence.getFrom()
+        typ = presence.getType()
+        with self._lock:
+            if typ == "subscribed":
+                self._add_subscription(jid, "to")
+                self._item(jid)["ask"] = None
+            elif typ == "unsubscribed":
+                self._remove_subscription(jid, "to")
+            elif typ == "unsubscribe":
+                self._remove_subscription(jid, "from")
+            elif typ == "probe":
+                # servers only probe for the users subscribed to our presence. This
+                # restores the subscriptions the roster does not know anymore, only
+                # for the contacts it has: the probe itself is answered without an item
+                item = self._data.get(str(jid.getStripped()))
+                if item and (item["name"] or item["groups"] or item["ask"] or not item["subscription"] == "none"):
+                    self._add_subscription(jid, "from")
+            elif typ in (None, "", "available"):
+                self._item(jid)["resources"][jid.getResource()] = {"show": presence.getShow(), "status": presence.getStatus(), "priority": presence.getPriority()}
+            elif typ == "unavailable":
+                bare = str(jid.getStripped())
+                if bare in self._data and jid.getResource() in self._data[bare]["resources"]:
+                    del self._data[bare]["resources"][jid.getResource()]
+
+
+class TNMultiplexedClient (object):
+    """
+    Per entity facade over a L{TNXMPPStreamMultiplexer}. It exposes the
+    subset of the xmpp.Client API used by L{TNArchipelEntity} and its plugins,
+    so handlers are registered and called exactly like with a dedicated stream.
+    """
+
+    is_multiplexed = True
+
+    def __init__(self, multiplexer, jid, log, roster_path=None):
+        """
+        Initialize the TNMultiplexedClient.
+        @type multiplexer: L{TNXMPPStreamMultiplexer}
+        @param multiplexer: the multiplexer owning the stream
+        @type jid: xmpp.JID
+        @param jid: the full JID of the entity
+        @type log: TNArchipelLogger
+        @param log: the logger of the entity
+        @type roster_path: string
+        @param roster_path: the file where the roster is saved, or None to keep it in memory only
+        """
+        self.multiplexer    = multiplexer
+        self.jid            = jid
+        self.log            = log
+        self.handlers       = []
+        self.roster         = TNMultiplexedRoster(self, roster_path)
+        self.last_presence  = None
+        self.vcard          = None
+        self.attached       = True
+        self._lock          = threading.RLock()
+
+
+    ### Handlers
+
+    def RegisterHandler(self, name, handler, typ="", ns="", xmlns=None, makefirst=False, system=False):
+        """
+        Register a stanza handler, like xmpp.Dispatcher.RegisterHandler.
+        """
+        entry = {"name": name, "handler": handler, "typ": typ, "ns": ns}
+        with self._lock:
+            if makefirst:
+                self.handlers.insert(0, entry)
+            else:
+                self.handlers.append(entry)
+
+    def UnregisterHandler(self, name, handler, typ="", ns="", xmlns=None):
+        """
+        Unregister a stanza handler, like xmpp.Dispatcher.UnregisterHandler.
+        """
+        with self._lock:
+            self.handlers = [h for h in self.handlers if not (h["name"] == name and h["handler"] == handler and h["typ"] == typ and h["ns"] == ns)]
+
+    def RegisterDisconnectHandler(self, handler):
+        """
+        Ignored: the multiplexer owns the stream and handles reconnection itself.
+        """
+        pass
+
+    def dispatch(self, stanza):
+        """
+        Call the registered handlers matching the given stanza.
+        @type stanza: xmpp.Protocol
+        @param stanza: the stanza addressed to this entity
+        """
+        name = stanza.getName()
+        typ = stanza.getType() or ""
+        namespaces = [child.getNamespace() for child in stanza.getChildren()]
+
+        if name == "presence":
+            self.roster.on_presence(stanza)
+            if typ == "probe":
+                self.send_last_presence(stanza.getFrom())
+                return
+
+        if name == "iq" and typ == "get" and "vcard-temp" in namespaces and self.vcard:
+            reply = stanza.buildReply("result")
+            reply.addChild(node=self.vcard)
+            self.send(reply)
+            return
+
+        with self._lock:
+            handlers = list(self.handlers)
+        for entry in handlers:
+            if not entry["name"] == name:
+                continue
+            if entry["typ"] and not entry["typ"] == typ:
+                continue
+            if entry["ns"] and not entry["ns"] in namespaces:
+                continue
+            try:
+                entry["handler"](self, stanza)
+            except xmpp.protocol.NodeProcessed:
+                return
+        if name == "iq" and typ in ("get", "set"):
+            self.send(xmpp.Error(stanza, xmpp.ERR_FEATURE_NOT_IMPLEMENTED))
+
+
+    ### Sending
+
+    def _stamp(self, stanza):
+        """
+        Set the 'from' attribute of the stanza to the entity JID.
+        """
+        if not stanza.getFrom():
+            stanza.setFrom(self.jid)
+        return stanza
+
+    def _is_self_addressed(self, stanza):
+        """
+        @rtype: Boolean
+        @return: True if the stanza is addressed to the entity account (i.e. to the server on behalf of the user)
+        """
+        to = stanza.getTo()
+        return not to or str(to.getStripped()) == str(self.jid.getStripped())
+
+    def _process_local_iq(self, stanza):
+        """
+        Answer locally the IQs that a client would send to its own account
+        (the vCard storage), as there is no user account behind a component.
+        @rtype: xmpp.Iq
+        @return: the reply or None if the IQ must be sent to the stream
+        """
+        if not stanza.getName() == "iq" or not self._is_self_addressed(stanza):
+            return None
+        vcard = stanza.getTag("vCard")
+        if not vcard or not vcard.getNamespace() == "vcard-temp":
+            return None
+        stanza.setTo(self.jid.getStripped())
+        stanza.setFrom(self.jid.getStripped())
+        if stanza.getType() == "set":
+            self.vcard = vcard
+            return stanza.buildReply("result")
+        reply = stanza.buildReply("result")
+        if self.vcard:
+            reply.addChild(node=self.vcard)
+        return reply
+
+    def _broadcast_presence(self, presence):
+        """
+        Store the presence and send it to all the subscribers, as the server
+        would do for a client broadcast presence.
+        """
+        self.last_presence = presence
+        for jid in self.roster.subscribers():
+            self.send_last_presence(jid)
+
+    def send_last_presence(self, jid):
+        """
+        Send the last broadcast presence to the given JID.
+        @type jid: xmpp.JID
+        @param jid: the recipient
+        """
+        if not self.last_presence:
+            return
+        presence = xmpp.Presence(node=self.last_presence)
+        presence.setTo(jid)
+        presence.setFrom(self.jid)
+        self.multiplexer.send(presence)
+
+    def send(self, stanza):
+        """
+        Send a stanza on behalf of the entity.
+        @type stanza: xmpp.Protocol
+        @param stanza: the stanza to send
+        @rtype: string
+        @return: the ID of the stanza
+        """
+        if not stanza.getID():
+            stanza.setID(self.multiplexer.next_id())
+        if stanza.getName() == "presence" and not stanza.getTo() and stanza.getType() in (None, "", "unavailable"):
+            self._broadcast_presence(stanza)
+            return stanza.getID()
+        reply = self._process_local_iq(stanza)
+        if reply:
+            self.multiplexer.loopback(self, reply)
+            return stanza.getID()
+        return self.multiplexer.send(self._stamp(stanza))
+
+    def SendAndCallForResponse(self, stanza, func, args={}):
+        """
+        Send a stanza and call func(conn, response, **args) when the response arrives.
+        """
+        if not stanza.getID():
+            stanza.setID(self.multiplexer.next_id())
+        if stanza.getName() == "presence" and not stanza.getTo():
+            # the server reflects broadcast presences to the client, do the same
+            self.send(stanza)
+            self.multiplexer.loopback(self, stanza, func, args)
+            return stanza.getID()
+        self.multiplexer.expect(stanza.getID(), self, func, args)
+        return self.send(stanza)
+
+    def SendAndWaitForResponse(self, stanza, timeout=None):
+        """
+        Send a stanza and block until the response arrives or timeout expires.
+        @rtype: xmpp.Protocol
+        @return: the response or None
+        """
+        if not timeout:
+            timeout = ARCHIPEL_MULTIPLEXER_RESPONSE_TIMEOUT
+        event = threading.Event()
+        result = {}
+        def _on_response(conn, resp):
+            result["response"] = resp
+            event.set()
+        self.SendAndCallForResponse(stanza, _on_response)
+        if threading.currentThread() is self.multiplexer:
+            # we are in the stream thread, so we have to pump the stream ourselves
+            deadline = time.time() + timeout
+            while not event.isSet() and time.time() < deadline:
+                self.multiplexer.process(1)
+        else:
+            event.wait(timeout)
+        return result.get("response")
+
+    def sendPresence(self, jid=None, typ=None, requestRoster=0):
+        """
+        Send a presence, like xmpp.Client.sendPresence.
+        """
+        self.send(xmpp.Presence(to=jid, typ=typ))
+
+
+    ### Client
+
+    def getRoster(self):
+        """
+        @rtype: L{TNMultiplexedRoster}
+        @return: the roster of the entity
+        """
+        return self.roster
+
+    def isConnected(self):
+        """
+        @rtype: Boolean
+        @return: True if attached and the shared stream is connected
+        """
+        return self.attached and self.multiplexer.isConnected()
+
+    def Process(self, timeout=0):
+        """
+        Stanzas are processed by the multiplexer thread. Just sleep.
+        """
+        time.sleep(timeout)
+        return 1
+
+    def disconnect(self):
+        """
+        Send unavailable presence and detach from the multiplexer.
+        """
+        if not self.attached:
+            return
+        if self.multiplexer.isConnected():
+            self._broadcast_presence(xmpp.Presence(typ="unavailable"))
+        self.multiplexer.detach(self)
+        self.attached = False
+
+    def on_stream_restored(self):
+        """
+        Called by the multiplexer when the stream has been reopened.
+        Announce again the last presence.
+        """
+        if self.last_presence:
+            self._broadcast_presence(self.last_presence)
+
+
+class TNXMPPStreamMultiplexer (Thread):
+    """
+    Owns one XMPP component stream and routes its stanzas
+    to the attached L{TNMultiplexedClient}.
+    """
+
+    def __init__(self, domain, secret, address, log, debug=False):
+        """
+        Initialize the TNXMPPStreamMultiplexer.
+        @type domain: string
+        @param domain: the component domain (i.e. vm.example.com)
+        @type secret: string
+        @param secret: the component shared secret
+        @type address: string
+        @param address: the component listener, as "host" or "host:port"
+        @type log: TNArchipelLogger
+        @param log: the logger to use
+        @type debug: Boolean
+        @param debug: if True, activate xmpppy debug
+        """
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.domain         = domain.lower()
+        self.secret         = secret
+        self.log            = log
+        self.debug          = debug
+        self.clients        = {}
+        self.expected       = {}
+        self.component      = None
+        self.running        = False
+        self.connected      = threading.Event()
+        self._lock          = threading.RLock()
+        self._send_lock     = threading.RLock()
+        self._id_counter    = 0
+        if ":" in address:
+            host, port = address.split(":")
+            self.address = (host, int(port))
+        else:
+            self.address = (address, ARCHIPEL_MULTIPLEXER_DEFAULT_PORT)
+
+
+    ### Entities management
+
+    def handles(self, jid):
+        """
+        @type jid: xmpp.JID
+        @param jid: the JID to check
+        @rtype: Boolean
+        @return: True if the given JID belongs to the component domain
+        """
+        return jid.getDomain().lower() == self.domain
+
+    def attach(self, jid, log, timeout=30, roster_path=None):
+        """
+        Attach an entity to the stream.
+        @type jid: xmpp.JID
+        @param jid: the JID of the entity
+        @type log: TNArchipelLogger
+        @param log: the logger of the entity
+        @type timeout: int
+        @param timeout: time to wait for the stream to be connected
+        @type roster_path: string
+        @param roster_path: the file where the roster of the entity is saved, or None to keep it in memory only
+        @rtype: L{TNMultiplexedClient}
+        @return: the client to use or None if the stream is not connected
+        """
+        if not self.connected.wait(timeout) and not self.connected.isSet():
+            return None
+        client = TNMultiplexedClient(self, jid, log, roster_path)
+        with self._lock:
+            self.clients[str(jid.getStripped()).lower()] = client
+        self.log.info("MULTIPLEXER: entity %s attached (%d entities)" % (jid, len(self.clients)))
+        return client
+
+    def detach(self, client):
+        """
+        Detach an entity from the stream.
+        @type client: L{TNMultiplexedClient}
+        @param client: the client to detach
+        """
+        with self._lock:
+            key = str(client.jid.getStripped()).lower()
+            if self.clients.get(key) is client:
+                del self.clients[key]
+            for stanza_id in [k for k, v in self.expected.iteritems() if v[0] is client]:
+                del self.expected[stanza_id]
+        self.log.info("MULTIPLEXER: entity %s detached (%d entities)" % (client.jid, len(self.clients)))
+
+
+    ### Stream
+
+    def next_id(self):
+        """
+        @rtype: string
+        @return: a new unique stanza ID
+        """
+        with self._send_lock:
+            self._id_counter += 1
+            return "mux%d" % self._id_counter
+
+    def isConnected(self):
+        """
+        @rtype: Boolean
+        @return: True if the component stream is connected
+        """
+        return self.connected.isSet()
+
+    def send(self, stanza):
+        """
+        Send a stanza on the shared stream.
+        @type stanza: xmpp.Protocol
+        @param stanza: the stanza to send
+        @rtype: string
+        @return: the ID of the stanza
+        """
+        if not self.connected.isSet():
+            raise Exception("Component stream %s is not connected" % self.domain)
+        with self._send_lock:
+            return self.component.send(stanza)
+
+    def expect(self, stanza_id, client, func, args):
+        """
+        Register a callback for the response of the given stanza ID.
+        """
+        with self._lock:
+            self.expected[stanza_id] = (client, func, args)
+
+    def loopback(self, client, stanza, func=None, args={}):
+        """
+        Deliver a locally generated response to the given client.
+        """
+        if func:
+            try:
+                func(client, stanza, **args)
+            except xmpp.protocol.NodeProcessed:
+                pass
+            return
+        with self._lock:
+            expected = self.expected.pop(stanza.getID(), None)
+        if expected:
+            try:
+                expected[1](client, stanza, **expected[2])
+            except xmpp.protocol.NodeProcessed:
+                pass
+
+    def process(self, timeout):
+        """
+        Process the stream for at most timeout seconds.
+        """
+        if not self.component.Process(timeout) and not self.component.isConnected():
+            raise Exception("Component stream has been closed")
+
+    def route(self, conn, stanza):
+        """
+        Route a received stanza to the right client. Registered as the only
+        handler of the component.
+        @type conn: xmpp.Component
+        @param conn: the component stream
+        @type stanza: xmpp.Protocol
+        @param stanza: the received stanza
+        """
+        to = stanza.getTo()
+        if not to:
+            raise xmpp.protocol.NodeProcessed
+        with self._lock:
+            client = self.clients.get(str(to.getStripped()).lower())
+            expected = None
+            if client and stanza.getType() in ("result", "error") and stanza.getID() in self.expected:
+                expected = self.expected.pop(stanza.getID())
+        if not client:
+            if stanza.getName() == "iq" and stanza.getType() in ("get", "set"):
+                self.component.send(xmpp.Error(stanza, xmpp.ERR_ITEM_NOT_FOUND))
+            raise xmpp.protocol.NodeProcessed
+        try:
+            if expected:
+                expected[1](client, stanza, **expected[2])
+            else:
+                client.dispatch(stanza)
+        except xmpp.protocol.NodeProcessed:
+            pass
+        except Exception as ex:
+            t, v, tr = sys.exc_info()
+            self.log.error("MULTIPLEXER: error while processing stanza for %s: %s" % (to, str(ex)))
+            self.log.error("MULTIPLEXER: TRACEBACK: %s" % "\n".join(traceback.format_exception(t, v, tr)))
+        raise xmpp.protocol.NodeProcessed
+
+    def connect(self):
+        """
+        Open and authenticate the component stream.
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        debug_mode = []
+        if self.debug:
+            debug_mode = ['always', 'nodebuilder']
+        self.component = xmpp.Component(self.domain, self.address[1], debug=debug_mode)
+        if not self.component.connect(server=self.address):
+            self.log.warning("MULTIPLEXER: unable to connect to component listener %s:%s" % self.address)
+            return False
+        if not self.component.auth(self.domain, self.secret):
+            self.log.error("MULTIPLEXER: unable to authenticate component %s. Check the secret." % self.domain)
+            return False
+        for name in ("iq", "message", "presence"):
+            self.component.RegisterHandler(name, self.route)
+        self.connected.set()
+        self.log.info("MULTIPLEXER: component stream %s opened" % self.domain)
+        with self._lock:
+            clients = self.clients.values()
+        for client in clients:
+            client.on_stream_restored()
+        return True
+
+    def run(self):
+        """
+        Main loop of the stream. Reconnect on any error.
+        """
+        self.running = True
+        while self.running:
+            try:
+                if not self.connected.isSet():
+                    if not self.connect():
+                        time.sleep(5.0)
+                    continue
+                self.process(1)
+            except Exception as ex:
+                self.connected.clear()
+                self.log.error("MULTIPLEXER: component stream lost (%s). Reconnecting in 5 seconds." % str(ex))
+                time.sleep(5.0)
+        if self.component and self.component.isConnected():
+            self.component.disconnect()
+
+    def stop(self):
+        """
+        Stop the main loop.
+        """
+        self.running = False
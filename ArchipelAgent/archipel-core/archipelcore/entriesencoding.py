@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#
+# entriesencoding.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compact encoding of the central database entries exchanged between the
+hypervisors and the central agent.
+
+The legacy encoding sends one <entry> node per row, with one <item key value>
+node per column. The compact encoding sends one <entries> node, containing
+the columns once and the rows as JSON arrays, compressed with zlib and
+encoded in base64 when the payload is big:
+
+    <entries encoding="compact" compression="zlib" count="2">eJyrVkr...</entries>
+
+A missing value is encoded as null, every other value as its string, so the
+decoded entries are the same as the legacy ones.
+
+The encodings supported by an entity are sent in the "encodings" attribute
+of its requests and keepalives. An entity only uses the compact encoding if
+its peer announced it, and falls back to the legacy one otherwise.
+
+The same way, the central agent announces the optional actions it supports
+in the "features" attribute of its keepalives, so the hypervisors only use
+them with a central agent which knows them.
+
+The fingerprint of a vm definition, used to only send the definitions the
+central agent does not know yet, is computed by L{get_domain_fingerprint}
+on both sides.
+"""
+
+import base64
+import hashlib
+import json
+import zlib
+
+import xmpp
+
+
+ARCHIPEL_ENTRIES_ENCODING_COMPACT           = "compact"
+ARCHIPEL_ENTRIES_ENCODINGS                  = (ARCHIPEL_ENTRIES_ENCODING_COMPACT,)
+ARCHIPEL_ENTRIES_COMPRESSION_THRESHOLD      = 4096
+
+ARCHIPEL_CENTRALAGENT_FEATURE_SYNC_VMS      = "sync_vms"
+ARCHIPEL_CENTRALAGENT_FEATURES              = (ARCHIPEL_CENTRALAGENT_FEATURE_SYNC_VMS,)
+
+
+def get_encodings(node):
+    """
+    Return the entries encodings announced in a node.
+    @type node: xmpp.Node
+    @param node: the node carrying the "encodings" attribute
+    @rtype: list
+    @return: the list of encodings, empty if none is announced
+    """
+    if not node or not node.getAttr("encodings"):
+        return []
+    return [encoding.strip() for encoding in node.getAttr("encodings").split(",")]
+
+def get_features(node):
+    """
+    Return the central agent features announced in a node.
+    @type node: xmpp.Node
+    @param node: the node carrying the "features" attribute
+    @rtype: list
+    @return: the list of features, empty if none is announced
+    """
+    if not node or not node.getAttr("features"):
+        return []
+    return [feature.strip() for feature in node.getAttr("features").split(",")]
+
+def get_domain_fingerprint(domain):
+    """
+    Return the fingerprint of a domain definition. The definition is
+    parsed and serialized again, so the hypervisor, which has the node,
+    and the central agent, which has the string it received, compute the
+    same fingerprint.
+    @type domain: xmpp.Node or string
+    @param domain: the definition of the domain
+    @rtype: string
+    @return: the SHA1 of the XML description, or None if there is none
+    """
+    if domain is None:
+        return None
+    domain_xml = xmpp.simplexml.ustr(domain)
+    if not domain_xml or domain_xml == "None":
+        return None
+    try:
+        domain_xml = xmpp.simplexml.ustr(xmpp.simplexml.NodeBuilder(data=domain_xml.encode("utf-8")).getDom())
+    except Exception:
+        pass
+    return hashlib.sha1(domain_xml.encode("utf-8")).hexdigest()
+
+def is_compact_entries_node(node):
+    """
+    Check if a node contains entries in compact encoding.
+    @type node: xmpp.Node
+    @param node: the node to check
+    @rtype: bool
+    @return: True if the node is a compact <entries> node
+    """
+    return node.getName() == "entries" and node.getAttr("encoding") == ARCHIPEL_ENTRIES_ENCODING_COMPACT
+
+def encode_payload(node, obj, compression_threshold=ARCHIPEL_ENTRIES_COMPRESSION_THRESHOLD):
+    """
+    Set the data of a node to the JSON encoding of an object, compressed
+    with zlib and encoded in base64 if it is big.
+    @type node: xmpp.Node
+    @param node: the node to fill
+    @type obj: object
+    @param obj: the object to encode
+    @type compression_threshold: int
+    @param compression_threshold: the size in bytes above which the payload is compressed, None to never compress
+    @rtype: xmpp.Node
+    @return: the node
+    """
+    payload = json.dumps(obj, separators=(",", ":"), default=xmpp.simplexml.ustr)
+    if compression_threshold is not None and len(payload) > compression_threshold:
+        payload = base64.b64encode(zlib.compress(payload))
+        node.setAttr("compression", "zlib")
+    node.setData(payload)
+    return node
+
+def decode_payload(node):
+    """
+    Return the object encoded in the data of a node by L{encode_payload}.
+    @type node: xmpp.Node
+    @param node: the node
+    @rtype: object
+    @return: the decoded object, None if the node has no data
+    """
+    payload = node.getData()
+    if not payload:
+        return None
+    if node.getAttr("compression") == "zlib":
+        payload = zlib.decompress(base64.b64decode(payload))
+    elif node.getAttr("compression"):
+        raise Exception("Unsupported payload compression %s" % node.getAttr("compression"))
+    return json.loads(payload)
+
+def pack_compact_entries(entries, compression_threshold=ARCHIPEL_ENTRIES_COMPRESSION_THRESHOLD):
+    """
+    Pack a list of entries in compact encoding.
+    @type entries: list
+    @param entries: list of dict entries
+    @type compression_threshold: int
+    @param compression_threshold: the size in bytes above which the payload is compressed, None to never compress
+    @rtype: xmpp.Node
+    @return: the <entries> node
+    """
+    columns = []
+    column_indexes = {}
+    rows = []
+    for entry in entries:
+        row = [None] * len(columns)
+        for key, value in entry.iteritems():
+            if not key in column_indexes:
+                column_indexes[key] = len(columns)
+                columns.append(key)
+                row.append(None)
+            row[column_indexes[key]] = xmpp.simplexml.ustr(value)
+        rows.append(row)
+
+    node = xmpp.Node("entries", attrs={"encoding": ARCHIPEL_ENTRIES_ENCODING_COMPACT, "count": len(rows)})
+    return encode_payload(node, {"columns": columns, "rows": rows}, compression_threshold)
+
+def unpack_compact_entries(node):
+    """
+    Unpack the entries of a node in compact encoding.
+    @type node: xmpp.Node
+    @param node: the <entries> node
+    @rtype: list
+    @return: list of dict entries
+    """
+    table = decode_payload(node)
+    if not table:
+        return []
+    columns = table["columns"]
+    entries = []
+    for row in table["rows"]:
+        entries.append(dict((columns[i], value) for i, value in enumerate(row) if value is not None))
+    return entries
@@ -25,15 +25,17 @@ this module contains some functions that allow objects to use advanced logging
 functionalities or others common stuffs
 """
 
+import atexit
 import ConfigParser
+import Queue
 import socket
 import struct
 import fcntl
-import inspect
 import glob
 import logging
 import logging.handlers
 import os
+import threading
 import xmpp
 import sys
 import traceback
@@ -48,10 +50,38 @@ ARCHIPEL_LOG_INFO                               = 1
 ARCHIPEL_LOG_WARNING                            = 2
 ARCHIPEL_LOG_ERROR                              = 3
 
+ARCHIPEL_LOG_LEVELS_MAPPING                     = {ARCHIPEL_LOG_DEBUG: logging.DEBUG,
+                                                   ARCHIPEL_LOG_INFO: logging.INFO,
+                                                   ARCHIPEL_LOG_WARNING: logging.WARNING,
+                                                   ARCHIPEL_LOG_ERROR: logging.ERROR}
+
+ARCHIPEL_LOG_ASYNC_QUEUE_SIZE                   = 10000
+ARCHIPEL_LOG_ASYNC_CLOSE_TIMEOUT                = 5
+
 
 log = logging.getLogger('archipel')
 
 
+class TNArchipelLogMessage (object):
+    """
+    Log message formatted only when a handler really emits it.
+    """
+    __slots__ = ("entity_class", "caller", "jid", "msg", "args")
+
+    def __init__(self, entity_class, caller, jid, msg, args):
+        self.entity_class   = entity_class
+        self.caller         = caller
+        self.jid            = jid
+        self.msg            = msg
+        self.args           = args
+
+    def __str__(self):
+        msg = self.msg
+        if self.args:
+            msg = msg % self.args
+        return "\033[33m%s.%s (%s)\033[0m::%s" % (self.entity_class, self.caller, self.jid, msg)
+
+
 class TNArchipelLogger:
     """
     archipel logger implt
@@ -62,36 +92,106 @@ class TNArchipelLogger:
         self.entity     = entity
         self.pubSubNode = pubsubnode
 
-    def __log(self, level, msg):
-        log = logging.getLogger('archipel')
-        msg = "\033[33m%s.%s (%s)\033[0m::%s" % (self.entity.__class__.__name__, inspect.stack()[2][3],  self.entity.jid, msg)
+    def __log(self, level, msg, args):
         if level < ARCHIPEL_LOG_LEVEL:
             return
-        elif level == ARCHIPEL_LOG_DEBUG:
-            log.debug(msg)
-        elif level == ARCHIPEL_LOG_INFO:
-            log.info(msg)
-        elif level == ARCHIPEL_LOG_WARNING:
-            log.warning(msg)
-        elif level == ARCHIPEL_LOG_ERROR:
-            log.error(msg)
+        level = ARCHIPEL_LOG_LEVELS_MAPPING[level]
+        if not log.isEnabledFor(level):
+            return
+        # frame 0 is __log, 1 is debug/info/..., 2 is the caller
+        caller = sys._getframe(2).f_code.co_name
+        log.log(level, TNArchipelLogMessage(self.entity.__class__.__name__, caller, self.entity.jid, msg, args))
 
         # if self.xmppclient and self.pubSubNode:
         #     log = xmpp.Node(tag="log", attrs={"date": datetime.datetime.now(), "level": str(level)})
         #     log.setData(msg)
         #     self.pubSubNode.add_item(log)
 
-    def debug(self, msg):
-        self.__log(ARCHIPEL_LOG_DEBUG, msg)
+    def debug(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_DEBUG, msg, args)
+
+    def info(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_INFO, msg, args)
+
+    def warning(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_WARNING, msg, args)
+
+    def error(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_ERROR, msg, args)
 
-    def info(self, msg):
-        self.__log(ARCHIPEL_LOG_INFO, msg)
 
-    def warning(self, msg):
-        self.__log(ARCHIPEL_LOG_WARNING, msg)
+class TNArchipelAsyncLogHandler (logging.Handler):
+    """
+    Handler that only queues the records. A worker thread passes them to
+    the real handler, so logging never waits for the disk. When the queue is
+    full, records are dropped and the number of dropped records is reported.
+    The queued records are written when the handler is closed, at the latest
+    when the process exits.
+    """
 
-    def error(self, msg):
-        self.__log(ARCHIPEL_LOG_ERROR, msg)
+    def __init__(self, handler, queue_size=ARCHIPEL_LOG_ASYNC_QUEUE_SIZE):
+        """
+        Initialize the TNArchipelAsyncLogHandler.
+        @type handler: logging.Handler
+        @param handler: the handler doing the real work
+        @type queue_size: int
+        @param queue_size: the max number of pending records
+        """
+        logging.Handler.__init__(self)
+        self.handler    = handler
+        self.queue      = Queue.Queue(queue_size)
+        self.dropped    = 0
+        self.closed     = False
+        self.drop_lock  = threading.Lock()
+        self.worker     = threading.Thread(target=self.process_queue)
+        self.worker.setDaemon(True)
+        self.worker.start()
+        atexit.register(self.close)
+
+    def emit(self, record):
+        """
+        Queue the record.
+        """
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            with self.drop_lock:
+                self.dropped += 1
+
+    def process_queue(self):
+        """
+        Worker thread main loop. Stops at the None record queued by close().
+        """
+        while True:
+            record = self.queue.get()
+            with self.drop_lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                self.handler.handle(logging.LogRecord(getattr(record, "name", "archipel"), logging.WARNING, __file__, 0, "%d log records dropped: logging queue full" % dropped, None, None))
+            if record is None:
+                break
+            self.handler.handle(record)
+
+    def setFormatter(self, fmt):
+        self.handler.setFormatter(fmt)
+
+    def flush(self):
+        self.handler.flush()
+
+    def close(self):
+        """
+        Write the queued records, stop the worker and close the real handler.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.queue.put(None, timeout=ARCHIPEL_LOG_ASYNC_CLOSE_TIMEOUT)
+            self.worker.join(ARCHIPEL_LOG_ASYNC_CLOSE_TIMEOUT)
+        except Queue.Full:
+            pass
+        self.handler.close()
+        logging.Handler.close(self)
 
 
 class ColorFormatter (logging.Formatter):
@@ -161,12 +261,17 @@ def init_log(conf):
     handler         = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
     log_format      = ColorFormatter(conf.get("LOGGING", "logging_formatter", raw=True), conf.get("LOGGING", "logging_date_format", raw=True))
     handler.setFormatter(log_format)
+    if conf.has_option("LOGGING", "logging_async") and conf.getboolean("LOGGING", "logging_async"):
+        queue_size = ARCHIPEL_LOG_ASYNC_QUEUE_SIZE
+        if conf.has_option("LOGGING", "logging_async_queue_size"):
+            queue_size = conf.getint("LOGGING", "logging_async_queue_size")
+        handler = TNArchipelAsyncLogHandler(handler, queue_size)
     logger.addHandler(handler)
     logger.setLevel(level)
 
 
 def build_error_iq(originclass, ex, iq, code=-1, ns=ARCHIPEL_NS_GENERIC_ERROR):
-    caller = inspect.stack()[1][3]
+    caller = sys._getframe(1).f_code.co_name
     log.error("%s.%s: exception raised is: '%s' triggered by stanza :\n%s" % (originclass, caller, ex, str(iq)))
     t, v, tr = sys.exc_info()
     log.debug("\n".join(traceback.format_exception(t,v,tr)))
@@ -187,7 +292,10 @@ def build_error_iq(originclass, ex, iq, code=-1, ns=ARCHIPEL_NS_GENERIC_ERROR):
 
 
 def build_error_message(originclass, ex, msg):
-    caller = inspect.stack()[3][3]
+    try:
+        caller = sys._getframe(3).f_code.co_name
+    except ValueError:
+        caller = sys._getframe(1).f_code.co_name
     log.error("%s: exception raised is: '%s' triggered by message:\n %s" % (caller, str(ex), str(msg)))
     return str(ex)
 
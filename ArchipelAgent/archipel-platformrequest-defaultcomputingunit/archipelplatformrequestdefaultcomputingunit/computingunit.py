@@ -20,8 +20,21 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import re
+import time
+
 from archipelcentralagentplatformrequest.scorecomputing import TNBasicPlatformScoreComputing
 
+from scoringengine import TNScoringEngine, parse_constraints, parse_weights, numpy
+
+
+ARCHIPEL_SCORE_VMS_REFRESH_INTERVAL = 30.0
+ARCHIPEL_SCORE_VCPU_RE              = re.compile(r"<vcpu[^>]*>\s*(\d+)\s*</vcpu>")
+# the statistics sent by the hypervisors, in the order of the stat columns, and the scoring feature of each one
+ARCHIPEL_SCORE_STATS                = (("memory", "free", "free_memory"),
+                                       ("CPU", "id", "cpu_idle"),
+                                       ("load", "one", "load"))
+
 
 class TNDefaultComputingUnit (TNBasicPlatformScoreComputing):
 
@@ -32,11 +45,40 @@ class TNDefaultComputingUnit (TNBasicPlatformScoreComputing):
         Initialize the TNBasicPlatformScoreComputing.
         """
         TNBasicPlatformScoreComputing.__init__(self)
-        self.required_stats = [ { "major":"memory", "minor":"free" } ]
+        self.required_stats         = [{"major": major, "minor": minor} for major, minor, feature in ARCHIPEL_SCORE_STATS]
+        self.entity                 = None
+        self.engine                 = None
+        self.vms_refresh_interval   = ARCHIPEL_SCORE_VMS_REFRESH_INTERVAL
+        self.last_vms_refresh       = 0
+        self.vcpus_cache            = {}
 
+    def initialize(self, entity, configuration):
+        """
+        Create the scoring engine and feed it with the statistics received
+        by the central agent.
+        @type entity: L{TNArchipelCentralAgent}
+        @param entity: the central agent
+        @type configuration: Configuration object
+        @param configuration: the configuration
+        """
+        TNBasicPlatformScoreComputing.initialize(self, entity, configuration)
+        weights = None
+        constraints = None
+        if configuration.has_option("PLATFORMREQUEST", "score_weights"):
+            weights = parse_weights(configuration.get("PLATFORMREQUEST", "score_weights"))
+        if configuration.has_option("PLATFORMREQUEST", "score_constraints"):
+            constraints = parse_constraints(configuration.get("PLATFORMREQUEST", "score_constraints"))
+        if configuration.has_option("PLATFORMREQUEST", "score_vms_refresh_interval"):
+            self.vms_refresh_interval = configuration.getfloat("PLATFORMREQUEST", "score_vms_refresh_interval")
+        self.entity = entity
+        self.engine = TNScoringEngine(weights, constraints, getattr(entity, "hypervisor_timeout_threshold", None))
+        if not numpy:
+            entity.log.warning("PLATFORMREQ: NumPy is not installed, the scores are computed in pure Python")
+        entity.register_hook("HOOK_CENTRALAGENT_HYP_STATS_UPDATED", method=self.hook_hypervisors_updated)
+        entity.register_hook("HOOK_CENTRALAGENT_HYP_UNREGISTERED", method=self.hook_hypervisors_unregistered)
 
-    ## Plugin implementation
 
+    ## Plugin implementation
     @staticmethod
     def plugin_info():
         """
@@ -54,6 +96,81 @@ class TNDefaultComputingUnit (TNBasicPlatformScoreComputing):
                     "configuration-tokens"      : plugin_configuration_tokens }
 
 
+    ### Hooks
+
+    def hook_hypervisors_updated(self, origin=None, user_info=None, arguments=None):
+        """
+        Update the features of the hypervisors with the statistics they sent.
+        @type arguments: list
+        @param arguments: the updates of the hypervisors
+        """
+        now = time.time()
+        for entry in arguments or []:
+            if "status" in entry and entry["status"] != "Online":
+                self.engine.remove(entry["jid"])
+                continue
+            values = {}
+            for index, (major, minor, feature) in enumerate(ARCHIPEL_SCORE_STATS):
+                value = entry.get("stat%d" % (index + 1))
+                if value is not None and value != "None":
+                    values[feature] = value
+            self.engine.update(entry["jid"], values, now)
+        if now - self.last_vms_refresh > self.vms_refresh_interval:
+            try:
+                self.refresh(self.entity.database, now)
+            except Exception as ex:
+                self.entity.log.warning("PLATFORMREQ: unable to refresh the scoring engine: %s" % str(ex))
+
+    def hook_hypervisors_unregistered(self, origin=None, user_info=None, arguments=None):
+        """
+        Stop scoring the unregistered hypervisors.
+        @type arguments: list
+        @param arguments: the unregistered hypervisors
+        """
+        for entry in arguments or []:
+            self.engine.remove(entry["jid"])
+
+
+    ### Scoring engine
+
+    def refresh(self, database, now):
+        """
+        Load the online hypervisors the first time, then refresh the number
+        of vms and of committed vCPUs of every hypervisor. The vCPUs of a
+        domain are only parsed again when its fingerprint changes.
+        @type database: L{TNDBController}
+        @param database: the central database, queried with read()
+        @type now: float
+        @param now: the current timestamp
+        """
+        if not self.last_vms_refresh:
+            for row in database.read("select jid, stat1, stat2, stat3 from hypervisors where status='Online'"):
+                values = {}
+                for index, (major, minor, feature) in enumerate(ARCHIPEL_SCORE_STATS):
+                    if row[index + 1] is not None:
+                        values[feature] = row[index + 1]
+                self.engine.update(row[0], values, now)
+        self.last_vms_refresh = now
+
+        vcpus_cache = {}
+        aggregates = {}
+        to_parse = []
+        for uuid, hypervisor, fingerprint in database.read("select uuid, hypervisor, fingerprint from vms where hypervisor != 'None'"):
+            cached = self.vcpus_cache.get(uuid)
+            if cached and fingerprint and cached[0] == fingerprint:
+                vcpus_cache[uuid] = cached
+            else:
+                to_parse.append((uuid, fingerprint))
+            aggregates.setdefault(hypervisor, []).append(uuid)
+        for i in range(0, len(to_parse), 500):
+            chunk = dict(to_parse[i:i + 500])
+            for uuid, domain in database.read("select uuid, domain from vms where uuid in (%s)" % ", ".join(["?"] * len(chunk)), tuple(chunk.keys())):
+                match = ARCHIPEL_SCORE_VCPU_RE.search(domain or "")
+                vcpus_cache[uuid] = (chunk[uuid], int(match.group(1)) if match else 1)
+        self.vcpus_cache = vcpus_cache
+        self.engine.set_vms(dict((hypervisor, (len(uuids), sum(vcpus_cache.get(uuid, (None, 1))[1] for uuid in uuids))) for hypervisor, uuids in aggregates.iteritems()))
+
+
     ### Score computing
 
     def score(self, database, limit=10):
@@ -62,17 +179,24 @@ class TNDefaultComputingUnit (TNBasicPlatformScoreComputing):
         you got to perform the action. If you want to decline
         the performing of the action, return 0.0 or None. the max score
         you can return is 1.0 (so basically see it as a percentage).
+        @type database: L{TNDBController}
+        @param database: the central database, queried with read()
         @type limit: integer
         @param limit: the number of potential hypervisors to suggest
         @rtype: list
         @return: scores of the top hypervisors
         """
+        if self.engine:
+            if not self.last_vms_refresh:
+                self.refresh(database, time.time())
+            return self.engine.score(int(limit or 10), time.time())
+        # without scoring engine:
         # stat1 is the free ram available, we divide it by 256GB of ram to get a first score, the highest ram the better;
         # 1/(1+num_vm) gives us another score based on the number of vms running, the less the better;
-        # but we have to perform an union to take into account the case of hypervisors with no vms
         # we multiply these 2 scores to get the final score.
+        # but we have to perform an union to take into account the case of hypervisors with no vms
         hyp_list = []
-        rows = database.execute("select hypervisors.jid, 1.0/(1+count(vms.uuid))*(hypervisors.stat1/256000000.0) as score_vms\
+        rows = database.read("select hypervisors.jid, 1.0/(1+count(vms.uuid))*(hypervisors.stat1/256000000.0) as score_vms\
                 from hypervisors join vms on hypervisors.jid=vms.hypervisor\
                 where hypervisors.status='Online'\
                 union\
@@ -85,3 +209,47 @@ class TNDefaultComputingUnit (TNBasicPlatformScoreComputing):
         for row in rows:
             hyp_list.append({"jid":row[0], "score":row[1]})
         return hyp_list
+
+    def place(self, database, demands, reserved):
+        """
+        Assign a batch of vms with first-fit-decreasing: the biggest vms are
+        placed first, each one on the best scored hypervisor which still has
+        enough free memory and matches the hard constraints once the vm is
+        added. The resources already reserved are substracted first.
+        @type database: L{TNDBController}
+        @param database: the central database, queried with read()
+        @type demands: list
+        @param demands: list of {"id", "memory", "vcpus"}, the resources needed by each vm
+        @type reserved: dict
+        @param reserved: the {"memory", "vcpus", "vms"} already reserved on each hypervisor by the previous placements
+        @rtype: list
+        @return: list of {"id", "hypervisor"} in the order of the demands, the hypervisor being None if the vm cannot be placed
+        """
+        if not self.engine:
+            raise Exception("Batch placements need the scoring engine")
+        if not self.last_vms_refresh:
+            self.refresh(database, time.time())
+        hypervisors = []
+        for jid, values in self.engine.candidates(time.time()):
+            if jid in reserved:
+                values["free_memory"] -= reserved[jid]["memory"]
+                values["vcpus"] += reserved[jid]["vcpus"]
+                values["vms"] += reserved[jid]["vms"]
+            hypervisors.append((jid, values))
+
+        assignments = {}
+        for index in sorted(range(len(demands)), key=lambda i: (demands[i]["memory"], demands[i]["vcpus"]), reverse=True):
+            demand = demands[index]
+            for jid, values in hypervisors:
+                if values["free_memory"] < demand["memory"]:
+                    continue
+                placed = dict(values)
+                placed["free_memory"] -= demand["memory"]
+                placed["vcpus"] += demand["vcpus"]
+                placed["vms"] += 1
+                if not self.engine.match_constraints(placed):
+                    continue
+                values.update(placed)
+                assignments[index] = jid
+                break
+        return [{"id": demand["id"], "hypervisor": assignments.get(index)} for index, demand in enumerate(demands)]
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+#
+# scoringengine.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNScoringEngine}, the in memory multi-criteria scoring of the
+hypervisors. NumPy is used if it is installed, otherwise the same scores
+are computed in pure Python.
+"""
+
+import operator
+import re
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# features of a hypervisor, and how each one is turned into a score between 0 and 1:
+#   - ratio: value divided by the highest value of the candidates, the highest the better
+#   - percent: value divided by 100, the highest the better
+#   - inverse: 1 / (1 + value), the lowest the better
+ARCHIPEL_SCORE_FEATURES = (("free_memory", "ratio"),
+                           ("cpu_idle", "percent"),
+                           ("load", "inverse"),
+                           ("vms", "inverse"),
+                           ("vcpus", "inverse"))
+ARCHIPEL_SCORE_FEATURES_INDEX = dict((feature, index) for index, (feature, transform) in enumerate(ARCHIPEL_SCORE_FEATURES))
+ARCHIPEL_SCORE_DEFAULT_WEIGHTS = {"free_memory": 1.0, "cpu_idle": 1.0, "load": 1.0, "vms": 1.0, "vcpus": 1.0}
+ARCHIPEL_SCORE_CONSTRAINT_OPERATORS = {">=": operator.ge, "<=": operator.le, ">": operator.gt, "<": operator.lt, "=": operator.eq, "!=": operator.ne}
+ARCHIPEL_SCORE_CONSTRAINT_RE = re.compile(r"^\s*(\w+)\s*(>=|<=|!=|>|<|=)\s*([-+.\deE]+)\s*$")
+ARCHIPEL_SCORE_INITIAL_CAPACITY = 64
+
+
+def parse_weights(value):
+    """
+    Parse weights written as "feature:weight, feature:weight".
+    @type value: string
+    @param value: the weights
+    @rtype: dict
+    @return: the weight of each feature
+    """
+    weights = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        feature, weight = item.split(":")
+        feature = feature.strip()
+        if not feature in ARCHIPEL_SCORE_FEATURES_INDEX:
+            raise Exception("Unknown scoring feature %s" % feature)
+        weights[feature] = float(weight)
+    return weights
+
+def parse_constraints(value):
+    """
+    Parse hard constraints written as "feature>=value, feature<value".
+    @type value: string
+    @param value: the constraints
+    @rtype: list
+    @return: list of (feature, operator, value)
+    """
+    constraints = []
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        match = ARCHIPEL_SCORE_CONSTRAINT_RE.match(item)
+        if not match or not match.group(1) in ARCHIPEL_SCORE_FEATURES_INDEX:
+            raise Exception("Invalid scoring constraint %s" % item)
+        constraints.append((match.group(1), match.group(2), float(match.group(3))))
+    return constraints
+
+
+class TNScoringEngine (object):
+    """
+    Keeps a matrix of the features of the hypervisors, one row per
+    hypervisor, updated as their statistics arrive. A score computes the
+    weighted score of all the hypervisors at once, excluding the ones which
+    do not match the hard constraints or whose statistics are too old.
+    """
+
+    def __init__(self, weights=None, constraints=None, timeout=None):
+        """
+        Initialize the TNScoringEngine.
+        @type weights: dict
+        @param weights: the weight of each feature, the default ones for the missing features
+        @type constraints: list
+        @param constraints: list of (feature, operator, value) the hypervisors must match
+        @type timeout: float
+        @param timeout: the age in seconds after which the statistics of a hypervisor are too old, None to keep them
+        """
+        self.weights        = dict(ARCHIPEL_SCORE_DEFAULT_WEIGHTS)
+        self.weights.update(weights or {})
+        self.constraints    = constraints or []
+        self.timeout        = timeout
+        self.index          = {}
+        self.jids           = []
+        self.free_rows      = []
+        self.lock           = threading.Lock()
+        self._allocate(ARCHIPEL_SCORE_INITIAL_CAPACITY)
+
+    def _allocate(self, capacity):
+        """
+        Allocate or grow the matrix. Must be called with the lock, or at init.
+        @type capacity: int
+        @param capacity: the new number of rows
+        """
+        if numpy is not None:
+            features = numpy.zeros((capacity, len(ARCHIPEL_SCORE_FEATURES)))
+            updated = numpy.zeros(capacity)
+            present = numpy.zeros(capacity, dtype=bool)
+            if self.jids:
+                features[:len(self.jids)] = self.features[:len(self.jids)]
+                updated[:len(self.jids)] = self.updated[:len(self.jids)]
+                present[:len(self.jids)] = self.present[:len(self.jids)]
+        else:
+            features = getattr(self, "features", []) + [[0.0] * len(ARCHIPEL_SCORE_FEATURES) for i in range(capacity - len(getattr(self, "features", [])))]
+            updated = getattr(self, "updated", []) + [0.0] * (capacity - len(getattr(self, "updated", [])))
+            present = getattr(self, "present", []) + [False] * (capacity - len(getattr(self, "present", [])))
+        self.capacity = capacity
+        self.features = features
+        self.updated = updated
+        self.present = present
+
+    def _row(self, jid):
+        """
+        Return the row of a hypervisor, allocating it if needed. Must be called with the lock.
+        @type jid: string
+        @param jid: the JID of the hypervisor
+        @rtype: int
+        @return: the row
+        """
+        if jid in self.index:
+            return self.index[jid]
+        if self.free_rows:
+            row = self.free_rows.pop()
+            self.jids[row] = jid
+        else:
+            row = len(self.jids)
+            if row >= self.capacity:
+                self._allocate(self.capacity * 2)
+            self.jids.append(jid)
+        for column in range(len(ARCHIPEL_SCORE_FEATURES)):
+            self.features[row][column] = 0.0
+        self.index[jid] = row
+        return row
+
+    def update(self, jid, values, now):
+        """
+        Update the features of a hypervisor.
+        @type jid: string
+        @param jid: the JID of the hypervisor
+        @type values: dict
+        @param values: the new value of some features
+        @type now: float
+        @param now: the current timestamp
+        """
+        with self.lock:
+            row = self._row(jid)
+            for feature, value in values.iteritems():
+                self.features[row][ARCHIPEL_SCORE_FEATURES_INDEX[feature]] = float(value)
+            self.updated[row] = now
+            self.present[row] = True
+
+    def set_vms(self, aggregates):
+        """
+        Replace the number of vms and of committed vCPUs of all the hypervisors.
+        @type aggregates: dict
+        @param aggregates: (number of vms, number of vCPUs) by hypervisor JID
+        """
+        vms = ARCHIPEL_SCORE_FEATURES_INDEX["vms"]
+        vcpus = ARCHIPEL_SCORE_FEATURES_INDEX["vcpus"]
+        with self.lock:
+            if numpy is not None:
+                self.features[:, vms] = 0.0
+                self.features[:, vcpus] = 0.0
+            else:
+                for row in self.features:
+                    row[vms] = 0.0
+                    row[vcpus] = 0.0
+            for jid, (vms_count, vcpus_count) in aggregates.iteritems():
+                if jid in self.index:
+                    self.features[self.index[jid]][vms] = float(vms_count)
+                    self.features[self.index[jid]][vcpus] = float(vcpus_count)
+
+    def remove(self, jid):
+        """
+        Stop scoring a hypervisor.
+        @type jid: string
+        @param jid: the JID of the hypervisor
+        """
+        with self.lock:
+            if not jid in self.index:
+                return
+            row = self.index.pop(jid)
+            self.jids[row] = None
+            self.present[row] = False
+            self.free_rows.append(row)
+
+    def score(self, limit, now):
+        """
+        Score all the hypervisors.
+        @type limit: int
+        @param limit: the number of hypervisors to return
+        @type now: float
+        @param now: the current timestamp
+        @rtype: list
+        @return: list of {"jid", "score"} of the best hypervisors, the best first
+        """
+        total_weight = sum(self.weights.values()) or 1.0
+        with self.lock:
+            if numpy is not None:
+                return self._score_numpy(limit, now, total_weight)
+            return self._score_python(limit, now, total_weight)
+
+    def candidates(self, now):
+        """
+        Return the hypervisors which can be scored, with their features.
+        @type now: float
+        @param now: the current timestamp
+        @rtype: list
+        @return: list of (jid, dict of features), the best scored first
+        """
+        scores = self.score(len(self.jids), now)
+        candidates = []
+        with self.lock:
+            for item in scores:
+                row = self.index.get(item["jid"])
+                if row is None:
+                    continue
+                candidates.append((item["jid"], dict((feature, float(self.features[row][column])) for column, (feature, transform) in enumerate(ARCHIPEL_SCORE_FEATURES))))
+        return candidates
+
+    def match_constraints(self, values):
+        """
+        Check if features match the hard constraints.
+        @type values: dict
+        @param values: the value of each feature
+        @rtype: bool
+        @return: True if all the constraints are matched
+        """
+        return all(ARCHIPEL_SCORE_CONSTRAINT_OPERATORS[op](values[feature], value) for feature, op, value in self.constraints)
+
+    def _score_numpy(self, limit, now, total_weight):
+        """
+        Score all the hypervisors in one vectorized pass. Must be called with the lock.
+        """
+        count = len(self.jids)
+        features = self.features[:count]
+        mask = self.present[:count].copy()
+        if self.timeout is not None:
+            mask &= (now - self.updated[:count]) <= self.timeout
+        for feature, op, value in self.constraints:
+            mask &= ARCHIPEL_SCORE_CONSTRAINT_OPERATORS[op](features[:, ARCHIPEL_SCORE_FEATURES_INDEX[feature]], value)
+        candidates = numpy.flatnonzero(mask)
+        if not len(candidates):
+            return []
+        scores = numpy.zeros(len(candidates))
+        for column, (feature, transform) in enumerate(ARCHIPEL_SCORE_FEATURES):
+            weight = self.weights.get(feature, 0.0)
+            if not weight:
+                continue
+            values = features[candidates, column]
+            if transform == "ratio":
+                highest = values.max()
+                scores += weight * (values / highest if highest > 0 else numpy.zeros(len(values)))
+            elif transform == "percent":
+                scores += weight * numpy.clip(values / 100.0, 0.0, 1.0)
+            else:
+                scores += weight / (1.0 + numpy.maximum(values, 0.0))
+        scores /= total_weight
+        if limit < len(candidates):
+            best = numpy.argpartition(-scores, limit - 1)[:limit]
+        else:
+            best = numpy.arange(len(candidates))
+        best = best[numpy.argsort(-scores[best], kind="mergesort")]
+        return [{"jid": self.jids[candidates[i]], "score": float(scores[i])} for i in best]
+
+    def _score_python(self, limit, now, total_weight):
+        """
+        Score all the hypervisors without NumPy. Must be called with the lock.
+        """
+        candidates = []
+        for row, jid in enumerate(self.jids):
+            if not jid or not self.present[row]:
+                continue
+            if self.timeout is not None and now - self.updated[row] > self.timeout:
+                continue
+            features = self.features[row]
+            if all(ARCHIPEL_SCORE_CONSTRAINT_OPERATORS[op](features[ARCHIPEL_SCORE_FEATURES_INDEX[feature]], value) for feature, op, value in self.constraints):
+                candidates.append(row)
+        highest = {}
+        for column, (feature, transform) in enumerate(ARCHIPEL_SCORE_FEATURES):
+            if transform == "ratio":
+                highest[column] = max([self.features[row][column] for row in candidates] or [0.0])
+        scores = []
+        for row in candidates:
+            score = 0.0
+            for column, (feature, transform) in enumerate(ARCHIPEL_SCORE_FEATURES):
+                weight = self.weights.get(feature, 0.0)
+                value = self.features[row][column]
+                if not weight:
+                    continue
+                if transform == "ratio":
+                    score += weight * (value / highest[column] if highest[column] > 0 else 0.0)
+                elif transform == "percent":
+                    score += weight * min(max(value / 100.0, 0.0), 1.0)
+                else:
+                    score += weight / (1.0 + max(value, 0.0))
+            scores.append({"jid": self.jids[row], "score": score / total_weight})
+        scores.sort(key=lambda item: -item["score"])
+        return scores[:limit]